@@ -13,9 +13,10 @@ formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 console.setFormatter(formatter)
 logging.getLogger().addHandler(console)
 
+# Run from the repository root: python -m dev.validate_zarr_values01
 # Define paths and parameters
-data_dir = '../data'
-save_dir = '../tmp_data'
+data_dir = 'data'
+save_dir = 'tmp_data'
 grid_resolutions = {'04': '0.25', '01': '1.00'}
 grid_dir = {'04': '025_degree', '01': '1_degree'}
 grid_res = '04'  # change this to '01' for 1-degree resolution, '04' for 0.25-degree
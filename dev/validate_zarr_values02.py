@@ -0,0 +1,239 @@
+import os
+import json
+import hashlib
+import logging
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import xarray as xr
+import zarr
+from tqdm import tqdm
+
+# Full validation of the zarr store against its source NetCDF files: every (parameter, time period) slab of every
+# group is compared, all variables and all values, one depth chunk band at a time on a process pool. Values must be
+# equal, NaN where the source is NaN (missing chunks read as the NaN fill value). Each stored zarr chunk gets a digest
+# of its raw bytes, written with the result of its band to a JSON report; a later run with the previous report
+# re-verifies only the bands whose source file changed, whose chunks changed, or which did not pass.
+# Run from the repository root: python -m dev.validate_zarr_values02
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+parameters = {
+    't': 'temperature',
+    's': 'salinity',
+    'o': 'oxygen',
+    'O': 'o2sat',
+    'A': 'AOU',
+    'i': 'silicate',
+    'p': 'phosphate',
+    'n': 'nitrate'
+}
+time_periods = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '11', '12', '13', '14', '15', '16']
+data_variables = ['an', 'mn', 'dd', 'ma', 'sd', 'se', 'oa', 'gp', 'sdo', 'sea']
+grid_dir = {'04': '025_degree', '01': '1_degree'}
+
+# Function to determine the subgroup
+def determine_subgroup(param, period):
+    param_name = parameters[param]
+    param_group = 'Nutrients'
+
+    if param_name in ['temperature', 'salinity']:
+        param_group = 'TS'
+    elif param_name in ['oxygen', 'o2sat', 'AOU']:
+        param_group = 'Oxy'
+
+    if period == '0':
+        subgroup = f'annual/{param_group}'
+    elif period in ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '11', '12']:
+        subgroup = f'monthly/{param_group}'
+    else:
+        subgroup = f'seasonal/{param_group}'
+
+    return subgroup
+
+def source_file(save_dir, param, period, res):
+    span = 'decav' if param in ['t', 's'] else 'all'
+    return os.path.abspath(f'{save_dir}/woa23_{span}_{param}{period.zfill(2)}_{res}.nc')
+
+def source_state(nc_file):
+    st = os.stat(nc_file)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+def chunk_key(arr, chunk_coords):
+    separator = getattr(arr, '_dimension_separator', None) or '.'
+    return f"{arr.path}/{separator.join(str(c) for c in chunk_coords)}"
+
+def chunk_digest(arr, chunk_coords):
+    """
+    blake2b of the stored (compressed) bytes of a chunk, 'fill' if the chunk is not stored
+    """
+    try:
+        raw = arr.store[chunk_key(arr, chunk_coords)]
+    except KeyError:
+        return 'fill'
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+def band_chunks(group, variables, ti, pi, di):
+    """
+    {'var/key': digest} of the zarr chunks of one (time period, parameter, depth chunk) band
+    """
+    digests = {}
+    for var in variables:
+        arr = group[var]
+        n_lat = -(-arr.shape[3] // arr.chunks[3])
+        n_lon = -(-arr.shape[4] // arr.chunks[4])
+        for yi in range(n_lat):
+            for xi in range(n_lon):
+                digests[chunk_key(arr, (ti, pi, di, yi, xi))] = chunk_digest(arr, (ti, pi, di, yi, xi))
+    return digests
+
+def validate_band(zarr_group_path, nc_file, param, period, di, previous=None):
+    """
+    Compare one depth chunk band of a slab with its source. `previous` is the report entry of this band from an
+    earlier run: if it passed with the same source file and chunk digests, the values are not read again.
+    """
+    result = {'status': 'ok', 'source': source_state(nc_file)}
+    group = zarr.open_group(zarr_group_path, mode='r')
+    times = [str(t) for t in group['time_periods'][:]]
+    params = [str(p) for p in group['parameters'][:]]
+    ti, pi = times.index(period), params.index(parameters[param])
+
+    zarr_vars = [var for var in data_variables if var in group]
+    result['chunks'] = band_chunks(group, zarr_vars, ti, pi, di)
+    if (previous and previous.get('status') == 'ok' and previous.get('source') == result['source']
+            and previous.get('chunks') == result['chunks']):
+        result['skipped'] = True
+        return result
+
+    with xr.open_dataset(nc_file, decode_times=False) as ds_nc:
+        nc_vars = {var: f'{param}_{var}' for var in data_variables if f'{param}_{var}' in ds_nc}
+        variables = [var for var in zarr_vars if var in nc_vars]
+        problems = {}
+        missing = sorted(set(zarr_vars) - set(nc_vars))
+        if missing:
+            problems['variables'] = f"no source variable for {missing}"
+        not_stored = sorted(set(nc_vars) - set(zarr_vars))
+        if not_stored:
+            # e.g. 'ma' of annual files, not part of the annual groups
+            result['not_stored'] = not_stored
+        depth_chunk = group[variables[0]].chunks[2]
+        depth_sl = slice(di * depth_chunk, min((di + 1) * depth_chunk, group['depth'].shape[0]))
+        if di == 0:
+            for coord in ['depth', 'lat', 'lon']:
+                if group[coord].shape[0] != ds_nc.sizes[coord] or not np.allclose(group[coord][:], ds_nc[coord].values):
+                    problems[coord] = 'coordinates differ'
+
+        for var in variables:
+            arr = group[var]
+            zarr_values = arr[ti, pi, depth_sl]
+            nc_values = ds_nc[nc_vars[var]].isel(depth=depth_sl).transpose(..., 'depth', 'lat', 'lon').values
+            nc_values = nc_values.reshape(zarr_values.shape)
+            equal = (zarr_values == nc_values) | (np.isnan(zarr_values) & np.isnan(nc_values))
+            if equal.all():
+                continue
+            # localize the differences to the zarr chunks of the band
+            bad_chunks = []
+            lat_chunk, lon_chunk = arr.chunks[3], arr.chunks[4]
+            for yi in range(-(-arr.shape[3] // lat_chunk)):
+                for xi in range(-(-arr.shape[4] // lon_chunk)):
+                    block = equal[:, yi * lat_chunk:(yi + 1) * lat_chunk, xi * lon_chunk:(xi + 1) * lon_chunk]
+                    if not block.all():
+                        bad_chunks.append(chunk_key(arr, (ti, pi, di, yi, xi)))
+            diff = np.abs(zarr_values - nc_values)
+            problems[var] = {
+                'count': int((~equal).sum()),
+                'nan_mismatch': int((np.isnan(zarr_values) != np.isnan(nc_values)).sum()),
+                'max_abs_diff': float(np.nanmax(diff)) if np.isfinite(diff).any() else None,
+                'chunks': bad_chunks,
+            }
+    if problems:
+        result['status'] = 'mismatch'
+        result['problems'] = problems
+    return result
+
+def _validate_band_task(args):
+    key, band, zarr_group_path, nc_file, param, period, di, previous = args
+    try:
+        return key, band, validate_band(zarr_group_path, nc_file, param, period, di, previous)
+    except Exception as e:
+        return key, band, {'status': 'error', 'error': repr(e)}
+
+def write_report(report, report_path):
+    tmp = f'{report_path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    os.replace(tmp, report_path)
+
+def validate_store(data_dir, save_dir, res, report_path, params=None, periods=None, workers=4, full=False):
+    """
+    Validate all slabs of a grid and write the report. Without `full`, bands that passed in the previous report at
+    `report_path` are re-verified only if their source file or chunks changed. Returns the report.
+    """
+    previous = {}
+    if not full and os.path.exists(report_path):
+        with open(report_path, 'r') as f:
+            previous = json.load(f).get('slabs', {})
+
+    report = {'grid': res, 'data_dir': os.path.abspath(data_dir), 'started_at': datetime.now(timezone.utc).isoformat(), 'slabs': {}}
+    tasks = []
+    for param in (params or list(parameters)):
+        for period in (periods or time_periods):
+            key = f'{param},{period}'
+            zarr_group_path = os.path.abspath(os.path.join(data_dir, grid_dir[res], determine_subgroup(param, period)))
+            nc_file = source_file(save_dir, param, period, res)
+            slab = {'group': zarr_group_path, 'source_file': nc_file, 'bands': {}}
+            report['slabs'][key] = slab
+            if not os.path.exists(nc_file):
+                slab['status'] = 'missing_source'
+                continue
+            if not os.path.isdir(zarr_group_path):
+                slab['status'] = 'missing_group'
+                continue
+            group = zarr.open_group(zarr_group_path, mode='r')
+            if parameters[param] not in [str(p) for p in group['parameters'][:]] or period not in [str(t) for t in group['time_periods'][:]]:
+                slab['status'] = 'missing_slab'
+                continue
+            depth_chunk = next(group[var].chunks[2] for var in data_variables if var in group)
+            n_bands = -(-group['depth'].shape[0] // depth_chunk)
+            previous_bands = previous.get(key, {}).get('bands', {})
+            for di in range(n_bands):
+                tasks.append((key, str(di), zarr_group_path, nc_file, param, period, di, previous_bands.get(str(di))))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_validate_band_task, task) for task in tasks]
+        for future in tqdm(as_completed(futures), total=len(futures), desc=f'validating {res}', ncols=100):
+            key, band, result = future.result()
+            report['slabs'][key]['bands'][band] = result
+            if result['status'] != 'ok':
+                logger.error(f"{key} depth band {band} of {report['slabs'][key]['group']}: {result['status']} {result.get('problems') or result.get('error')}")
+
+    summary = {'slabs': 0, 'bands': 0, 'bands_verified': 0, 'bands_skipped': 0, 'chunks': 0, 'failed': []}
+    for key, slab in report['slabs'].items():
+        if 'status' not in slab:
+            bands = slab['bands'].values()
+            slab['status'] = 'ok' if all(b['status'] == 'ok' for b in bands) else \
+                ('error' if any(b['status'] == 'error' for b in bands) else 'mismatch')
+            summary['bands'] += len(bands)
+            summary['bands_skipped'] += sum(1 for b in bands if b.get('skipped'))
+            summary['chunks'] += sum(len(b.get('chunks', {})) for b in bands)
+        summary['slabs'] += 1
+        if slab['status'] != 'ok':
+            summary['failed'].append(key)
+    summary['bands_verified'] = summary['bands'] - summary['bands_skipped']
+    report['summary'] = summary
+    report['finished_at'] = datetime.now(timezone.utc).isoformat()
+    write_report(report, report_path)
+    logger.info(f"Validation of {res}: {summary['slabs'] - len(summary['failed'])}/{summary['slabs']} slabs ok, "
+                f"{summary['bands_verified']} bands verified, {summary['bands_skipped']} unchanged. Report: {report_path}")
+    return report
+
+def main():
+    data_dir = 'data'
+    save_dir = 'tmp_data'
+    for res in ['01', '04']:
+        validate_store(data_dir, save_dir, res, f'dev/validation_report_{res}.json', workers=os.cpu_count())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+import os
+import time
+import logging
+import argparse
+import tempfile
+import numpy as np
+import xarray as xr
+from src.zarr_cache import ZarrDatasetCache
+from src.woa23_mask import OceanMasks
+from src.woa23_query import QueryPlan, select_group, read_selection_block, assemble_wide, result_columns, finalize_columns, iter_slab_batches
+from src.woa23_backend import ZarrBackend, ColumnarBackend, ColumnarExports
+from dev.zarr_geoparquet_woa23 import export_group
+from dev.zarr_ocean_mask_woa23 import build_mask
+
+# Conformance test of the query backends (src/woa23_backend.py): the same query plans are read from the zarr store
+# (direct chunk reads and xarray/Dask) and from its GeoParquet export (dev/zarr_geoparquet_woa23.py), as whole
+# selections and as streamed slab batches, with and without the ocean masks and dropna. Every frame must equal the
+# zarr/xarray frame (values, nulls, row and column order, dtypes). Prints the read time of each backend per query shape.
+# With --synthetic, a tiny generated group is checked instead of the store (no data needed; runs in seconds).
+# Run from the repository root: python -m dev.woa23_backend_conformance [--synthetic]
+
+grid_dir = {'01': '1_degree', '04': '025_degree'}
+grid_size = {'01': 1.0, '04': 0.25}
+subgroups = [f'{period_group}/{param_group}' for period_group in ['annual', 'monthly', 'seasonal'] for param_group in ['TS', 'Oxy', 'Nutrients']]
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+def query_shapes(ds, rng, n_random):
+    """
+    (name, lon range, lat range, depth range, time periods, variables) of fixed shapes and `n_random` random boxes
+    """
+    lons, lats, depths = ds['lon'].values, ds['lat'].values, ds['depth'].values
+    periods = [str(tp) for tp in ds['time_periods'].values]
+    variables = list(ds.data_vars)
+    mid_lon, mid_lat = len(lons) // 2, len(lats) // 2
+    shapes = [
+        ('point profile', (lons[mid_lon], lons[mid_lon]), (lats[mid_lat], lats[mid_lat]), (depths[0], depths[-1]), periods[:1], ['mn']),
+        ('10x10 box', (lons[mid_lon], lons[mid_lon + 9]), (lats[mid_lat], lats[mid_lat + 9]), (depths[0], depths[-1]), periods, ['mn']),
+        ('global, one depth', (lons[0], lons[-1]), (lats[0], lats[-1]), (depths[3], depths[3]), periods, ['mn']),
+        ('global, all periods x 4 depths', (lons[0], lons[-1]), (lats[0], lats[-1]), (depths[0], depths[3]), periods, ['mn', 'sd']),
+        ('60x30 box, one depth', (lons[mid_lon], lons[mid_lon + 59]), (lats[mid_lat], lats[mid_lat + 29]), (depths[10], depths[10]), periods, variables[:3]),
+        ('60x30 box, all depths', (lons[mid_lon], lons[mid_lon + 59]), (lats[mid_lat], lats[mid_lat + 29]), (depths[0], depths[-1]), periods[:1], ['mn']),
+    ]
+    for k in range(n_random):
+        x0, x1 = sorted(rng.integers(0, len(lons), 2))
+        y0, y1 = sorted(rng.integers(0, len(lats), 2))
+        d0, d1 = sorted(rng.integers(0, len(depths), 2))
+        tps = sorted(rng.choice(periods, rng.integers(1, len(periods) + 1), replace=False), key=periods.index)
+        vars_ = list(rng.choice(variables, rng.integers(1, min(3, len(variables)) + 1), replace=False))
+        shapes.append((f'random {k}', (lons[x0], lons[x1]), (lats[y0], lats[y1]), (depths[d0], depths[d1]), tps, vars_))
+    return shapes
+
+def read_frames(plan, sel, backend, max_rows):
+    """
+    The result frame of one selection read whole, and the frames of its streamed slab batches
+    """
+    columns = result_columns([sel], plan.variables)
+    whole = finalize_columns(assemble_wide([read_selection_block(sel, backend=backend)], plan.variables, columns, plan.dropna), plan)
+    batches = [finalize_columns(assemble_wide([read_selection_block(s, tp_pos, depth_pos, backend=backend) for s, tp_pos, depth_pos in parts],
+                                              plan.variables, columns, plan.dropna), plan)
+               for parts in iter_slab_batches([sel], max_rows)]
+    return whole, batches
+
+def synthetic_group(root, seed=0, row_group_rows=512):
+    """
+    Write a tiny 1-degree group under `root`: 2 time periods, 2 parameters and 12 depths (two depth chunks) on a
+    60 x 120 tile with land, a random sea floor and scattered NaNs, chunked across lat/lon too, with its ocean mask and
+    GeoParquet export (small row groups). Returns the group and export paths.
+    """
+    rng = np.random.default_rng(seed)
+    lon = np.arange(-59.5, 60, 1.0, dtype=np.float32)
+    lat = np.arange(-29.5, 30, 1.0, dtype=np.float32)
+    depth = np.concatenate([np.arange(0, 50, 10), np.arange(50, 400, 50)], dtype=np.float32)
+    parameters, periods = ['temperature', 'salinity'], ['13', '14']
+    shape = (len(periods), len(parameters), len(depth), len(lat), len(lon))
+    bottom = rng.integers(-1, len(depth), size=(len(lat), len(lon)))  # deepest level with values, -1 on land
+    below = np.arange(len(depth))[:, None, None] > bottom
+    data_vars = {}
+    for k, var in enumerate(['mn', 'an', 'sd']):
+        values = (rng.standard_normal(shape) * 3 + 10 + k).astype(np.float32)
+        values[..., below] = np.nan
+        values[rng.random(shape) < 0.05] = np.nan
+        data_vars[var] = (('time_periods', 'parameters', 'depth', 'lat', 'lon'), values)
+    ds = xr.Dataset(data_vars, coords={'lon': lon, 'lat': lat, 'depth': depth, 'parameters': parameters, 'time_periods': periods})
+
+    zarr_group_path = os.path.join(root, 'data', grid_dir['01'], 'seasonal', 'TS')
+    export_path = os.path.join(root, 'data_parquet', grid_dir['01'], 'seasonal', 'TS')
+    ds.chunk({'time_periods': 1, 'parameters': 1, 'depth': 8, 'lat': 30, 'lon': 60}).to_zarr(zarr_group_path, mode='w', consolidated=False)
+    build_mask(zarr_group_path)
+    export_group(zarr_group_path, export_path, workers=2, row_group_rows=row_group_rows)
+    return zarr_group_path, export_path
+
+def check_group(zarr_group_path, export_path, res, n_random=20, seed=0, max_rows=50000, required=False):
+    """
+    Compare the backends on the query shapes of one group. Returns the number of failed comparisons
+    (a missing or outdated export counts as one with `required`, otherwise the group is skipped).
+    """
+    zarr_cache = ZarrDatasetCache()
+    exports = ColumnarExports()
+    masks = OceanMasks()
+    version = zarr_cache.version(zarr_group_path)
+    export = exports.get(export_path, version)
+    if export is None:
+        if required:
+            logger.error(f"No up-to-date export of {zarr_group_path} in {export_path}.")
+            return 1
+        logger.warning(f"No up-to-date export of {zarr_group_path} in {export_path}. Skipping.")
+        return 0
+    ds = xr.open_zarr(zarr_group_path)
+    params = [str(p) for p in ds['parameters'].values]
+    backends = [ZarrBackend(zarr_cache), ZarrBackend(zarr_cache, direct=True), ColumnarBackend(export)]
+    labels = ['zarr/xarray', 'zarr/direct', 'columnar']
+    failed = 0
+    rng = np.random.default_rng(seed)
+    for name, (lon_min, lon_max), (lat_min, lat_max), (depth_min, depth_max), periods, variables in query_shapes(ds, rng, n_random):
+        for masked, dropna in [(False, False), (True, False), (True, True)]:
+            plan = QueryPlan(res, grid_size[res], params, periods, variables, [zarr_group_path],
+                             float(lon_min), float(lon_max) + 0.1, float(lat_min), float(lat_max) + 0.1,
+                             float(depth_min), float(depth_max), dropna=dropna)
+            sel = select_group(plan, zarr_group_path, ds)
+            if masked:
+                bottom = masks.get(zarr_group_path, version)
+                if bottom is None:
+                    continue
+                sel.valid_depth_stop = int(bottom[sel.lat_sl, sel.lon_sl].max())
+            timings = []
+            reference = None
+            for label, backend in zip(labels, backends):
+                start = time.perf_counter()
+                whole, batches = read_frames(plan, sel, backend, max_rows)
+                timings.append(f"{label} {time.perf_counter() - start:.3f}s")
+                if reference is None:
+                    reference = (whole, batches)
+                    continue
+                if not whole.equals(reference[0]) or whole.schema != reference[0].schema or len(batches) != len(reference[1]) \
+                        or not all(b.equals(r) and b.schema == r.schema for b, r in zip(batches, reference[1])):
+                    failed += 1
+                    logger.error(f"{zarr_group_path} '{name}' (masked={masked}, dropna={dropna}): {label} differs from {labels[0]}")
+            logger.info(f"{os.path.basename(zarr_group_path)} '{name}' (masked={masked}, dropna={dropna}), {reference[0].height} rows: {', '.join(timings)}")
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that all query backends return identical frames')
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--parquet-dir', default='data_parquet')
+    parser.add_argument('--grids', default='01,04', help="comma-separated: '01' (1-degree), '04' (0.25-degree)")
+    parser.add_argument('--random', type=int, default=20, help='random query boxes per group')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--synthetic', action='store_true', help='check a tiny generated group instead of the store')
+    args = parser.parse_args()
+
+    failed = 0
+    if args.synthetic:
+        with tempfile.TemporaryDirectory() as root:
+            zarr_group_path, export_path = synthetic_group(root, args.seed)
+            # small batches: the streamed reads span several slab batches
+            failed = check_group(zarr_group_path, export_path, '01', args.random, args.seed, max_rows=2000, required=True)
+        if failed:
+            raise SystemExit(f"{failed} backend comparisons failed")
+        logger.info("All backends returned identical frames.")
+        return
+
+    for res in [g.strip() for g in args.grids.split(',')]:
+        for subgroup in subgroups:
+            zarr_group_path = os.path.abspath(os.path.join(args.data_dir, grid_dir[res], subgroup))
+            if os.path.isdir(zarr_group_path):
+                failed += check_group(zarr_group_path, os.path.abspath(os.path.join(args.parquet_dir, grid_dir[res], subgroup)),
+                                      res, args.random, args.seed)
+    if failed:
+        raise SystemExit(f"{failed} backend comparisons failed")
+    logger.info("All backends returned identical frames.")
+
+if __name__ == '__main__':
+    main()
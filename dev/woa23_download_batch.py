@@ -1,14 +1,22 @@
 import os
+import json
+import hashlib
 import logging
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 from tqdm import tqdm
 
+# Concurrent, resumable download of the WOA23 NetCDF files from NCEI (also used by dev/zarr_parallel_write_woa23.py).
+# Run from the repository root: python -m dev.woa23_download_batch
+
 # Define paths and parameters
 parameters = {
-    # 't': 'temperature', #when download 1-degree, all time spans, disable temperature, salinity
-    # 's': 'salinity',    #see https://www.ncei.noaa.gov/data/oceans/woa/WOA23/DOCUMENTATION/WOA23_Product_Documentation.pdf
+    't': 'temperature',
+    's': 'salinity',
     'o': 'oxygen',
     'O': 'o2sat',
     'A': 'AOU',
@@ -43,94 +51,272 @@ grid_resolutions = {
 # Logging setup
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger()
-file_handler = logging.FileHandler('download_processing.log', mode='w')
-file_handler.setLevel(logging.INFO)
-file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-logger.addHandler(file_handler)
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-logger.addHandler(console_handler)
-
-completed_downloads = set()
-
-# Function to read completed downloads
-def load_completed_downloads(res):
-    global completed_downloads
-    completed_data_file = f'data_downloaded_{res}.txt'
-    if os.path.exists(completed_data_file):
-        with open(completed_data_file, 'r') as f:
-            for line in f:
-                completed_downloads.add(line.strip())
-
-# Function to write a completed download entry
-def write_completed_download(param, period, grid_res, nc_file):
-    completed_data_file = f'data_downloaded_{grid_res}.txt'
-    with open(completed_data_file, 'a') as f:
-        f.write(f'{param},{period},{grid_res},{nc_file}\n')
-
-# Function to download data with retry, timeout, and progress logging
-def download_data(url, save_path, retries=3, timeout=300, chunk_size=1024*1024):
-    session = requests.Session()
-    retry = Retry(total=retries, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
 
-    try:
-        response = session.get(url, timeout=timeout, stream=True)
-        response.raise_for_status()  # Raise HTTPError for bad responses
+def setup_file_logging():
+    file_handler = logging.FileHandler('download_processing.log', mode='w')
+    file_handler.setLevel(logging.INFO)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logger.addHandler(file_handler)
 
-        total_size = int(response.headers.get('content-length', 0))
-        downloaded_size = 0
+MANIFEST_FILE = 'download_manifest.json'  # in the save directory: file name -> url, size, sha256, validators
+_thread_local = threading.local()
 
-        with open(save_path, 'wb') as f, tqdm(total=total_size, unit='B', unit_scale=True, desc=save_path, ncols=100) as pbar:
-            for data in response.iter_content(chunk_size=chunk_size):
-                f.write(data)
-                downloaded_size += len(data)
-                pbar.update(len(data))
+def get_session(pool_size=8, retries=3):
+    """
+    One pooled session per download thread: connections are kept alive and reused across the files of that thread
+    """
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _thread_local.session = session
+    return session
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to download {url}: {e}")
-        raise
+# Function to build the NCEI url of a WOA23 NetCDF file
+# decav: 1955-2022, Average of seven decadal means from 1955 to 2022 (temperature, salinity).
+# all: All available years. Average of all available data. Refers to the 1965-2022 time span for dissolved oxygen (and related fields) and nutrients
+def file_url(param, period, res, base_url=None):
+    span = 'decav' if param in ['t', 's'] else 'all'
+    if base_url is None:
+        base_url = "https://www.ncei.noaa.gov/data/oceans/woa/WOA23/DATA" if param in ['t', 's'] else "https://www.ncei.noaa.gov/thredds-ocean/fileServer/woa23/DATA"
+    file_name = f'woa23_{span}_{param}{period.zfill(2)}_{res}.nc'
+    return file_name, f'{base_url}/{parameters[param]}/netcdf/{span}/{grid_resolutions[res]}/{file_name}'
 
-# Function to check if a dataset has been downloaded
-def is_data_downloaded(param, period, grid_res):
-    return f'{param},{period},{grid_res}' in completed_downloads
+class DownloadManifest:
+    """
+    JSON record of the downloaded files (size, sha256 and HTTP validators), rewritten atomically after each file.
+    The size and hash of an entry are what a new download is verified against while the server still reports the
+    same version of the file (ETag / Last-Modified); a republished file is recorded anew.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
 
-# Function to download WOA2023 datasets
-# decav: 1955-2022, Average of seven decadal means from 1955 to 2022.
-# all: All available years. Average of all available data. Refers to the 1965-2022 time span for dissolved oxygen (and related fields) and nutrients
-def download_woa23_datasets(save_dir):
-    grids = ["01"] # ["04", "01"]  # Download 0.25-degree data first
-    # base_url = "https://www.ncei.noaa.gov/data/oceans/woa/WOA23/DATA" # for 0.25-degree
-    base_url = "https://www.ncei.noaa.gov/thredds-ocean/fileServer/woa23/DATA" #for 1.0 degreee
-    span = 'all' # decav
+    def get(self, file_name):
+        with self._lock:
+            return dict(self.entries.get(file_name, {}))
 
-    for res in grids:
-        load_completed_downloads(res)
+    def update(self, file_name, **fields):
+        with self._lock:
+            self.entries.setdefault(file_name, {}).update(fields)
+            self._write()
 
-        for param in parameters:
-            for period in time_periods.keys():
-                if is_data_downloaded(param, period, res):
-                    logger.info(f"Skipping already downloaded dataset: {param} {period} {res}")
-                    continue
+    def reset(self, file_name, **fields):
+        """
+        Replace the entry of a file, e.g. when the server has a new version of it
+        """
+        with self._lock:
+            self.entries[file_name] = dict(fields)
+            self._write()
+
+    def _write(self):
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def get_manifest(save_dir):
+    """
+    The download manifest of a save directory, one instance per process so that concurrent writers share its lock
+    """
+    path = os.path.abspath(os.path.join(save_dir, MANIFEST_FILE))
+    with _manifests_lock:
+        if path not in _manifests:
+            _manifests[path] = DownloadManifest(path)
+        return _manifests[path]
+
+def same_version(entry, headers):
+    """
+    True if the response headers carry the ETag (or, without ETags, the Last-Modified) recorded in the manifest entry
+    """
+    if headers.get('etag') and entry.get('etag'):
+        return headers['etag'] == entry['etag']
+    if headers.get('last-modified') and entry.get('last_modified'):
+        return headers['last-modified'] == entry['last_modified']
+    return False
+
+def file_sha256(path, chunk_size=8*1024*1024):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            sha.update(block)
+    return sha
 
-                padded_period = period.zfill(2)
-                file_name = f'woa23_{span}_{param}{padded_period}_{res}.nc'
-                url = f'{base_url}/{parameters[param]}/netcdf/{span}/{grid_resolutions[res]}/{file_name}'
-                nc_file = os.path.abspath(f'{save_dir}/{file_name}')
-
-                if not os.path.exists(nc_file):
-                    logger.info(f"Downloading file from {url}")
-                    try:
-                        download_data(url, nc_file)
-                        write_completed_download(param, period, res, nc_file)
-                    except Exception as e:
-                        logger.error(f"Skipping file {file_name} due to error: {e}")
+def download_data(url, save_path, manifest, retries=3, timeout=300, chunk_size=1024*1024, pbar=None):
+    """
+    Download `url` to `save_path` through `save_path`.part: a partial file left by an interrupted run (or a dropped
+    connection) is resumed with an HTTP Range request, as long as the file did not change on the server (If-Range).
+    The file is moved into place only once its size matches Content-Length and, if the server still reports the
+    version recorded in the manifest, its size and sha256 match the manifest; otherwise they are recorded anew.
+    """
+    file_name = os.path.basename(save_path)
+    part_path = f'{save_path}.part'
+    session = get_session()
+    if os.path.exists(save_path) and not os.path.exists(part_path):
+        # a file not (or no longer) matching the manifest, e.g. left truncated by an older run: resume and verify it
+        os.replace(save_path, part_path)
+
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        expected = manifest.get(file_name)  # validators recorded by the previous attempt, if any
+        headers = {}
+        validator = expected.get('etag') or expected.get('last_modified')
+        if offset and validator:
+            headers = {'Range': f'bytes={offset}-', 'If-Range': validator}
+        elif offset:
+            headers = {'Range': f'bytes={offset}-'}
+        try:
+            with session.get(url, timeout=timeout, stream=True, headers=headers) as response:
+                if response.status_code != 416 or not offset:
+                    response.raise_for_status()  # Raise HTTPError for bad responses
+                current = same_version(expected, response.headers)
+                if response.status_code in (206, 416) and offset and not current:
+                    # the partial file may belong to another version of the file (no validator to resume with)
+                    logger.info(f"Restarting {file_name} from zero (version of the partial file unknown)")
+                    os.remove(part_path)
+                    continue
+                if not current:
+                    # new (or first) version: the recorded size and hash no longer apply
+                    manifest.reset(file_name, url=url, etag=response.headers.get('etag'),
+                                   last_modified=response.headers.get('last-modified'))
+                    expected = {}
+                if response.status_code == 416 and offset:
+                    # nothing left to fetch: the partial file is complete or too long (verified below)
+                    total_size = response.headers.get('content-range', '').rpartition('/')[2]
+                    total_size = int(total_size) if total_size.isdigit() else 0
+                    sha = file_sha256(part_path)
                 else:
-                    logger.info(f"Using existing file: {nc_file}")
+                    if response.status_code == 206:
+                        sha = file_sha256(part_path)
+                        total_size = offset + int(response.headers.get('content-length', 0))
+                        mode = 'ab'
+                    else:
+                        # full response: the server ignored the range or the file changed, start from zero
+                        if offset:
+                            logger.info(f"Restarting {file_name} from zero (server sent the full file)")
+                        sha, offset, mode = hashlib.sha256(), 0, 'wb'
+                        total_size = int(response.headers.get('content-length', 0))
+                    if offset and pbar is not None:
+                        pbar.update(offset)
+                    with open(part_path, mode) as f:
+                        for data in response.iter_content(chunk_size=chunk_size):
+                            f.write(data)
+                            sha.update(data)
+                            if pbar is not None:
+                                pbar.update(len(data))
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout) as e:
+            if attempt == retries:
+                logger.error(f"Failed to download {url}: {e}")
+                raise
+            logger.warning(f"Download of {file_name} interrupted ({e}), resuming ({attempt + 1}/{retries})")
+            continue
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to download {url}: {e}")
+            raise
+
+        size = os.path.getsize(part_path)
+        digest = sha.hexdigest()
+        if (total_size and size != total_size) or ('size' in expected and size != expected['size']) \
+                or ('sha256' in expected and digest != expected['sha256']):
+            os.remove(part_path)
+            if attempt == retries:
+                raise IOError(f"Integrity check failed for {file_name}: size {size}, sha256 {digest}, expected {expected}")
+            logger.warning(f"Integrity check failed for {file_name}, downloading it again ({attempt + 1}/{retries})")
+            continue
+
+        os.replace(part_path, save_path)
+        manifest.update(file_name, size=size, sha256=digest, downloaded_at=datetime.now(timezone.utc).isoformat())
+        return save_path
+    raise IOError(f"Failed to download {file_name} in {retries + 1} attempts")
+
+def is_data_downloaded(nc_file, manifest, verify=False, url=None, timeout=60):
+    """
+    True if the file is in place with the size (and, with `verify`, the sha256) recorded in the manifest and, given
+    its `url`, the server still has that version: conditional HEAD request on the recorded ETag / Last-Modified.
+    If the server cannot be reached the local file is kept.
+    """
+    entry = manifest.get(os.path.basename(nc_file))
+    if not os.path.exists(nc_file) or 'size' not in entry or os.path.getsize(nc_file) != entry['size']:
+        return False
+    if verify and file_sha256(nc_file).hexdigest() != entry.get('sha256'):
+        return False
+    if url is None:
+        return True
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        response = get_session().head(url, timeout=timeout, headers=headers, allow_redirects=True)
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"Could not check {url} ({e}), keeping the local file")
+        return True
+    if response.status_code == 304 or (response.ok and same_version(entry, response.headers)):
+        return True
+    if response.ok:
+        logger.info(f"{os.path.basename(nc_file)} changed on the server, downloading it again")
+        return False
+    logger.warning(f"Could not check {url} (HTTP {response.status_code}), keeping the local file")
+    return True
+
+# Function to download WOA2023 datasets concurrently
+def download_woa23_datasets(save_dir, grids=("01",), params=None, periods=None, workers=4, base_url=None, verify=False,
+                            check_remote=True, on_complete=None):
+    """
+    Download the NetCDF files of the given grids, parameters and periods with `workers` concurrent downloads.
+    Files already in place (per the manifest and, with `check_remote`, unchanged on the server) are skipped;
+    `on_complete(param, period, res, nc_file)` is called in the calling thread as each file is ready, e.g. to hand it
+    to the conversion step. Returns the list of failed files.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    manifest = get_manifest(save_dir)
+    jobs = []
+    for res in grids:
+        for param in (params or list(parameters)):
+            for period in (periods or list(time_periods)):
+                file_name, url = file_url(param, period, res, base_url)
+                jobs.append((param, period, res, url, os.path.abspath(f'{save_dir}/{file_name}')))
+
+    failed = []
+    pending = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_place = executor.map(lambda job: is_data_downloaded(job[4], manifest, verify, job[3] if check_remote else None), jobs)
+        for job, done in zip(jobs, in_place):
+            if done:
+                logger.info(f"Using existing file: {job[4]}")
+                if on_complete is not None:
+                    on_complete(*job[:3], job[4])
+            else:
+                pending.append(job)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor, tqdm(total=len(pending), unit='file', ncols=100) as pbar:
+        futures = {executor.submit(download_data, job[3], job[4], manifest): job for job in pending}
+        for future in as_completed(futures):
+            param, period, res, url, nc_file = futures[future]
+            pbar.update(1)
+            try:
+                future.result()
+                logger.info(f"Downloaded {url}")
+            except Exception as e:
+                logger.error(f"Skipping file {os.path.basename(nc_file)} due to error: {e}")
+                failed.append(nc_file)
+                continue
+            if on_complete is not None:
+                on_complete(param, period, res, nc_file)
+    return failed
 
 if __name__ == '__main__':
-    save_dir = os.path.abspath('./netcdf')
-    download_woa23_datasets(save_dir)
+    setup_file_logging()
+    save_dir = os.path.abspath('tmp_data')  # where dev/zarr_parallel_write_woa23.py reads them
+    download_woa23_datasets(save_dir, grids=["01"], workers=4)  # ["04", "01"] for both grids
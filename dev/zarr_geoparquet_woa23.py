@@ -0,0 +1,175 @@
+import os
+import json
+import shutil
+import logging
+import argparse
+import numpy as np
+import zarr
+import pyarrow as pa
+import pyarrow.parquet as pq
+import dask
+from dask import delayed
+from dask.diagnostics import ProgressBar
+from src.zarr_cache import ZarrDatasetCache
+
+# Export of the WOA23 zarr store to GeoParquet for analytical engines: each grid and subgroup is written under
+# {out_dir}/{grid}/{period}/{params}/time_period={p}/depth={d}/part-0.parquet (Hive partitioning), one row per ocean
+# cell with lon, lat, a cell_key, one float32 column per {parameter}_{variable} (the API column names) and the cell
+# center as a WKB point `geometry` column (GeoParquet metadata, CRS84). Rows are sorted by cell_key, the Hilbert
+# curve index of the cell, so each row group covers a compact lon/lat region and its min/max statistics prune
+# lon/lat predicates. Dask tasks each read one (time period, depth chunk) band of the group, so the export streams
+# chunk by chunk. A subgroup is exported again only if its `_source_version` differs from the zarr group version.
+# Run from the repository root: python -m dev.zarr_geoparquet_woa23
+
+grid_dir = {
+    '01': '1_degree',
+    '04': '025_degree'
+}
+subgroups = [f'{period_group}/{param_group}' for period_group in ['annual', 'monthly', 'seasonal'] for param_group in ['TS', 'Oxy', 'Nutrients']]
+data_variables = ['an', 'mn', 'dd', 'ma', 'sd', 'se', 'oa', 'gp', 'sdo', 'sea']
+ROW_GROUP_ROWS = 8192  # rows per row group: up to 8 per 1-degree and 127 per 0.25-degree depth level
+SOURCE_VERSION_FILE = '_source_version'  # '_' prefixed files are ignored by Hive-style readers
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+def hilbert_key(lat_idx, lon_idx, n_bits):
+    """
+    Hilbert curve index of grid cells on a 2**n_bits square: unlike Z-order the curve has no long jumps, so a run of
+    consecutive keys (a row group) stays a compact region
+    """
+    x = lon_idx.astype(np.int64)
+    y = lat_idx.astype(np.int64)
+    key = np.zeros(len(x), dtype=np.int64)
+    s = 1 << (n_bits - 1)
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        key += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant
+        flip = ~ry & rx
+        x = np.where(flip, s - 1 - x, x)
+        y = np.where(flip, s - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s >>= 1
+    return key.astype(np.uint32)
+
+def wkb_points(lon, lat):
+    """
+    pyarrow binary array of little-endian WKB points, built from one fixed-size numpy buffer
+    """
+    points = np.empty(len(lon), dtype=[('byte_order', 'u1'), ('geom_type', '<u4'), ('x', '<f8'), ('y', '<f8')])
+    points['byte_order'] = 1
+    points['geom_type'] = 1
+    points['x'] = lon
+    points['y'] = lat
+    offsets = np.arange(0, points.itemsize * (len(lon) + 1), points.itemsize, dtype=np.int32)
+    return pa.Array.from_buffers(pa.binary(), len(lon), [None, pa.py_buffer(offsets), pa.py_buffer(points.tobytes())])
+
+def geo_metadata(lon, lat):
+    return json.dumps({
+        'version': '1.1.0',
+        'primary_column': 'geometry',
+        'columns': {'geometry': {
+            'encoding': 'WKB',
+            'geometry_types': ['Point'],
+            'bbox': [float(lon.min()), float(lat.min()), float(lon.max()), float(lat.max())],
+        }},
+    }).encode()
+
+def partition_value(v):
+    return str(int(v)) if float(v).is_integer() else str(float(v))
+
+def export_band(src_path, dst_path, ti, depth_sl, variables, row_group_rows=ROW_GROUP_ROWS):
+    """
+    Write the depth levels in `depth_sl` of time period index `ti`, one Parquet file per level. Returns the rows written.
+    """
+    group = zarr.open_group(src_path, mode='r')
+    lon = group['lon'][:]
+    lat = group['lat'][:]
+    depths = group['depth'][depth_sl]
+    time_period = str(group['time_periods'][ti])
+    params = [str(p) for p in group['parameters'][:]]
+    band = {var: group[var][ti, :, depth_sl] for var in variables}  # (parameters, depth, lat, lon)
+
+    lat_idx, lon_idx = np.meshgrid(np.arange(len(lat)), np.arange(len(lon)), indexing='ij')
+    key = hilbert_key(lat_idx.ravel(), lon_idx.ravel(), int(np.ceil(np.log2(max(len(lat), len(lon))))))
+    order = np.argsort(key, kind='stable')
+    key, cell_lon, cell_lat = key[order], lon[lon_idx.ravel()[order]], lat[lat_idx.ravel()[order]]
+
+    rows = 0
+    for k, depth in enumerate(depths):
+        columns = {f'{param}_{var}': band[var][pi, k].ravel()[order] for var in variables for pi, param in enumerate(params)}
+        valid = np.zeros(len(order), dtype=bool)
+        for values in columns.values():
+            valid |= ~np.isnan(values)
+        if not valid.any():
+            continue
+        table = pa.table({
+            'cell_key': key[valid],
+            'lon': cell_lon[valid],
+            'lat': cell_lat[valid],
+            **{name: pa.array(values[valid], from_pandas=True) for name, values in columns.items()},
+            'geometry': wkb_points(cell_lon[valid], cell_lat[valid]),
+        })
+        table = table.replace_schema_metadata({b'geo': geo_metadata(cell_lon[valid], cell_lat[valid])})
+        part_dir = os.path.join(dst_path, f'time_period={time_period}', f'depth={partition_value(depth)}')
+        os.makedirs(part_dir, exist_ok=True)
+        tmp = os.path.join(part_dir, '.part-0.parquet.tmp')
+        pq.write_table(table, tmp, compression='zstd', row_group_size=row_group_rows, write_statistics=True,
+                       sorting_columns=[pq.SortingColumn(0)])
+        os.replace(tmp, os.path.join(part_dir, 'part-0.parquet'))
+        rows += table.num_rows
+    return rows
+
+def export_group(src_path, dst_path, variables=None, workers=4, row_group_rows=ROW_GROUP_ROWS, force=False):
+    source_version = ZarrDatasetCache.store_version(src_path)
+    marker = os.path.join(dst_path, SOURCE_VERSION_FILE)
+    if not force and os.path.exists(marker):
+        with open(marker, 'r') as f:
+            if f.read().strip() == source_version:
+                logger.info(f"Parquet export {dst_path} is up to date. Skipping.")
+                return 0
+
+    logger.info(f"Exporting {src_path} -> {dst_path}")
+    shutil.rmtree(dst_path, ignore_errors=True)
+    group = zarr.open_group(src_path, mode='r')
+    variables = [var for var in (variables or data_variables) if var in group]
+    depth_chunk = group[variables[0]].chunks[2]
+    n_depth = group['depth'].shape[0]
+    tasks = [delayed(export_band)(src_path, dst_path, ti, slice(d0, min(d0 + depth_chunk, n_depth)), variables, row_group_rows)
+             for ti in range(group['time_periods'].shape[0]) for d0 in range(0, n_depth, depth_chunk)]
+    with ProgressBar():
+        rows = sum(dask.compute(*tasks, num_workers=workers))
+
+    # Written last: a partly written export is never taken as up to date
+    with open(marker, 'w') as f:
+        f.write(source_version)
+    logger.info(f"Parquet export {dst_path} written: {rows} rows.")
+    return rows
+
+def export_store(data_dir, out_dir, res, groups=None, variables=None, workers=4, row_group_rows=ROW_GROUP_ROWS, force=False):
+    for subgroup in (groups or subgroups):
+        src_path = os.path.join(data_dir, grid_dir[res], subgroup)
+        if os.path.isdir(src_path):
+            export_group(src_path, os.path.join(out_dir, grid_dir[res], subgroup), variables, workers, row_group_rows, force)
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the WOA23 zarr store to Hive-partitioned GeoParquet')
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--out-dir', default='data_parquet')
+    parser.add_argument('--grids', default='01,04', help="comma-separated: '01' (1-degree), '04' (0.25-degree)")
+    parser.add_argument('--subgroups', default=None, help="comma-separated, e.g. 'annual/TS,monthly/Oxy' (default: all)")
+    parser.add_argument('--variables', default=None, help="comma-separated, e.g. 'an,mn' (default: all)")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--row-group-rows', type=int, default=ROW_GROUP_ROWS)
+    parser.add_argument('--force', action='store_true', help='export again even if up to date')
+    args = parser.parse_args()
+
+    split = lambda s: [v.strip() for v in s.split(',')] if s else None
+    for res in split(args.grids):
+        export_store(os.path.abspath(args.data_dir), os.path.abspath(args.out_dir), res, split(args.subgroups),
+                     split(args.variables), args.workers, args.row_group_rows, args.force)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import os
+import logging
+import xarray as xr
+import zarr
+from dask.diagnostics import ProgressBar
+from src.zarr_cache import ZarrDatasetCache
+from src.config import PYRAMID_LEVELS
+from src.woa23_mask import mask_path, bottom_index
+from src.woa23_pyramid import pyramid_level_dir
+
+# Build the ocean mask of every WOA23 zarr group (native grids and, if built, their pyramid levels): a (lat, lon)
+# `bottom_index` array with the number of depth levels down to the deepest value of each column (0 on land), stored
+# next to the group as {group}_mask. The API uses it to skip the depth levels below the sea floor of a query box
+# without reading them, and for dropna=true to crop the box to its ocean columns. A mask is used only if its
+# `source_version` attribute matches the version of the source group.
+# Run from the repository root: python -m dev.zarr_ocean_mask_woa23
+
+grid_dir = {
+    '01': '1_degree',
+    '04': '025_degree'
+}
+subgroups = [f'{period_group}/{param_group}' for period_group in ['annual', 'monthly', 'seasonal'] for param_group in ['TS', 'Oxy', 'Nutrients']]
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+def build_mask(src_path):
+    dst_path = mask_path(src_path)
+    source_version = ZarrDatasetCache.store_version(src_path)
+    try:
+        if zarr.open_group(dst_path, mode='r').attrs.get('source_version') == source_version:
+            logger.info(f"Ocean mask of {src_path} is up to date. Skipping.")
+            return False
+    except zarr.errors.GroupNotFoundError:
+        pass
+
+    logger.info(f"Building ocean mask {dst_path}")
+    ds = xr.open_zarr(src_path, consolidated=False)
+    mask = xr.Dataset({'bottom_index': bottom_index(ds)})
+    for var in mask.variables.values():
+        var.encoding.pop('chunks', None)
+        var.encoding.pop('preferred_chunks', None)
+    with ProgressBar():
+        mask.chunk({'lat': -1, 'lon': -1}).to_zarr(dst_path, mode='w', consolidated=False)
+
+    # Written last: a partly written mask is never taken as up to date
+    zarr.open_group(dst_path, mode='a').attrs['source_version'] = source_version
+    n_ocean = int((mask['bottom_index'] > 0).sum())
+    logger.info(f"Ocean mask of {src_path} written: {n_ocean} of {mask['bottom_index'].size} columns hold values.")
+    return True
+
+def build_masks(data_dir, res, pyramid_dir=None):
+    for subgroup in subgroups:
+        src_paths = [os.path.join(data_dir, grid_dir[res], subgroup)]
+        if pyramid_dir is not None:
+            src_paths += [os.path.join(pyramid_dir, grid_dir[res], pyramid_level_dir(grid_size), subgroup) for grid_size in PYRAMID_LEVELS[res]]
+        for src_path in src_paths:
+            if os.path.isdir(src_path):
+                build_mask(src_path)
+
+def main():
+    data_dir = os.path.abspath('data')
+    pyramid_dir = os.path.abspath('data_pyramid')
+    res = '01'  # change this to '01' for 1-degree resolution, '04' for 0.25-degree
+    build_masks(data_dir, res, pyramid_dir)
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,19 @@
 import os
+import json
 import logging
+import threading
+from datetime import datetime, timezone
 import xarray as xr
 import numpy as np
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import dask.array as da
 from dask import delayed
-from dask.diagnostics import ProgressBar
-import dask
 import zarr
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
 from tqdm import tqdm
+from dev.woa23_download_batch import download_woa23_datasets, download_data, is_data_downloaded, get_manifest, file_url, file_sha256
+
+# Ingestion of the WOA23 NetCDF files into the zarr store, then the derived copies of the store.
+# Run from the repository root: python -m dev.zarr_parallel_write_woa23
 
 # Define paths and parameters
 parameters = {
@@ -67,51 +69,104 @@ if not logger.hasHandlers():
     console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levellevel)s - %(message)s'))
     logger.addHandler(console_handler)
 
-completed_datasets = set()
-
-# Function to read completed datasets
-def load_completed_datasets(res):
-    global completed_datasets
-    completed_data_file = f'data_completed_{res}.txt'
-    if os.path.exists(completed_data_file):
-        with open(completed_data_file, 'r') as f:
-            for line in f:
-                parts = line.strip().split(',')
-                completed_datasets.add(f"{parts[0]},{parts[1]},{parts[2]}")
-
-# Function to write a completed dataset entry
-def write_completed_dataset(param, period, grid_res, nc_file):
-    completed_data_file = f'data_completed_{grid_res}.txt'
-    with open(completed_data_file, 'a') as f:
-        f.write(f'{param},{period},{grid_res},{nc_file}\n')
-
-# Function to download data with retry, timeout, and progress logging
-def download_data(url, save_path, retries=3, timeout=300, chunk_size=1024*1024):
-    session = requests.Session()
-    retry = Retry(total=retries, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-
-    try:
-        response = session.get(url, timeout=timeout, stream=True)
-        response.raise_for_status()  # Raise HTTPError for bad responses
-
-        total_size = int(response.headers.get('content-length', 0))
-        downloaded_size = 0
+# HDF5 (NetCDF4) is not thread-safe: NetCDF files are opened and read under this lock, zarr writes run in parallel
+netcdf_lock = threading.Lock()
+
+INGEST_MANIFEST_FILE = 'dev/ingest_manifest.json'  # slab key -> source file, size, mtime, sha256, target group, slab, write time
+LEGACY_COMPLETED_FILES = ['dev/data_completed_01.txt', 'dev/data_completed_04.txt']  # imported once into the manifest
+
+class IngestManifest:
+    """
+    JSON record of the converted slabs, keyed 'param,period,grid': the source NetCDF file (size, mtime, sha256), the
+    zarr group and (parameter, time period) slab it was written to, and when. A slab is converted again only if its
+    source file content changed (sha256; recomputed only when size or mtime differ) or its zarr group is missing.
+    """
+    def __init__(self, path, legacy_files=()):
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+        else:
+            # data_completed_*.txt lines (param,period,grid,file) carry no hash: adopted on their first check
+            for legacy_file in legacy_files:
+                if os.path.exists(legacy_file):
+                    with open(legacy_file, 'r') as f:
+                        for line in f:
+                            parts = line.strip().split(',')
+                            if len(parts) == 4:
+                                self.entries[','.join(parts[:3])] = {'file': parts[3], 'sha256': None}
+
+    @staticmethod
+    def key(param, period, grid_res):
+        return f'{param},{period},{grid_res}'
+
+    def source_state(self, nc_file, entry=None):
+        """
+        (size, mtime_ns, sha256) of a source file, the hash taken from `entry` when size and mtime did not change
+        """
+        st = os.stat(nc_file)
+        entry = entry or {}
+        if entry.get('sha256') and entry.get('size') == st.st_size and entry.get('mtime_ns') == st.st_mtime_ns:
+            return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': entry['sha256']}
+        return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': file_sha256(nc_file).hexdigest()}
+
+    def check(self, param, period, grid_res, nc_file, zarr_group_path):
+        """
+        (is_current, source state) of a slab: current if it was written from this file content into the current
+        zarr group (not one since deleted or initialized again)
+        """
+        key = self.key(param, period, grid_res)
+        with self._lock:
+            entry = dict(self.entries.get(key, {}))
+        state = self.source_state(nc_file, entry)
+        if not entry or not os.path.isdir(zarr_group_path):
+            return False, state
+        if entry.get('group_initialized_at') != group_initialized_at(zarr_group_path):
+            logger.info(f"Zarr group of {key} was initialized again: its slab will be converted again")
+            return False, state
+        if entry.get('sha256') is None:
+            logger.info(f"Adopting legacy completed entry {key} with source hash {state['sha256']}")
+            self.record(param, period, grid_res, nc_file, zarr_group_path, state, written_at=entry.get('written_at'))
+            return True, state
+        if entry['sha256'] != state['sha256']:
+            logger.info(f"Source of {key} changed ({nc_file}): its slab will be converted again")
+            return False, state
+        if (entry.get('size'), entry.get('mtime_ns')) != (state['size'], state['mtime_ns']):
+            self.record(param, period, grid_res, nc_file, zarr_group_path, state, written_at=entry.get('written_at'))
+        return True, state
+
+    def record(self, param, period, grid_res, nc_file, zarr_group_path, state, written_at=None):
+        entry = {
+            'file': nc_file,
+            **state,
+            'group': zarr_group_path,
+            'group_initialized_at': group_initialized_at(zarr_group_path),
+            'slab': {'parameters': parameters[param], 'time_periods': period},
+            'written_at': written_at or datetime.now(timezone.utc).isoformat(),
+        }
+        with self._lock:
+            self.entries[self.key(param, period, grid_res)] = entry
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
 
-        with open(save_path, 'wb') as f, tqdm(total=total_size, unit='B', unit_scale=True, desc=save_path, ncols=100) as pbar:
-            for data in response.iter_content(chunk_size=chunk_size):
-                f.write(data)
-                downloaded_size += len(data)
-                pbar.update(len(data))
+ingest_manifest = None
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to download {url}: {e}")
-        raise
+def group_initialized_at(zarr_group_path):
+    try:
+        return zarr.open_group(zarr_group_path, mode='r').attrs.get('initialized_at')
+    except zarr.errors.GroupNotFoundError:
+        return None
 
+def load_ingest_manifest(path=INGEST_MANIFEST_FILE):
+    global ingest_manifest
+    ingest_manifest = IngestManifest(path, LEGACY_COMPLETED_FILES)
+    return ingest_manifest
 
-# Function to initialize Zarr store with empty data variables
+# Function to initialize Zarr store with empty data variables (metadata only)
 def initialize_zarr_store(zarr_group_path, ds, chunk_sizes):
     try:
         zarr.open_group(zarr_group_path, mode='r')
@@ -119,41 +174,54 @@ def initialize_zarr_store(zarr_group_path, ds, chunk_sizes):
         return
     except zarr.errors.GroupNotFoundError:
         logger.info("Initializing Zarr store...")
-        empty_ds = xr.Dataset(coords=ds.coords)
-        empty_ds.to_zarr(zarr_group_path, mode='w')
+        dims = ('time_periods', 'parameters', 'depth', 'lat', 'lon')
+        data_shape = tuple(len(ds.coords[dim]) for dim in dims)
+        chunks = tuple(chunk_sizes[dim] for dim in dims)
 
-        # Incrementally add each variable to avoid memory exhaustion
+        data_vars = {}
         for var in data_variables:
             if var == 'ma' and '0' in ds.coords['time_periods']:
                 continue
             if var == 'sdo' and ('Nutrients' in zarr_group_path or ('Oxy' in zarr_group_path and not 'annual' in zarr_group_path)):
                 continue
-            data_shape = (
-                len(ds.coords['time_periods']),
-                len(ds.coords['parameters']),
-                len(ds.coords['depth']),
-                len(ds.coords['lat']),
-                len(ds.coords['lon'])
-            )
-            temp_data = np.empty(data_shape, dtype=np.float32)
-            temp_data.fill(np.nan)  # Fill with NaNs to indicate empty data
-            temp_ds = xr.Dataset({var: (('time_periods', 'parameters', 'depth', 'lat', 'lon'), temp_data)}, coords=ds.coords)
-            temp_ds = temp_ds.chunk(chunk_sizes)
-            temp_ds.to_zarr(zarr_group_path, mode='a')
-            del temp_data, temp_ds  # Clear variables to free up memory
+            # Lazy NaN array in a single Dask chunk: never computed, it only gives the variable its shape and dtype
+            data_vars[var] = (dims, da.full(data_shape, np.nan, dtype=np.float32, chunks=data_shape))
+        empty_ds = xr.Dataset(data_vars, coords=ds.coords, attrs={'initialized_at': datetime.now(timezone.utc).isoformat()})
+
+        # compute=False writes the coordinates and the array metadata only, no chunk is written:
+        # chunks never written read as the NaN fill value
+        empty_ds.to_zarr(zarr_group_path, mode='w', compute=False,
+                         encoding={var: {'_FillValue': np.nan, 'chunks': chunks} for var in data_vars})
         logger.info("Zarr store initialized.")
 
-# Function to append a new dataset to the existing Zarr store using Dask
+def slab_region(ds_existing, param_name, period_key):
+    """
+    Region (integer slices per dimension) of one (time_period, parameter) slab of a zarr group, checked to start and
+    end on chunk boundaries so that writes of different slabs never touch the same chunk
+    """
+    ti = ds_existing.indexes['time_periods'].get_loc(period_key)
+    pi = ds_existing.indexes['parameters'].get_loc(param_name)
+    region = {'time_periods': slice(ti, ti + 1), 'parameters': slice(pi, pi + 1)}
+    region.update({dim: slice(0, ds_existing.sizes[dim]) for dim in ['depth', 'lat', 'lon']})
+    for var in ds_existing.data_vars:
+        for dim, chunks in zip(ds_existing[var].dims, ds_existing[var].encoding['chunks']):
+            sl = region[dim]
+            if sl.start % chunks != 0 or (sl.stop % chunks != 0 and sl.stop != ds_existing.sizes[dim]):
+                raise ValueError(f"Slab {region} of {var} is not aligned to its chunks {ds_existing[var].encoding['chunks']}")
+    return region
+
+# Function to write a new dataset into its own slab of the existing Zarr store using Dask
 @delayed
-def append_to_zarr_store(zarr_group_path, nc_file, param_key, period_key, grid_res):
+def append_to_zarr_store(zarr_group_path, nc_file, param_key, period_key, grid_res, source_state=None):
     try:
         logger.info(f"Appending {param_key} for period {period_key} from {nc_file}...")
 
-        # Open the existing Zarr store
+        # Open the existing Zarr store (metadata only: coordinates, chunks)
         ds_existing = xr.open_zarr(zarr_group_path, consolidated=False)
         
         # Load the new dataset from NetCDF with decode_times=False
-        ds_new = xr.open_dataset(nc_file, decode_times=False)
+        with netcdf_lock:
+            ds_new = xr.open_dataset(nc_file, decode_times=False)
 
         # Drop unused variables if they exist
         ds_new = ds_new.drop_vars(['crs', 'lat_bnds', 'lon_bnds', 'depth_bnds', 'climatology_bounds'], errors='ignore')
@@ -170,43 +238,44 @@ def append_to_zarr_store(zarr_group_path, nc_file, param_key, period_key, grid_r
 
         # Extract the parameter name
         param_name = parameters[param_key]
+        region = slab_region(ds_existing, param_name, period_key)
 
-        # Ensure the new dataset has the correct coordinates and dimensions
-        ds_new = ds_new.expand_dims({'parameters': [param_name], 'time_periods': [period_key]})
-
+        # Only this file's (time_period, parameter) slab is written, one depth chunk band at a time, in regions
+        # aligned to the store's chunks: the rest of the group is neither read nor rewritten, and tasks writing
+        # other slabs run in parallel. Values are written by position (the store's coordinates are kept).
+        variables = []
         for var in ds_new.data_vars:
-            # Extract the relevant data for the region update
-            new_data = ds_new[var].data.squeeze()
-            
-            # Create a temporary DataArray with the correct dimensions
-            temp_da = xr.DataArray(
-                new_data,
-                dims=['depth', 'lat', 'lon'],
-                coords={
-                    'depth': ds_existing.depth,
-                    'lat': ds_existing.lat,
-                    'lon': ds_existing.lon
-                }
-            )
-            
-            # Update the existing dataset with the new data in the specified region
-            ds_existing[var].loc[dict(parameters=param_name, time_periods=period_key)] = temp_da
-
-        # Write the updated data to the Zarr store without re-writing the coordinates
-        ds_existing.chunk(chunk_sizes).to_zarr(zarr_group_path, mode='a')
+            if var not in ds_existing.data_vars:
+                logger.warning(f"{var} of {nc_file} has no variable in {zarr_group_path}. Skipping.")
+                continue
+            if tuple(ds_new[var].sizes[dim] for dim in ['depth', 'lat', 'lon']) != tuple(ds_existing.sizes[dim] for dim in ['depth', 'lat', 'lon']):
+                raise ValueError(f"{var} of {nc_file} does not have the depth/lat/lon shape of {zarr_group_path}")
+            variables.append(var)
+
+        n_depth = ds_existing.sizes['depth']
+        depth_chunk = ds_existing[variables[0]].encoding['chunks'][2]
+        for d0 in range(0, n_depth, depth_chunk):
+            depth_sl = slice(d0, min(d0 + depth_chunk, n_depth))
+            with netcdf_lock:
+                band = xr.Dataset({
+                    var: (('time_periods', 'parameters', 'depth', 'lat', 'lon'),
+                          ds_new[var].isel(depth=depth_sl).transpose('depth', 'lat', 'lon').values[None, None])
+                    for var in variables
+                })
+            # all-NaN chunks (land, below the sea floor) are not stored (and removed if stored before)
+            band.to_zarr(zarr_group_path, region={**region, 'depth': depth_sl}, consolidated=False, write_empty_chunks=False)
+        with netcdf_lock:
+            ds_new.close()
         logger.info(f"Successfully appended {param_key} for period {period_key}.")
 
-        # Log the completion of this dataset
-        write_completed_dataset(param_key, period_key, grid_res, nc_file)
+        # Record the source of this slab
+        if source_state is not None:
+            ingest_manifest.record(param_key, period_key, grid_res, nc_file, zarr_group_path, source_state)
 
     except Exception as e:
         logger.error(f"Error appending {param_key} for period {period_key}: {e}")
         raise
 
-# Function to check if a dataset has been completed
-def is_data_completed(param, period, grid_res):
-    return f'{param},{period},{grid_res}' in completed_datasets
-
 # Function to determine the subgroup based on parameter and period
 def determine_subgroup(param, period):
     param_name = parameters[param]
@@ -229,25 +298,26 @@ def determine_subgroup(param, period):
 
 # Top-level function for parallel processing
 def download_and_process(param, period, save_dir, data_dir, res, chunk_sizes):
-    if is_data_completed(param, period, res):
-        logger.info(f"Skipping already completed dataset: {param} {period} {res}")
-        return
-
-    span = 'decav' if param in ['t', 's'] else 'all'
-    base_url = "https://www.ncei.noaa.gov/data/oceans/woa/WOA23/DATA" if param in ['t', 's'] else "https://www.ncei.noaa.gov/thredds-ocean/fileServer/woa23/DATA"
-    padded_period = period.zfill(2)
-    file_name = f'woa23_{span}_{param}{padded_period}_{res}.nc'
-    url = f'{base_url}/{parameters[param]}/netcdf/{span}/{grid_resolutions[res]}/{file_name}'
+    file_name, url = file_url(param, period, res)
     nc_file = os.path.abspath(f'{save_dir}/{file_name}')
 
-    if not os.path.exists(nc_file):
+    # normally already downloaded by download_woa23_datasets; otherwise resumed and verified the same way
+    manifest = get_manifest(save_dir)
+    if not is_data_downloaded(nc_file, manifest):
         logger.info(f"Downloading file: {nc_file}")
-        download_data(url, nc_file)
+        download_data(url, nc_file, manifest)
     else:
         logger.info(f"Using existing file: {nc_file}")
 
     subgroup = determine_subgroup(param, period)
     zarr_group_path = os.path.abspath(f'{data_dir}/{grid_dir[res]}/{subgroup}')
+
+    if ingest_manifest is None:
+        load_ingest_manifest()
+    is_current, source_state = ingest_manifest.check(param, period, res, nc_file, zarr_group_path)
+    if is_current:
+        logger.info(f"Skipping already completed dataset: {param} {period} {res}")
+        return
     
     lon = np.arange(-179.875, 180, 0.25, dtype=np.float32) if res == '04' else np.arange(-179.5, 180, 1.0, dtype=np.float32)
     lat = np.arange(-89.875, 90, 0.25, dtype=np.float32) if res == '04' else np.arange(-89.5, 90, 1.0, dtype=np.float32)
@@ -283,29 +353,49 @@ def download_and_process(param, period, save_dir, data_dir, res, chunk_sizes):
     )
     
     initialize_zarr_store(zarr_group_path, ds_initial, chunk_sizes)
-    return append_to_zarr_store(zarr_group_path, nc_file, param, period, res)
+    return append_to_zarr_store(zarr_group_path, nc_file, param, period, res, source_state)
 
-# Main processing function
-def process_subgroup(save_dir, data_dir, res):
+# Main processing function: files are downloaded concurrently (resumed and verified against the download manifest)
+# and each one is handed to the conversion pool as soon as it is complete
+def process_subgroup(save_dir, data_dir, res, download_workers=4, convert_workers=4):
     params = ['t', 's', 'o', 'O', 'A', 'i', 'p', 'n']
     periods = list(time_periods) # ['0', '1', '2', '3', '4', '5', '6', '7', '13', '14', '15', '16']  # Example for trials
 
-    delayed_tasks = []
-    for param in params:
-        for period in periods:
-            delayed_tasks.append(download_and_process(param, period, save_dir, data_dir, res, chunk_sizes))
+    with ThreadPoolExecutor(max_workers=convert_workers) as converter:
+        futures = []
+
+        def convert(param, period, grid_res, nc_file):
+            # zarr groups are initialized here, in the calling thread; the slab writes run in the pool
+            task = download_and_process(param, period, save_dir, data_dir, grid_res, chunk_sizes)
+            if task is not None:
+                futures.append(converter.submit(task.compute, scheduler='sync'))
 
-    with ProgressBar():
-        dask.compute(*delayed_tasks, num_workers=4)
+        failed = download_woa23_datasets(save_dir, [res], params, periods, download_workers, on_complete=convert)
+        for future in tqdm(as_completed(futures), total=len(futures), desc='converting', ncols=100):
+            future.result()
+    if failed:
+        logger.error(f"{len(failed)} files failed to download and were not converted: {failed}")
 
 # Create the initial empty Zarr store
 def main():
-    data_dir = os.path.abspath('../data')
-    save_dir = os.path.abspath('../tmp_data')
+    data_dir = os.path.abspath('data')
+    save_dir = os.path.abspath('tmp_data')
     res = '01'  # change this to '01' for 1-degree resolution, '04' for 0.25-degree
 
-    load_completed_datasets(res)
+    load_ingest_manifest()
     process_subgroup(save_dir, data_dir, res)
 
+    # Rechunk step: profile-oriented copy of every subgroup (read by the API for profiles and narrow boxes)
+    from dev.zarr_rechunk_profile_woa23 import rechunk_store
+    rechunk_store(data_dir, os.path.abspath('data_profile'), res)
+
+    # Pyramid step: coarsened overview levels (served for map-scale queries with resolution=auto/max_cells)
+    from dev.zarr_pyramid_woa23 import build_pyramid
+    build_pyramid(data_dir, os.path.abspath('data_pyramid'), res)
+
+    # Ocean masks (bottom level index per column) of the groups and their pyramid levels
+    from dev.zarr_ocean_mask_woa23 import build_masks
+    build_masks(data_dir, res, os.path.abspath('data_pyramid'))
+
 if __name__ == '__main__':
     main()
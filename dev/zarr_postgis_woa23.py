@@ -0,0 +1,295 @@
+import os
+import struct
+import logging
+import threading
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import zarr
+import psycopg2
+from tqdm import tqdm
+
+# Bulk loader of the WOA23 zarr groups into PostGIS tables (replaces the row-by-row inserts of zarr2postgis.ipynb).
+# Each task reads one zarr depth chunk (the loaded parameters, all its depths) of a time period; the rows of each
+# (time period, depth) slab (lon, lat, depth, time_period, one column per parameter, and the grid cell polygon as EWKB)
+# are encoded with numpy directly in the PostgreSQL binary COPY format, rows with all parameters NaN dropped, and
+# streamed with COPY FROM STDIN on several connections. Each slab is one transaction that also records it in the
+# {table}_slabs progress table, so an interrupted load resumes with the slabs not yet recorded (empty ones included).
+# Run from the repository root: python -m dev.zarr_postgis_woa23
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+grid_db = {'01': 'grd1', '04': 'grd025'}  # Two gridded resolutions data: 1-degree and 0.25-degree in WOA23
+grid_dir = {'01': '1_degree', '04': '025_degree'}
+grid_step = {'01': 1.0, '04': 0.25}
+group_parameters = {
+    'TS': ['temperature', 'salinity'],
+    'Oxy': ['oxygen', 'o2sat', 'AOU'],
+    'Nutrients': ['silicate', 'phosphate', 'nitrate']
+}
+
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)  # signature, flags, header extension length
+COPY_TRAILER = struct.pack('>h', -1)
+SRID = 4326
+EWKB_POLYGON = 3 | 0x20000000  # polygon with SRID flag
+EWKB_POLYGON_SIZE = 1 + 4 * 4 + 5 * 2 * 8  # byte order, type, srid, rings, points, 5 (x, y) of the closed ring
+
+def connect_db(settings):
+    return psycopg2.connect(**settings)
+
+def create_table(conn, table_name, parameter_set):
+    with conn.cursor() as cur:
+        columns = ", ".join([f"{param} FLOAT" for param in parameter_set])
+        cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            lon FLOAT,
+            lat FLOAT,
+            depth INTEGER,
+            time_period INTEGER,
+            {columns},
+            geom GEOMETRY
+        );
+        CREATE TABLE IF NOT EXISTS {table_name}_slabs (
+            time_period INTEGER,
+            depth INTEGER,
+            n_rows BIGINT,
+            PRIMARY KEY (time_period, depth)
+        );
+        """)
+    conn.commit()
+
+# Indexes are built once after the load, faster than maintaining them row by row during COPY
+def create_indexes(conn, table_name, geom_index=True):
+    with conn.cursor() as cur:
+        if geom_index:
+            cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_geom ON {table_name} USING GIST (geom);")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_depth ON {table_name} (depth);")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_time_period ON {table_name} (time_period);")
+    conn.commit()
+
+def row_dtype(parameter_set, present):
+    """
+    numpy structured dtype of one binary COPY row in which the parameters flagged in `present` have a value
+    (a NULL field is its length -1 only). Integers and floats are big-endian, the EWKB polygon little-endian.
+    """
+    fields = [('n_fields', '>i2'),
+              ('lon_len', '>i4'), ('lon', '>f8'),
+              ('lat_len', '>i4'), ('lat', '>f8'),
+              ('depth_len', '>i4'), ('depth', '>i4'),
+              ('time_period_len', '>i4'), ('time_period', '>i4')]
+    for param, has_value in zip(parameter_set, present):
+        fields.append((f'{param}_len', '>i4'))
+        if has_value:
+            fields.append((param, '>f8'))
+    fields += [('geom_len', '>i4'), ('byte_order', 'u1'), ('geom_type', '<u4'), ('srid', '<u4'),
+               ('n_rings', '<u4'), ('n_points', '<u4'), ('ring', '<f8', (5, 2))]
+    return np.dtype(fields)
+
+def encode_rows(lon, lat, depth, time_period, values, parameter_set, step):
+    """
+    Binary COPY rows of the cells at (lon, lat), 1-D arrays, with `values` (parameter, cell) and NaN as NULL.
+    Cells with all parameters NaN are dropped. Rows are grouped by their pattern of NULLs, each group encoded as
+    one fixed-size structured array.
+    """
+    valid = ~np.isnan(values)
+    pattern = (valid * (1 << np.arange(len(parameter_set)))[:, None]).sum(axis=0)
+    pieces = []
+    for code in np.unique(pattern):
+        if code == 0:
+            continue
+        idx = np.nonzero(pattern == code)[0]
+        present = [bool((code >> k) & 1) for k in range(len(parameter_set))]
+        rows = np.empty(len(idx), dtype=row_dtype(parameter_set, present))
+        rows['n_fields'] = 5 + len(parameter_set)
+        rows['lon_len'] = rows['lat_len'] = 8
+        rows['depth_len'] = rows['time_period_len'] = 4
+        rows['lon'] = lon[idx]
+        rows['lat'] = lat[idx]
+        rows['depth'] = depth
+        rows['time_period'] = time_period
+        for k, (param, has_value) in enumerate(zip(parameter_set, present)):
+            rows[f'{param}_len'] = 8 if has_value else -1
+            if has_value:
+                rows[param] = values[k, idx]
+        rows['geom_len'] = EWKB_POLYGON_SIZE
+        rows['byte_order'] = 1
+        rows['geom_type'] = EWKB_POLYGON
+        rows['srid'] = SRID
+        rows['n_rings'] = 1
+        rows['n_points'] = 5
+        lon_min, lon_max = lon[idx] - step / 2, lon[idx] + step / 2
+        lat_min, lat_max = lat[idx] - step / 2, lat[idx] + step / 2
+        ring = rows['ring']
+        ring[:, [0, 1, 4], 0] = lon_min[:, None]
+        ring[:, [2, 3], 0] = lon_max[:, None]
+        ring[:, [0, 3, 4], 1] = lat_min[:, None]
+        ring[:, [1, 2], 1] = lat_max[:, None]
+        pieces.append(rows.tobytes())
+    return pieces
+
+class CopyStream:
+    """
+    File-like object over an iterator of byte pieces, read by cursor.copy_expert without joining the pieces
+    """
+    def __init__(self, pieces):
+        self._pieces = iter(pieces)
+        self._piece = memoryview(b'')
+        self._offset = 0
+
+    def read(self, size=-1):
+        while self._offset >= len(self._piece):
+            try:
+                self._piece, self._offset = memoryview(next(self._pieces)), 0
+            except StopIteration:
+                return b''
+        end = len(self._piece) if size is None or size < 0 else self._offset + size
+        data = self._piece[self._offset:end]
+        self._offset += len(data)
+        return data.tobytes()
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+def read_depth_band(group, variable, ti, d0, d1, p_idx):
+    """
+    Values of the parameters `p_idx` at time period `ti` and depths d0:d1, (parameters, depth, lat, lon): reading a
+    whole zarr depth chunk at once decompresses each chunk once (and only those of the loaded parameters)
+    """
+    return group[variable].get_orthogonal_selection((ti, p_idx, slice(d0, d1)))
+
+def slab_pieces(slab, lon, lat, depth, time_period, parameter_set, step, lat_band=90):
+    """
+    Encoded rows of one (time period, depth) slab, (parameters, lat, lon), in bands of `lat_band` latitudes
+    """
+    for y0 in range(0, len(lat), lat_band):
+        values = slab[:, y0:y0 + lat_band].reshape(len(parameter_set), -1)
+        n_lat = values.shape[1] // len(lon)
+        cell_lon = np.tile(lon, n_lat)
+        cell_lat = np.repeat(lat[y0:y0 + n_lat], len(lon))
+        yield from encode_rows(cell_lon, cell_lat, depth, time_period, values, parameter_set, step)
+
+def loaded_slabs(conn, table_name):
+    """
+    (time_period, depth) of the slabs recorded as loaded; for a table loaded before the progress table existed, the
+    slabs that have rows
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT time_period, depth FROM {table_name}_slabs;")
+        done = set(cur.fetchall())
+        if not done:
+            cur.execute(f"SELECT DISTINCT time_period, depth FROM {table_name};")
+            done = set(cur.fetchall())
+    conn.commit()
+    return done
+
+def load_group(zarr_group_path, table_name, parameter_set, res, db_settings, variable='mn', workers=4, resume=True, geom_index=True):
+    """
+    Load one zarr group into `table_name` with `workers` connections, one zarr depth chunk per task and one
+    (time period, depth) slab per COPY and transaction. With `resume`, slabs already recorded are skipped.
+    Returns the number of rows written.
+    """
+    group = zarr.open_group(zarr_group_path, mode='r')
+    group_params = [str(p) for p in group['parameters'][:]]
+    p_idx = [group_params.index(param) for param in parameter_set]
+    times = [int(t) for t in group['time_periods'][:]]
+    depths = [int(d) for d in group['depth'][:]]
+    lon = group['lon'][:].astype(np.float64)
+    lat = group['lat'][:].astype(np.float64)
+    depth_chunk = group[variable].chunks[2]
+
+    conn = connect_db(db_settings)
+    create_table(conn, table_name, parameter_set)
+    done = loaded_slabs(conn, table_name) if resume else set()
+    conn.close()
+    # (time period, depth chunk start, stop, depths of the chunk not loaded yet)
+    units = []
+    for ti in range(len(times)):
+        for d0 in range(0, len(depths), depth_chunk):
+            d1 = min(d0 + depth_chunk, len(depths))
+            todo = [di for di in range(d0, d1) if (times[ti], depths[di]) not in done]
+            if todo:
+                units.append((ti, d0, d1, todo))
+    n_slabs = sum(len(todo) for *_, todo in units)
+    logger.info(f"Loading {zarr_group_path} into {table_name}: {n_slabs} slabs ({len(done)} already loaded)")
+
+    columns = ['lon', 'lat', 'depth', 'time_period', *parameter_set, 'geom']
+    copy_sql = f"COPY {table_name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT binary)"
+    progress_sql = f"INSERT INTO {table_name}_slabs (time_period, depth, n_rows) VALUES (%s, %s, %s)"
+    local = threading.local()
+    connections = []
+    connections_lock = threading.Lock()
+
+    def load_band(ti, d0, d1, todo):
+        if not hasattr(local, 'conn'):
+            local.conn = connect_db(db_settings)
+            with connections_lock:
+                connections.append(local.conn)
+        band = read_depth_band(group, variable, ti, d0, d1, p_idx)
+        rows = 0
+        for di in todo:
+            pieces = slab_pieces(band[:, di - d0], lon, lat, depths[di], times[ti], parameter_set, grid_step[res])
+            try:
+                with local.conn.cursor() as cur:
+                    cur.copy_expert(copy_sql, CopyStream(chain([COPY_HEADER], pieces, [COPY_TRAILER])), size=1024*1024)
+                    slab_rows = cur.rowcount
+                    cur.execute(progress_sql, (times[ti], depths[di], slab_rows))
+                local.conn.commit()
+            except Exception:
+                local.conn.rollback()
+                raise
+            rows += slab_rows
+        return rows
+
+    total_rows = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(load_band, *unit): unit for unit in units}
+            for future in tqdm(as_completed(futures), total=len(futures), desc=table_name, ncols=100):
+                ti, d0, d1, _ = futures[future]
+                try:
+                    total_rows += future.result()
+                except Exception as e:
+                    logger.error(f"Error loading time_period={times[ti]}, depths {depths[d0]}-{depths[d1 - 1]} into {table_name}: {e}")
+                    raise
+    finally:
+        for c in connections:
+            c.close()
+
+    conn = connect_db(db_settings)
+    create_indexes(conn, table_name, geom_index)
+    conn.close()
+    logger.info(f"Loaded {total_rows} rows into {table_name}")
+    return total_rows
+
+def main():
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+    db_settings = {
+        'dbname': os.getenv('DBNAME'),
+        'user': os.getenv('DBUSER'),
+        'password': os.getenv('DBPASS'),
+        'host': os.getenv('DBHOST'),
+        'port': os.getenv('DBPORT'),
+        'options': "-c statement_timeout=0",
+        'keepalives': 1,
+        'keepalives_idle': 30,
+        'keepalives_interval': 10,
+        'keepalives_count': 5
+    }
+    grids = [g.strip() for g in str(os.getenv('GRIDSET', '01')).split(',')]
+    time_periods = [p.strip() for p in str(os.getenv('TIMESET', 'annual')).split(',')]
+    pars = [c.strip() for c in str(os.getenv('PARAMSET', 'TS')).split(',')]
+
+    for res in grids:
+        for time_period in time_periods:
+            for par in pars:
+                zarr_store_path = os.path.abspath(f"data/{grid_dir[res]}/{time_period}/{par}")
+                table_name = f"{grid_db[res]}_{time_period}_{par}"
+                load_group(zarr_store_path, table_name, group_parameters[par], res, db_settings, workers=4)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import os
+import logging
+import xarray as xr
+import zarr
+from dask.diagnostics import ProgressBar
+from src.zarr_cache import ZarrDatasetCache
+from src.config import PYRAMID_LEVELS, PYRAMID_CHUNK_SIZES
+from src.woa23_pyramid import pyramid_level_dir, coarsen_factor, coarsen_mean
+
+# Build the coarsened overview levels (pyramid) of the WOA23 zarr store: for each native group, copies at
+# PYRAMID_LEVELS grid sizes holding the NaN-aware, area-weighted mean of the native cells, under
+# data_pyramid/{grid}/{level}/{period}/{params} (e.g. data_pyramid/025_degree/2_degree/annual/TS).
+# Each level is coarsened directly from the native group. The API serves a level for resolution=auto/max_cells
+# (or an explicit resolution) only if its `source_version` attribute matches the version of the source group.
+# Run from the repository root: python -m dev.zarr_pyramid_woa23
+
+grid_dir = {
+    '01': '1_degree',
+    '04': '025_degree'
+}
+grid_sizes = {'01': 1.0, '04': 0.25}
+subgroups = [f'{period_group}/{param_group}' for period_group in ['annual', 'monthly', 'seasonal'] for param_group in ['TS', 'Oxy', 'Nutrients']]
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+def coarsen_group(src_path, dst_path, factor, chunk_sizes=PYRAMID_CHUNK_SIZES):
+    source_version = ZarrDatasetCache.store_version(src_path)
+    try:
+        if zarr.open_group(dst_path, mode='r').attrs.get('source_version') == source_version:
+            logger.info(f"Pyramid level {dst_path} is up to date. Skipping.")
+            return False
+    except zarr.errors.GroupNotFoundError:
+        pass
+
+    logger.info(f"Coarsening {src_path} -> {dst_path} by {factor}x{factor} cells")
+    ds = xr.open_zarr(src_path, consolidated=False)
+    # source chunks aligned to the coarsening factor, so each coarse cell is reduced within one chunk
+    ds = ds.chunk({'lat': factor * max(1, chunk_sizes['lat'] // factor), 'lon': factor * max(1, chunk_sizes['lon'] // factor)})
+    coarse = coarsen_mean(ds, factor)
+    for var in coarse.variables.values():
+        var.encoding.pop('chunks', None)
+        var.encoding.pop('preferred_chunks', None)
+    with ProgressBar():
+        coarse.chunk(chunk_sizes).to_zarr(dst_path, mode='w', consolidated=False)
+
+    # Written last: a partly written level is never taken as up to date
+    zarr.open_group(dst_path, mode='a').attrs['source_version'] = source_version
+    logger.info(f"Pyramid level {dst_path} written (source version {source_version}).")
+    return True
+
+def build_pyramid(data_dir, pyramid_dir, res, levels=None):
+    for subgroup in subgroups:
+        src_path = os.path.join(data_dir, grid_dir[res], subgroup)
+        if not os.path.isdir(src_path):
+            continue
+        for grid_size in (levels or PYRAMID_LEVELS[res]):
+            factor = coarsen_factor(grid_sizes[res], grid_size)
+            coarsen_group(src_path, os.path.join(pyramid_dir, grid_dir[res], pyramid_level_dir(grid_size), subgroup), factor)
+
+def main():
+    data_dir = os.path.abspath('data')
+    pyramid_dir = os.path.abspath('data_pyramid')
+    res = '01'  # change this to '01' for 1-degree resolution, '04' for 0.25-degree
+    build_pyramid(data_dir, pyramid_dir, res)
+
+if __name__ == '__main__':
+    main()
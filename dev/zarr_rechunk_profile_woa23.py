@@ -0,0 +1,61 @@
+import os
+import logging
+import xarray as xr
+import zarr
+from dask.diagnostics import ProgressBar
+from src.zarr_cache import ZarrDatasetCache
+from src.config import PROFILE_CHUNK_SIZES
+
+# Build the profile-layout copy of the WOA23 zarr store: same groups, variables and coordinates,
+# but all depth levels of small lat/lon tiles in one chunk, so a station profile decompresses one chunk
+# instead of every depth chunk of a 90x360 map tile. The API reads it for profiles and narrow boxes
+# (PROFILE_LAYOUT_MAX_CELLS) only if its `source_version` attribute matches the version of the source group.
+# Run from the repository root: python -m dev.zarr_rechunk_profile_woa23
+
+grid_dir = {
+    '01': '1_degree',
+    '04': '025_degree'
+}
+subgroups = [f'{period_group}/{param_group}' for period_group in ['annual', 'monthly', 'seasonal'] for param_group in ['TS', 'Oxy', 'Nutrients']]
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger()
+
+def rechunk_group(src_path, dst_path, chunk_sizes=PROFILE_CHUNK_SIZES):
+    source_version = ZarrDatasetCache.store_version(src_path)
+    try:
+        if zarr.open_group(dst_path, mode='r').attrs.get('source_version') == source_version:
+            logger.info(f"Profile layout of {src_path} is up to date. Skipping.")
+            return False
+    except zarr.errors.GroupNotFoundError:
+        pass
+
+    logger.info(f"Rechunking {src_path} -> {dst_path} with chunks {chunk_sizes}")
+    ds = xr.open_zarr(src_path, consolidated=False)
+    for var in ds.variables.values():
+        # drop the source chunk encoding, otherwise to_zarr keeps the map-oriented chunks
+        var.encoding.pop('chunks', None)
+        var.encoding.pop('preferred_chunks', None)
+    with ProgressBar():
+        ds.chunk(chunk_sizes).to_zarr(dst_path, mode='w', consolidated=False)
+
+    # Written last: a partly written copy is never taken as up to date
+    zarr.open_group(dst_path, mode='a').attrs['source_version'] = source_version
+    logger.info(f"Profile layout of {src_path} written (source version {source_version}).")
+    return True
+
+def rechunk_store(data_dir, profile_dir, res):
+    for subgroup in subgroups:
+        src_path = os.path.join(data_dir, grid_dir[res], subgroup)
+        if not os.path.isdir(src_path):
+            continue
+        rechunk_group(src_path, os.path.join(profile_dir, grid_dir[res], subgroup))
+
+def main():
+    data_dir = os.path.abspath('data')
+    profile_dir = os.path.abspath('data_profile')
+    res = '01'  # change this to '01' for 1-degree resolution, '04' for 0.25-degree
+    rechunk_store(data_dir, profile_dir, res)
+
+if __name__ == '__main__':
+    main()
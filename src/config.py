@@ -5,3 +5,31 @@ LON_RANGE_LIMIT = None
 LAT_RANGE_LIMIT = None
 AREA_LIMIT = None
 pars = None
+ZARR_CACHE_SIZE = 48 # max number of opened zarr groups kept per worker
+ZARR_CACHE_CHECK_INTERVAL = 5 # seconds between checks whether a cached zarr group changed on disk
+FAST_PATH_MAX_CELLS = 400 # lon x lat cells up to which a query is served by direct zarr index reads
+QUERY_MAX_WORKERS = 4 # queries executed concurrently (off the event loop) per worker
+QUERY_MAX_QUEUE = 32 # queries allowed to wait for a free query worker before answering 503
+STREAM_BATCH_ROWS = 200000 # max rows per streamed slab batch (at least one time_period x depth level)
+RESPONSE_CACHE_BYTES = 256 * 1024**2 # memory budget of the per-worker response cache
+RESPONSE_CACHE_MAX_ENTRY = 32 * 1024**2 # larger responses are not cached
+QUERY_MAX_CHUNKS = 200000 # zarr chunks a single query may touch (413 above); LON/LAT_RANGE_LIMIT, AREA_LIMIT in degrees if set
+QUERY_MAX_BYTES = 4 * 1024**3 # estimated output bytes (float32 values) of a single streamed query (413 above)
+QUERY_JSON_MAX_BYTES = 64 * 1024**2 # same for JSON, which is built in memory; larger queries are pointed to streamed formats
+QUERY_INFLIGHT_BYTES = 8 * 1024**3 # estimated output bytes of all queries in flight per worker (429 above)
+EXPORT_RESULTS_DIR = "tmp/woa23_jobs" # export job directories (result files), shared by all API workers and the Dask worker
+EXPORT_BATCH_ROWS = 2000000 # max rows per part file of a CSV/Parquet export job (parts are written in parallel)
+EXPORT_MAX_BYTES = 64 * 1024**3 # estimated output bytes (float32 values) of a single export job (413 above)
+EXPORT_JOB_TTL = 86400 # seconds after which export job directories are removed
+EXPORT_JOB_STALL_TIMEOUT = 3600 # seconds without any file written in its directory after which a running export job is reported failed
+PROFILE_LAYOUT_MAX_CELLS = 400 # lon x lat cells up to which a query reads the profile-layout copy (when built and up to date)
+PROFILE_CHUNK_SIZES = {'time_periods': 1, 'parameters': 1, 'depth': -1, 'lat': 10, 'lon': 10} # profile layout: all depths in one chunk
+POINTS_MAX_POINTS = 10000 # stations per /api/woa23/points request
+MATCHUP_MAX_ROWS = 2000000 # observations per /api/woa23/matchup upload
+SECTION_MAX_SAMPLES = 5000 # samples along the path of one /api/woa23/section request
+DERIVED_CACHE_BYTES = 128 * 1024**2 # memory budget of the per-worker cache of derived (density, sigma0) slabs
+PYRAMID_LEVELS = {'01': [2.0, 5.0], '04': [0.5, 1.0, 2.0, 5.0]} # coarsened overview levels (grid size in degrees) per native grid
+PYRAMID_CHUNK_SIZES = {'time_periods': 1, 'parameters': 1, 'depth': 8, 'lat': 90, 'lon': 360} # map chunks of the pyramid levels (capped at the level size)
+PYRAMID_AUTO_MAX_CELLS = 100000 # lon x lat cells per depth level served by resolution=auto when max_cells is not given
+QUERY_BACKEND = 'auto' # zarr | columnar (the GeoParquet export in data_parquet/ when up to date) | auto: columnar when cheaper by COLUMNAR_COST_FACTOR
+COLUMNAR_COST_FACTOR = 4 # auto: the export serves a selection when it decodes this many times fewer values than the zarr chunks touched
@@ -0,0 +1,269 @@
+import os
+import re
+import json
+import time
+import shutil
+import uuid
+from functools import partial
+import dask
+import numpy as np
+import zarr
+import xarray as xr
+import pyarrow.parquet as pq
+from dask.distributed import fire_and_forget
+from src.woa23_query import read_selection_block, assemble_wide, finalize_columns, result_columns, iter_slab_batches
+from src.woa23_derived import derived_parameters, derivable_vars, derive_block, compute_derived
+from src.woa23_utils import depth_to_pressure
+
+# format -> (media type, file extension)
+export_formats = {
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'netcdf': ('application/x-netcdf', 'nc'),
+}
+
+_job_id_pattern = re.compile(r'^[0-9a-f]{32}$')
+
+# The functions below run as tasks on the Dask workers (which need `src` importable, see setup.py).
+# All job state is kept as files in the job directory, so any API worker process can report on any job.
+
+def _write_json(path: str, data: dict):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+def _write_error(job_dir: str, err: Exception):
+    _write_json(os.path.join(job_dir, 'error.json'), {'error': f"{type(err).__name__}: {err}", 'time': time.time()})
+
+def part_path(job_dir: str, index: int, fmt: str) -> str:
+    return os.path.join(job_dir, f"part-{index:05d}.{export_formats[fmt][1]}")
+
+def write_export_part(job_dir: str, index: int, plan, parts: list, columns: list, fmt: str) -> str:
+    """
+    Read one batch of (time_period, depth) slabs and write it as a CSV/Parquet part file
+    """
+    try:
+        blocks = []
+        for sel, tp_pos, depth_pos in parts:
+            if sel.direct_readable:
+                group = zarr.open_group(sel.read_path, mode='r')
+                block = read_selection_block(sel, tp_pos, depth_pos, zarr_arrays={var: group[var] for var in sel.variables})
+            else:
+                # chunks=None: lazily indexed numpy arrays, no nested Dask graph inside this task
+                block = read_selection_block(sel, tp_pos, depth_pos, ds=xr.open_zarr(sel.read_path, chunks=None))
+            if (sel.derived or sel.hidden) and not block.is_empty():
+                derive_block(block, sel.derived, sel.hidden, block.lats[:, None])
+            blocks.append(block)
+        df = finalize_columns(assemble_wide(blocks, plan.variables, columns, plan.dropna), plan)
+
+        path = part_path(job_dir, index, fmt)
+        tmp = f"{path}.tmp"
+        if fmt == 'csv':
+            df.write_csv(tmp, include_header=index == 0)
+        else:
+            df.write_parquet(tmp, compression='zstd')
+        os.replace(tmp, path)
+        return path
+    except Exception as e:
+        _write_error(job_dir, e)
+        raise
+
+def combine_export_parts(job_dir: str, part_paths: list, fmt: str, file_name: str, *parts_written) -> str:
+    """
+    Concatenate the part files (in order) into the result file, then mark the job finished
+    """
+    try:
+        out_path = os.path.join(job_dir, file_name)
+        tmp = f"{out_path}.tmp"
+        if fmt == 'csv':
+            with open(tmp, 'wb') as out:
+                for path in part_paths:
+                    with open(path, 'rb') as f:
+                        shutil.copyfileobj(f, out)
+        else:
+            writer = None
+            for path in part_paths:
+                table = pq.read_table(path)
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp, table.schema, compression='zstd')
+                writer.write_table(table)
+            writer.close()
+        os.replace(tmp, out_path)
+        for path in part_paths:
+            os.remove(path)
+        _write_json(os.path.join(job_dir, 'done.json'), {'finished': time.time(), 'size': os.path.getsize(out_path)})
+        return out_path
+    except Exception as e:
+        _write_error(job_dir, e)
+        raise
+
+def write_export_netcdf(job_dir: str, plan, selections: list, file_name: str) -> str:
+    """
+    Write the selections as gridded (time_period, depth, lat, lon) variables named like the CSV/JSON columns
+    """
+    try:
+        datasets = []
+        for sel in selections:
+            if sel.is_empty():
+                continue
+            ds = xr.open_zarr(sel.read_path)
+            sub = ds[sel.variables].isel(time_periods=sel.tp_idx, parameters=sel.p_idx,
+                                         depth=sel.depth_sl, lat=sel.lat_sl, lon=sel.lon_sl)
+            data_vars = {}
+            for var in sel.variables:
+                for pi, param in enumerate(sel.param_labels):
+                    name = param if var == 'mn' else f"{param}_{var}"
+                    data_vars[name] = sub[var].isel(parameters=pi, drop=True)
+                for derived in (sel.derived if var in derivable_vars else []):
+                    temperature, salinity = (data_vars[src if var == 'mn' else f"{src}_{var}"] for src in derived_parameters[derived])
+                    pressure = depth_to_pressure(sub['depth'], sub['lat']) if derived != 'sigma0' else 0.0
+                    data_vars[derived if var == 'mn' else f"{derived}_{var}"] = xr.apply_ufunc(
+                        partial(compute_derived, derived), temperature, salinity, pressure, dask='parallelized', output_dtypes=[np.float32])
+                for param in sel.hidden:
+                    data_vars.pop(param if var == 'mn' else f"{param}_{var}")
+            datasets.append(xr.Dataset(data_vars))
+        merged = xr.merge(datasets, join='outer').rename({'time_periods': 'time_period'})
+        for variable in merged.variables.values():
+            variable.encoding = {}
+        encoding = {name: {'zlib': True, 'complevel': 4} for name in merged.data_vars}
+
+        out_path = os.path.join(job_dir, file_name)
+        tmp = f"{out_path}.tmp"
+        # written chunk by chunk inside this task
+        with dask.config.set(scheduler='synchronous'):
+            merged.to_netcdf(tmp, encoding=encoding)
+        os.replace(tmp, out_path)
+        _write_json(os.path.join(job_dir, 'done.json'), {'finished': time.time(), 'size': os.path.getsize(out_path)})
+        return out_path
+    except Exception as e:
+        _write_error(job_dir, e)
+        raise
+
+class ExportJobManager:
+    """
+    Submits export jobs as Dask futures on the existing client and reports their state from the job directories.
+    CSV/Parquet jobs are split into slab batches written as parts in parallel, then combined into one file.
+    A job that has not finished is reported failed when its future (if submitted by this process) ended in error or
+    was lost, e.g. with a worker killed mid-task, or when nothing was written in its directory for `stall_timeout`.
+    """
+    def __init__(self, client, results_dir: str, batch_rows: int = 2000000, ttl: float = 86400, stall_timeout: float = 3600):
+        self.client = client
+        self.results_dir = os.path.abspath(results_dir)
+        self.batch_rows = batch_rows
+        self.ttl = ttl
+        self.stall_timeout = stall_timeout
+        self._futures = {}  # job_id -> final future (kept while this process is alive)
+        os.makedirs(self.results_dir, exist_ok=True)
+
+    def job_dir(self, job_id: str):
+        if not _job_id_pattern.match(job_id):
+            return None
+        path = os.path.join(self.results_dir, job_id)
+        return path if os.path.isdir(path) else None
+
+    def submit(self, plan, selections: list, fmt: str, query: dict, estimate: str) -> str:
+        self.purge()
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self.results_dir, job_id)
+        os.makedirs(job_dir)
+        file_name = f"woa23_from_ODB_{job_id[:8]}.{export_formats[fmt][1]}"
+
+        if fmt == 'netcdf':
+            n_parts = 1
+        else:
+            batches = list(iter_slab_batches(selections, self.batch_rows)) or [[]]
+            n_parts = len(batches)
+        _write_json(os.path.join(job_dir, 'job.json'), {
+            'job_id': job_id, 'format': fmt, 'file': file_name, 'parts': n_parts,
+            'query': query, 'estimate': estimate, 'created': time.time(),
+        })
+
+        prefix = f"woa23-export-{job_id}"
+        if fmt == 'netcdf':
+            final = self.client.submit(write_export_netcdf, job_dir, plan, selections, file_name, key=f"{prefix}-netcdf")
+        else:
+            columns = result_columns(selections, plan.variables)
+            part_paths = [part_path(job_dir, i, fmt) for i in range(n_parts)]
+            writes = [self.client.submit(write_export_part, job_dir, i, plan, parts, columns, fmt, key=f"{prefix}-part-{i}")
+                      for i, parts in enumerate(batches)]
+            final = self.client.submit(combine_export_parts, job_dir, part_paths, fmt, file_name, *writes, key=f"{prefix}-combine")
+        # the job keeps running on the cluster even if this API process restarts
+        fire_and_forget(final)
+        self._futures[job_id] = final
+        return job_id
+
+    def status(self, job_id: str):
+        job_dir = self.job_dir(job_id)
+        if job_dir is None:
+            return None
+        with open(os.path.join(job_dir, 'job.json')) as f:
+            job = json.load(f)
+        info = {key: job[key] for key in ('job_id', 'format', 'parts', 'query', 'estimate', 'created')}
+
+        done_path = os.path.join(job_dir, 'done.json')
+        error_path = os.path.join(job_dir, 'error.json')
+        if os.path.exists(done_path):
+            with open(done_path) as f:
+                done = json.load(f)
+            info.update(status='finished', progress=1.0, parts_done=job['parts'], **done)
+        elif os.path.exists(error_path):
+            with open(error_path) as f:
+                info.update(status='failed', **json.load(f))
+        else:
+            error = self.stalled(job_id, job_dir)
+            if error is not None:
+                # recorded like a task error, so every API worker reports it and the ttl applies from now
+                _write_json(error_path, {'error': error, 'time': time.time()})
+                info.update(status='failed', error=error)
+                return info
+            ext = export_formats[job['format']][1]
+            parts_done = sum(1 for name in os.listdir(job_dir) if name.startswith('part-') and name.endswith(f".{ext}"))
+            info.update(status='running' if parts_done else 'queued', parts_done=parts_done,
+                        progress=round(0.99 * parts_done / job['parts'], 3))
+        return info
+
+    def stalled(self, job_id: str, job_dir: str):
+        """
+        Why an unfinished job will never finish, or None. The tasks record their own exceptions in error.json;
+        this catches the jobs whose tasks could not (worker killed, future lost or cancelled).
+        """
+        future = self._futures.get(job_id)
+        if future is not None:
+            if future.status in ('error', 'lost', 'cancelled'):
+                return f"Export task {future.status} (worker died or the job was cancelled)"
+            return None
+        # no future here (job submitted by another API worker, or this one restarted): last write in the job directory
+        # (part files and the .tmp files being written)
+        last_write = max(os.path.getmtime(os.path.join(job_dir, name)) for name in os.listdir(job_dir))
+        if time.time() - last_write > self.stall_timeout:
+            return f"No progress for {int(time.time() - last_write)} s (worker died?)"
+        return None
+
+    def result_path(self, job_id: str):
+        """
+        Path and file name of the result of a finished job, or None
+        """
+        job_dir = self.job_dir(job_id)
+        if job_dir is None or not os.path.exists(os.path.join(job_dir, 'done.json')):
+            return None
+        with open(os.path.join(job_dir, 'job.json')) as f:
+            file_name = json.load(f)['file']
+        return os.path.join(job_dir, file_name), file_name
+
+    def purge(self):
+        """
+        Remove job directories older than the ttl
+        """
+        now = time.time()
+        for name in os.listdir(self.results_dir):
+            path = os.path.join(self.results_dir, name)
+            if _job_id_pattern.match(name) and os.path.isdir(path) and now - os.path.getmtime(path) > self.ttl:
+                shutil.rmtree(path, ignore_errors=True)
+                self._futures.pop(name, None)
+
+    def stats(self) -> dict:
+        states = {}
+        for job_id, future in list(self._futures.items()):
+            states[future.status] = states.get(future.status, 0) + 1
+        return {'results_dir': self.results_dir, 'submitted_here': len(self._futures), 'futures': states}
@@ -0,0 +1,112 @@
+import asyncio
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+class QueryQueueFull(Exception):
+    """
+    Raised when more queries are waiting than the executor accepts
+    """
+    pass
+
+class QueryBudgetExceeded(Exception):
+    """
+    Raised when admitting a query would exceed the estimated output bytes allowed in flight
+    """
+    pass
+
+class QueryExecutor:
+    """
+    Runs blocking query work (zarr reads, Dask compute, polars) on a dedicated thread pool so the
+    asyncio event loop keeps serving other requests. At most `max_workers` queries run at once;
+    up to `max_queue` more wait for a free worker, and the time spent waiting is recorded.
+    Admitted queries also reserve their estimated output bytes, at most `max_inflight_bytes` in total.
+    """
+    def __init__(self, max_workers: int = 4, max_queue: int = 32, max_inflight_bytes: int = None, name: str = 'woa23-query'):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.max_inflight_bytes = max_inflight_bytes
+        self.inflight_bytes = 0
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.over_budget = 0
+        self.continuations = 0
+        self.queue_time_total = 0.0
+        self.queue_time_max = 0.0
+
+    def _execute(self, submitted: float, func):
+        queue_time = time.monotonic() - submitted
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.queue_time_total += queue_time
+            self.queue_time_max = max(self.queue_time_max, queue_time)
+        try:
+            return func(), queue_time
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Await `func(*args, **kwargs)` executed on the pool. Returns (result, queue_time in seconds).
+        """
+        with self._lock:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise QueryQueueFull(f"Too many queued queries (limit {self.max_queue})")
+            self.queued += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, self._execute, time.monotonic(), partial(func, *args, **kwargs))
+
+    async def run_continuation(self, func, *args, **kwargs):
+        """
+        Await `func(*args, **kwargs)` executed on the pool for a query already admitted by `run`, e.g. the next chunk
+        of its streamed response: it is not subject to the queue limit and not counted as another query.
+        """
+        with self._lock:
+            self.continuations += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, partial(func, *args, **kwargs))
+
+    def reserve(self, nbytes: int):
+        """
+        Reserve `nbytes` of the in-flight budget; a single query is always admitted when nothing else is in flight
+        """
+        with self._lock:
+            if (self.max_inflight_bytes is not None and self.inflight_bytes > 0
+                    and self.inflight_bytes + nbytes > self.max_inflight_bytes):
+                self.over_budget += 1
+                raise QueryBudgetExceeded(f"Too much query output in flight (limit {self.max_inflight_bytes} bytes)")
+            self.inflight_bytes += nbytes
+
+    def release(self, nbytes: int):
+        with self._lock:
+            self.inflight_bytes -= nbytes
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            finished = max(self.completed, 1)
+            return {
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'over_budget': self.over_budget,
+                'continuations': self.continuations,
+                'inflight_bytes': self.inflight_bytes,
+                'max_inflight_bytes': self.max_inflight_bytes,
+                'queue_time_avg': self.queue_time_total / finished,
+                'queue_time_max': self.queue_time_max,
+            }
@@ -0,0 +1,87 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+def make_etag(key: tuple, store_versions: list) -> str:
+    """
+    Strong ETag of a normalized query against the versions of the zarr groups it reads
+    """
+    digest = hashlib.sha1(repr((key, sorted(store_versions))).encode()).hexdigest()[:32]
+    return f'"{digest}"'
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    True if an If-None-Match header value matches `etag` (weak comparison, as RFC 9110 requires for If-None-Match)
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    return any((tag[2:] if tag.startswith('W/') else tag) == etag for tag in candidates)
+
+class ResponseCache:
+    """
+    LRU cache of encoded query responses keyed by normalized query, bounded by a total memory budget.
+    Entries remember the ETag they were built for; a different ETag (store changed) is a miss.
+    """
+    def __init__(self, max_bytes: int = 256 * 1024**2, max_entry_bytes: int = 32 * 1024**2):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries = OrderedDict()  # key -> (etag, body)
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: tuple, etag: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != etag:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: tuple, etag: str, body: bytes):
+        if len(body) > self.max_entry_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self._entries[key] = (etag, body)
+            self.size += len(body)
+            while self.size > self.max_bytes and self._entries:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def collect(self, chunks, key: tuple, etag: str):
+        """
+        Pass a stream of byte chunks through, caching the whole body at the end if it fits in one entry
+        """
+        parts, total = [], 0
+        for chunk in chunks:
+            if parts is not None:
+                total += len(chunk)
+                if total > self.max_entry_bytes:
+                    parts = None
+                else:
+                    parts.append(chunk)
+            yield chunk
+        if parts is not None:
+            self.put(key, etag, b''.join(parts))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,89 @@
+import numpy as np
+import polars as pl
+
+def polygon_mask(lons, lats, vertices) -> np.ndarray:
+    """
+    (lat, lon) mask of the cell centers inside a polygon given as (n, 2) lon/lat vertices (even-odd rule)
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    x = np.asarray(lons, dtype=np.float64)[None, :]
+    y = np.asarray(lats, dtype=np.float64)[:, None]
+    inside = np.zeros((y.shape[0], x.shape[1]), dtype=bool)
+    for (x0, y0), (x1, y1) in zip(vertices, np.roll(vertices, -1, axis=0)):
+        if y0 == y1:
+            continue
+        crosses = (y0 > y) != (y1 > y)
+        x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        inside ^= crosses & (x < x_cross)
+    return inside
+
+def area_weights(lats) -> np.ndarray:
+    """
+    Relative area of the cells of a regular lon/lat grid at each latitude
+    """
+    return np.cos(np.radians(np.asarray(lats, dtype=np.float64)))
+
+class ProfileAggregator:
+    """
+    Area-weighted statistics per (time_period, depth) slab, accumulated block by block in float64:
+    count, sum of weights, weighted sums of values and squares, min and max per result column
+    """
+    def __init__(self, slab_keys: list, columns: list):
+        self.slab_index = {}
+        for key in slab_keys:
+            self.slab_index.setdefault(key, len(self.slab_index))
+        self.columns = list(columns)
+        n = len(self.slab_index)
+        self.count = {name: np.zeros(n, dtype=np.int64) for name in self.columns}
+        self.weight = {name: np.zeros(n) for name in self.columns}
+        self.sum = {name: np.zeros(n) for name in self.columns}
+        self.sum_sq = {name: np.zeros(n) for name in self.columns}
+        self.min = {name: np.full(n, np.nan) for name in self.columns}
+        self.max = {name: np.full(n, np.nan) for name in self.columns}
+
+    def add(self, block, weights):
+        """
+        Add a QueryBlock; `weights` (lat, lon) are the cell weights of the block, 0 outside the region
+        """
+        slabs = np.asarray([self.slab_index[(tp, float(dep))] for tp in block.tp_labels for dep in block.depths], dtype=np.int64)
+        w = np.asarray(weights, dtype=np.float64).reshape(-1)
+        outside = w <= 0
+        for var, values in block.arrays.items():
+            for pi, param in enumerate(block.param_labels):
+                name = f"{param}_{var}"
+                if name not in self.count:
+                    continue
+                v = values[pi].reshape(len(slabs), -1)
+                if outside.any():
+                    v = np.where(outside, np.float32(np.nan), v)
+                valid = ~np.isnan(v)
+                self.count[name][slabs] += valid.sum(axis=1)
+                self.weight[name][slabs] += valid @ w
+                # fmin/fmax skip NaN (all-NaN rows give NaN, which the running fmin/fmax ignores)
+                self.min[name][slabs] = np.fmin(self.min[name][slabs], np.fmin.reduce(v, axis=1))
+                self.max[name][slabs] = np.fmax(self.max[name][slabs], np.fmax.reduce(v, axis=1))
+                # NaN set to zero, so the weighted sums are plain matrix-vector products (accumulated in float64)
+                v = np.nan_to_num(v.astype(np.float64), copy=False)
+                self.sum[name][slabs] += v @ w
+                self.sum_sq[name][slabs] += np.square(v, out=v) @ w
+
+    def frame(self, labels: dict = None) -> pl.DataFrame:
+        """
+        One row per (time_period, depth) slab: depth, time_periods, then {label}_{stat} for each result column
+        (`labels` maps column names to output names; weighted population std; null statistics where no cell has a value)
+        """
+        series = [
+            pl.Series('depth', [key[1] for key in self.slab_index], dtype=pl.Float32),
+            pl.Series('time_periods', [key[0] for key in self.slab_index], dtype=pl.String),
+        ]
+        for name in self.columns:
+            label = (labels or {}).get(name, name)
+            empty = self.count[name] == 0
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = self.sum[name] / self.weight[name]
+                std = np.sqrt(np.maximum(self.sum_sq[name] / self.weight[name] - mean * mean, 0.0))
+            for stat, values in (('mean', mean), ('min', self.min[name]), ('max', self.max[name]), ('std', std)):
+                values = np.where(empty, np.nan, values).astype(np.float32)
+                series.append(pl.Series(f"{label}_{stat}", values, nan_to_null=True))
+            series.append(pl.Series(f"{label}_count", self.count[name]))
+        return pl.DataFrame(series)
@@ -0,0 +1,206 @@
+import os
+import math
+import threading
+from abc import ABC, abstractmethod
+import numpy as np
+import pyarrow.parquet as pq
+from src.woa23_query import GroupSelection, read_zarr_block, read_ds_block, chunks_spanned
+
+SOURCE_VERSION_FILE = '_source_version'  # written last by dev/zarr_geoparquet_woa23.py: zarr group version of the export
+
+class QueryBackend(ABC):
+    """
+    Source of the values of a GroupSelection. `read_arrays` returns, per statistic variable of the selection, the
+    values at time period indices `tp_idx` and depth indices `depth_index` (slice or list, absolute) over the
+    selected lat/lon cells, in PARAM_MAJOR_DIMS order with NaN where there is no value. All backends return the same
+    arrays for the same selection (dev/woa23_backend_conformance.py checks it), so the result frames are identical.
+    """
+    name = None
+
+    @abstractmethod
+    def read_arrays(self, sel: GroupSelection, tp_idx: list, depth_index) -> dict:
+        ...
+
+class ZarrBackend(QueryBackend):
+    """
+    Reads the zarr group (or its copy in `sel.read_path`): zarr chunks by index with `direct`, otherwise through xarray/Dask
+    """
+    name = 'zarr'
+
+    def __init__(self, zarr_cache, direct: bool = False):
+        self.zarr_cache = zarr_cache
+        self.direct = direct
+
+    def read_arrays(self, sel: GroupSelection, tp_idx: list, depth_index) -> dict:
+        if self.direct and sel.direct_readable:
+            zarr_arrays = {var: self.zarr_cache.get_array(sel.read_path, var) for var in sel.variables}
+            return read_zarr_block(zarr_arrays, tp_idx, sel.p_idx, depth_index, sel.lat_sl, sel.lon_sl)
+        ds = self.zarr_cache.get(sel.read_path)
+        return read_ds_block(ds, sel.variables, tp_idx, sel.p_idx, depth_index, sel.lat_sl, sel.lon_sl)
+
+def row_group_bounds(metadata) -> np.ndarray:
+    """
+    (row groups, 4) lon min, lon max, lat min, lat max of each row group of a Parquet file, from its footer
+    statistics (unbounded where a row group has none)
+    """
+    names = [metadata.schema.column(i).name for i in range(metadata.num_columns)]
+    bounds = np.tile([-np.inf, np.inf, -np.inf, np.inf], (metadata.num_row_groups, 1))
+    for rg in range(metadata.num_row_groups):
+        for k, name in enumerate(['lon', 'lat']):
+            stats = metadata.row_group(rg).column(names.index(name)).statistics
+            if stats is not None and stats.has_min_max:
+                bounds[rg, 2 * k:2 * k + 2] = stats.min, stats.max
+    return bounds
+
+class ColumnarExport:
+    """
+    Listing of a GeoParquet export of one zarr group (dev/zarr_geoparquet_woa23.py): the part file of each
+    (time_period, depth) partition and the {param}_{var} value columns. Partitions without any value are not written.
+    The lon/lat bounds of the row groups of each part file are kept once read (a few KB per file).
+    """
+    def __init__(self, path: str, version: str):
+        self.path = path
+        self.version = version
+        self.files = {}  # (time_period, depth) -> part file
+        for tp_dir in os.listdir(path):
+            if not tp_dir.startswith('time_period='):
+                continue
+            for depth_dir in os.listdir(os.path.join(path, tp_dir)):
+                file = os.path.join(path, tp_dir, depth_dir, 'part-0.parquet')
+                if depth_dir.startswith('depth=') and os.path.exists(file):
+                    self.files[(tp_dir.partition('=')[2], float(depth_dir.partition('=')[2]))] = file
+        self.columns = set()
+        self.row_group_rows = 1
+        if self.files:
+            metadata = pq.read_metadata(next(iter(self.files.values())))
+            self.columns = set(metadata.schema.names)
+            self.row_group_rows = max(metadata.row_group(0).num_rows, 1) if metadata.num_row_groups else 1
+        self._bounds = {}  # part file -> row_group_bounds
+        self._lock = threading.Lock()
+
+    def covers(self, sel: GroupSelection) -> bool:
+        """
+        True if the export holds all value columns of the selection
+        """
+        return all(f"{param}_{var}" in self.columns for var in sel.variables for param in sel.param_labels)
+
+    def row_groups(self, file: str, lon_min: float, lon_max: float, lat_min: float, lat_max: float) -> np.ndarray:
+        """
+        Row groups of a part file whose lon/lat statistics overlap the box
+        """
+        with self._lock:
+            bounds = self._bounds.get(file)
+        if bounds is None:
+            bounds = row_group_bounds(pq.read_metadata(file))
+            with self._lock:
+                self._bounds[file] = bounds
+        return np.flatnonzero((bounds[:, 0] <= lon_max) & (bounds[:, 1] >= lon_min) &
+                              (bounds[:, 2] <= lat_max) & (bounds[:, 3] >= lat_min))
+
+class ColumnarExports:
+    """
+    Per-worker cache of the listings of the GeoParquet exports. An export is used only if it was written from the
+    current version of its zarr group; the `_source_version` marker is checked on every lookup (one stat), since it
+    goes first when an export is rewritten.
+    """
+    def __init__(self):
+        self._entries = {}  # export path -> (marker mtime_ns, ColumnarExport)
+        self._lock = threading.Lock()
+
+    def get(self, path: str, version: str):
+        """
+        Listing of the export at `path` if it is up to date with zarr group `version`, else None
+        """
+        marker = os.path.join(path, SOURCE_VERSION_FILE)
+        try:
+            mtime_ns = os.stat(marker).st_mtime_ns
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is None or entry[0] != mtime_ns:
+            with open(marker, 'r') as f:
+                export_version = f.read().strip()
+            entry = (mtime_ns, ColumnarExport(path, export_version))
+            with self._lock:
+                self._entries[path] = entry
+        return entry[1] if entry[1].version == version else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'files': sum(len(e.files) for _, e in self._entries.values())}
+
+class ColumnarBackend(QueryBackend):
+    """
+    Reads the GeoParquet export of the group with the predicates pushed down to the files: only the part files of
+    the selected (time_period, depth) partitions are opened, only the row groups whose lon/lat statistics overlap the
+    box are read (rows are sorted along a Hilbert curve, so a box touches few row groups) and only the selected
+    {param}_{var} columns are decoded. The rows in the box are scattered into NaN-filled arrays: cells not exported
+    hold no value.
+    """
+    name = 'columnar'
+
+    def __init__(self, export: ColumnarExport):
+        self.export = export
+
+    def read_arrays(self, sel: GroupSelection, tp_idx: list, depth_index) -> dict:
+        tp_labels = [sel.tp_labels[sel.tp_idx.index(ti)] for ti in tp_idx]
+        if isinstance(depth_index, slice):
+            depth_index = range(depth_index.start, depth_index.stop)
+        depths = [float(sel.depths[di - sel.depth_sl.start]) for di in depth_index]
+        shape = (len(sel.p_idx), len(tp_labels), len(depths), len(sel.lats), len(sel.lons))
+        arrays = {var: np.full(shape, np.nan, dtype=np.float32) for var in sel.variables}
+        if min(shape) == 0:
+            return arrays
+
+        lon_min, lon_max, lat_min, lat_max = sel.lons[0], sel.lons[-1], sel.lats[0], sel.lats[-1]
+        columns = {(var, pi): f"{param}_{var}" for var in sel.variables for pi, param in enumerate(sel.param_labels)}
+        for ti, tp in enumerate(tp_labels):
+            for di, depth in enumerate(depths):
+                file = self.export.files.get((tp, depth))
+                if file is None:
+                    continue
+                row_groups = self.export.row_groups(file, lon_min, lon_max, lat_min, lat_max)
+                if len(row_groups) == 0:
+                    continue
+                table = pq.ParquetFile(file).read_row_groups(row_groups, columns=['lon', 'lat', *columns.values()], use_threads=False)
+                lon, lat = table['lon'].to_numpy(), table['lat'].to_numpy()
+                rows = np.flatnonzero((lon >= lon_min) & (lon <= lon_max) & (lat >= lat_min) & (lat <= lat_max))
+                yi = np.searchsorted(sel.lats, lat[rows])
+                xi = np.searchsorted(sel.lons, lon[rows])
+                for (var, pi), name in columns.items():
+                    # nulls come out as NaN
+                    arrays[var][pi, ti, di, yi, xi] = table[name].to_numpy()[rows]
+        return arrays
+
+def read_depth_slice(sel: GroupSelection) -> slice:
+    """
+    Depth levels of the selection that are read: those above `valid_depth_stop` (ocean mask)
+    """
+    if sel.valid_depth_stop is None:
+        return sel.depth_sl
+    return slice(sel.depth_sl.start, max(sel.depth_sl.start, min(sel.depth_sl.stop, sel.valid_depth_stop)))
+
+def zarr_read_cells(sel: GroupSelection, chunk_shapes: dict) -> int:
+    """
+    Values decoded to read the selection from zarr: all cells of the chunks it touches.
+    `chunk_shapes` maps each variable to its zarr chunk shape (DIMS order).
+    """
+    depth_sl = read_depth_slice(sel)
+    cells = 0
+    for var in sel.variables:
+        shape = chunk_shapes[var]
+        cells += (chunks_spanned(sel.tp_idx, shape[0]) * chunks_spanned(sel.p_idx, shape[1]) * chunks_spanned(depth_sl, shape[2]) *
+                  chunks_spanned(sel.lat_sl, shape[3]) * chunks_spanned(sel.lon_sl, shape[4]) * math.prod(shape))
+    return cells
+
+def columnar_read_cells(sel: GroupSelection, export: ColumnarExport) -> int:
+    """
+    Values decoded to read the selection from the columnar export: per (time_period, depth) part file, the rows of
+    the row groups overlapping the box (the box cells rounded up, plus one row group along its edges) times the
+    value columns and lon/lat
+    """
+    depth_sl = read_depth_slice(sel)
+    n_file = len(sel.tp_idx) * (depth_sl.stop - depth_sl.start)
+    n_row = (math.ceil(len(sel.lats) * len(sel.lons) / export.row_group_rows) + 1) * export.row_group_rows
+    return n_file * n_row * (len(sel.variables) * len(sel.p_idx) + 2)
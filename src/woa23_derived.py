@@ -0,0 +1,109 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+from src.woa23_utils import sea_density, depth_to_pressure
+
+# derived parameter -> source parameters it is computed from (in this order)
+derived_parameters = {
+    'density': ('temperature', 'salinity'),
+    'sigma0': ('temperature', 'salinity'),
+}
+# statistics a derived parameter is computed for (means); other statistics of it are not defined
+derivable_vars = ['an', 'mn']
+
+def compute_derived(name: str, temperature, salinity, pressure, out=None):
+    """
+    `density`: in-situ density (kg/m^3) at `pressure` (dbar).
+    `sigma0`: density anomaly (kg/m^3 - 1000) at the surface, as `calculate_sea_density(..., 0, sigma0=True)`.
+    """
+    if name == 'sigma0':
+        return sea_density(temperature, salinity, 0.0, sigma0=True, out=out, dtype=np.float32)
+    return sea_density(temperature, salinity, pressure, out=out, dtype=np.float32)
+
+class SlabCache:
+    """
+    LRU cache of derived (time_period, depth) slabs (numpy arrays), bounded by a total memory budget
+    """
+    def __init__(self, max_bytes: int = 128 * 1024**2):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple):
+        with self._lock:
+            values = self._entries.get(key)
+            if values is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return values
+
+    def put(self, key: tuple, values: np.ndarray):
+        if values.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old.nbytes
+            self._entries[key] = values
+            self.size += values.nbytes
+            while self.size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.nbytes
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+def _derive_var(name, temperature, salinity, depths, lats, cache, cache_key, tp_labels):
+    """
+    Derived values (T, D, *cells) of one statistic, computed slab by slab for the slabs not in the cache
+    """
+    cell_ndim = temperature.ndim - 2
+    if cache is None:
+        pressure = depth_to_pressure(depths.reshape((-1,) + (1,) * cell_ndim), lats) if name != 'sigma0' else 0.0
+        return compute_derived(name, temperature, salinity, pressure)
+
+    values = np.empty(temperature.shape, dtype=np.float32)
+    missing = []
+    for ti, tp in enumerate(tp_labels):
+        for di, dep in enumerate(depths):
+            hit = cache.get(cache_key + (name, tp, float(dep)))
+            if hit is None:
+                missing.append((ti, di))
+            else:
+                values[ti, di] = hit
+    if missing:
+        ti, di = (np.asarray(idx, dtype=np.int64) for idx in zip(*missing))
+        pressure = depth_to_pressure(depths[di].reshape((-1,) + (1,) * cell_ndim), lats) if name != 'sigma0' else 0.0
+        computed = compute_derived(name, temperature[ti, di], salinity[ti, di], pressure)
+        values[ti, di] = computed
+        for k, (t, d) in enumerate(missing):
+            cache.put(cache_key + (name, tp_labels[t], float(depths[d])), computed[k])
+    return values
+
+def derive_block(block, derived: list, hidden: list, lats, cache: SlabCache = None, cache_key: tuple = None):
+    """
+    Append the derived parameters to a QueryBlock/PointBlock (arrays var -> (P, T, D, *cells)), computed from its
+    temperature/salinity, and drop the parameters read only as their sources (`hidden`). `lats` broadcasts against
+    the cell axes. Statistics other than means get all-NaN derived values (not part of the result columns).
+    With a cache, computed slabs are kept under `cache_key` + (name, time_period, depth), per statistic.
+    """
+    keep = [pi for pi, param in enumerate(block.param_labels) if param not in hidden]
+    for var, values in block.arrays.items():
+        parts = [values[keep]]
+        for name in derived:
+            if var in derivable_vars:
+                temperature, salinity = (values[block.param_labels.index(src)] for src in derived_parameters[name])
+                var_key = None if cache is None else cache_key + (var,)
+                parts.append(_derive_var(name, temperature, salinity, block.depths, lats, cache, var_key, block.tp_labels)[None])
+            else:
+                parts.append(np.full((1,) + values.shape[1:], np.nan, dtype=np.float32))
+        block.arrays[var] = np.concatenate(parts) if len(parts) > 1 else parts[0]
+    block.param_labels = [block.param_labels[pi] for pi in keep] + list(derived)
+    return block
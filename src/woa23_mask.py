@@ -0,0 +1,55 @@
+import os
+import threading
+import numpy as np
+import xarray as xr
+import zarr
+
+def mask_path(zarr_group_path: str) -> str:
+    """
+    Path of the ocean mask of a zarr group, stored next to it (e.g. .../annual/TS -> .../annual/TS_mask)
+    """
+    return f"{zarr_group_path.rstrip('/')}_mask"
+
+def bottom_index(ds: xr.Dataset) -> xr.DataArray:
+    """
+    (lat, lon) number of depth levels down to the deepest level holding a value in any variable, parameter or
+    time period of the group, i.e. the index of that level + 1, and 0 for land (the ocean mask is bottom_index > 0)
+    """
+    valid = None
+    for da in ds.data_vars.values():
+        column = da.notnull().any(['time_periods', 'parameters'])
+        valid = column if valid is None else valid | column
+    levels = xr.DataArray(np.arange(1, ds.sizes['depth'] + 1, dtype=np.int16), dims='depth')
+    return (valid * levels).max('depth').astype(np.int16)
+
+class OceanMasks:
+    """
+    Per-worker cache of the bottom_index arrays (small 2-D int16) of zarr groups, read from their mask groups.
+    A mask is used only if it was built from the current version of its source group.
+    """
+    def __init__(self):
+        self._entries = {}  # mask path -> (source version, bottom_index)
+        self._lock = threading.Lock()
+
+    def get(self, zarr_group_path: str, version: str):
+        """
+        bottom_index of a zarr group at `version`, or None if it has no up-to-date mask
+        """
+        path = mask_path(zarr_group_path)
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        if not os.path.isdir(path):
+            return None
+        group = zarr.open_group(path, mode='r')
+        if group.attrs.get('source_version') != version:
+            return None
+        values = group['bottom_index'][:]
+        with self._lock:
+            self._entries[path] = (version, values)
+        return values
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': sum(v.nbytes for _, v in self._entries.values())}
@@ -0,0 +1,97 @@
+import io
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# format -> (media type, file extension)
+output_formats = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrow'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+def read_frame(body: bytes, content_type: str):
+    """
+    Parse an uploaded columnar batch by its media type: Parquet, Arrow IPC (stream or file) or CSV (default).
+    Returns the frame and the matching output format.
+    """
+    media_type = (content_type or '').split(';')[0].strip().lower()
+    if media_type in ('application/vnd.apache.parquet', 'application/parquet', 'application/x-parquet'):
+        return pl.read_parquet(io.BytesIO(body)), 'parquet'
+    if media_type in ('application/vnd.apache.arrow.stream', 'application/vnd.apache.arrow.file'):
+        if body[:6] == b'ARROW1':
+            return pl.read_ipc(io.BytesIO(body)), 'arrow'
+        return pl.read_ipc_stream(io.BytesIO(body)), 'arrow'
+    return pl.read_csv(io.BytesIO(body)), 'csv'
+
+class _ChunkSink(io.RawIOBase):
+    """
+    Write-only file object that hands back whatever was written since the last `take()`
+    """
+    def __init__(self):
+        self._parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._parts.append(bytes(b))
+        return len(b)
+
+    def take(self) -> bytes:
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+def iter_csv(frames):
+    include_header = True
+    for df in frames:
+        yield df.write_csv(include_header=include_header).encode()  # polars version
+        include_header = False
+
+def iter_ndjson(frames):
+    for df in frames:
+        if not df.is_empty():
+            yield df.write_ndjson().encode()
+
+def iter_arrow_ipc(frames):
+    """
+    Arrow IPC stream: schema message, then one or more record batches per frame
+    """
+    sink = _ChunkSink()
+    writer = None
+    for df in frames:
+        table = df.to_arrow()
+        if writer is None:
+            writer = pa.ipc.new_stream(sink, table.schema)
+        writer.write_table(table)
+        yield sink.take()
+    if writer is not None:
+        writer.close()
+        yield sink.take()
+
+def iter_parquet(frames, compression: str = 'zstd'):
+    """
+    Parquet file written row group by row group; the footer goes out with the last chunk
+    """
+    sink = _ChunkSink()
+    writer = None
+    for df in frames:
+        table = df.to_arrow()
+        if writer is None:
+            writer = pq.ParquetWriter(sink, table.schema, compression=compression)
+        writer.write_table(table)
+        yield sink.take()
+    if writer is not None:
+        writer.close()
+        yield sink.take()
+
+def iter_encoded(frames, fmt: str):
+    """
+    Encode a sequence of polars frames (same schema) into chunks of bytes of the given output format
+    """
+    encoders = {'csv': iter_csv, 'ndjson': iter_ndjson, 'arrow': iter_arrow_ipc, 'parquet': iter_parquet}
+    for chunk in encoders[fmt](frames):
+        if chunk:
+            yield chunk
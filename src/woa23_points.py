@@ -0,0 +1,257 @@
+import numpy as np
+import polars as pl
+import xarray as xr
+from src.woa23_query import QueryCost, chunks_spanned, float_column, result_columns
+
+def snap_to_grid_index(coords, values, grid_size: float) -> np.ndarray:
+    """
+    Index of the grid cell holding each value (vectorized `to_lowest_grid_point`), -1 if outside the grid
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    centers = np.floor(values / grid_size) * grid_size + 0.5 * grid_size
+    with np.errstate(invalid='ignore'):
+        idx = np.rint((centers - coords[0]) / grid_size)
+    idx = np.where(np.isfinite(idx), idx, -1).astype(np.int64)
+    idx[(idx < 0) | (idx >= len(coords))] = -1
+    return idx
+
+def unique_cells(lat_idx, lon_idx):
+    """
+    Unique (lat, lon) cells of a set of points, and the position of each point among them
+    """
+    keys = np.asarray(lat_idx, dtype=np.int64) * (1 << 32) + np.asarray(lon_idx, dtype=np.int64)
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys >> 32, keys & ((1 << 32) - 1), inverse
+
+def cell_chunk_groups(lat_idx, lon_idx, chunk_lat: int, chunk_lon: int):
+    """
+    Group cells by the lat/lon chunk holding them. Yields the positions of the cells in each chunk.
+    """
+    chunk_id = (np.asarray(lat_idx) // chunk_lat) * (1 << 32) + np.asarray(lon_idx) // chunk_lon
+    order = np.argsort(chunk_id, kind='stable')
+    bounds = np.flatnonzero(np.diff(chunk_id[order])) + 1
+    return np.split(order, bounds)
+
+def read_zarr_cells(zarr_arrays: dict, tp_idx, p_idx, depth_sl: slice, lat_idx, lon_idx) -> dict:
+    """
+    Values at the (lat_idx[i], lon_idx[i]) cells of each zarr array, as var -> (P, T, D, N) arrays
+    (PARAM_MAJOR_DIMS order with the cells last). Every lat/lon chunk touched is read once, for all its cells.
+    """
+    lat_idx = np.asarray(lat_idx, dtype=np.int64)
+    lon_idx = np.asarray(lon_idx, dtype=np.int64)
+    n_depth = depth_sl.stop - depth_sl.start
+    data = {}
+    for var, zarr_array in zarr_arrays.items():
+        values = np.full((len(p_idx), len(tp_idx), n_depth, len(lat_idx)), np.nan, dtype=np.float32)
+        if len(lat_idx):
+            fill_value = zarr_array.fill_value
+            for rows in cell_chunk_groups(lat_idx, lon_idx, zarr_array.chunks[3], zarr_array.chunks[4]):
+                la, lo = lat_idx[rows], lon_idx[rows]
+                la0, lo0 = la.min(), lo.min()
+                block = zarr_array.oindex[list(tp_idx), list(p_idx), depth_sl, la0:la.max() + 1, lo0:lo.max() + 1]
+                cells = block[..., la - la0, lo - lo0]  # (T, P, D, n)
+                if fill_value is not None and not np.isnan(fill_value):
+                    cells = np.where(cells == fill_value, np.float32(np.nan), cells)
+                values[..., rows] = np.moveaxis(cells, 1, 0)
+        data[var] = values
+    return data
+
+def read_ds_cells(ds, variables: list, tp_idx, p_idx, depth_sl: slice, lat_idx, lon_idx) -> dict:
+    """
+    Same as `read_zarr_cells`, through xarray pointwise (vectorized) indexing
+    """
+    loaded = ds[variables].isel(
+        time_periods=list(tp_idx),
+        parameters=list(p_idx),
+        depth=depth_sl,
+        lat=xr.DataArray(np.asarray(lat_idx, dtype=np.int64), dims='cell'),
+        lon=xr.DataArray(np.asarray(lon_idx, dtype=np.int64), dims='cell'),
+    ).transpose('parameters', 'time_periods', 'depth', 'cell').compute()
+    return {var: np.asarray(loaded[var].values, dtype=np.float32) for var in variables}
+
+class PointBlock:
+    """
+    Values of one zarr group at a set of cells, per statistic variable, as (P, T, D, N) arrays
+    """
+    def __init__(self, tp_labels, param_labels, depths):
+        self.tp_labels = [str(tp) for tp in tp_labels]
+        self.param_labels = [str(p) for p in param_labels]
+        self.depths = np.asarray(depths, dtype=np.float32)
+        self.arrays = {}  # var -> ndarray (P, T, D, N)
+
+def slab_table(blocks: list):
+    """
+    (time_period, depth) slabs of the blocks in order of first appearance, and the slab positions of each block
+    """
+    slab_index = {}
+    block_slabs = []
+    for b in blocks:
+        idx = [slab_index.setdefault((tp, float(dep)), len(slab_index)) for tp in b.tp_labels for dep in b.depths]
+        block_slabs.append(np.asarray(idx, dtype=np.int64))
+    return slab_index, block_slabs
+
+def assemble_points(blocks: list, variables: list, point_ids, lons, lats, columns: list = None) -> pl.DataFrame:
+    """
+    Build the result of a point query: one profile per point, i.e. rows ordered by point, then by
+    (time_period, depth) slab in order of first appearance. Blocks hold the values of the N points.
+    """
+    point_ids = np.asarray(point_ids, dtype=np.int64)
+    n_point = len(point_ids)
+    slab_index, block_slabs = slab_table(blocks)
+    n_slab = len(slab_index)
+
+    values_of = {}
+    for b, slabs in zip(blocks, block_slabs):
+        for var in variables:
+            if var not in b.arrays:
+                continue
+            for pi, param in enumerate(b.param_labels):
+                name = f"{param}_{var}"
+                if name not in values_of:
+                    values_of[name] = np.full((n_slab, n_point), np.nan, dtype=np.float32)
+                values_of[name][slabs] = b.arrays[var][pi].reshape(len(slabs), n_point)
+
+    if columns is None:
+        columns = list(values_of)
+    n_row = n_point * n_slab
+    slab_tps = [k[0] for k in slab_index]
+    return pl.DataFrame([
+        pl.Series('point', np.repeat(point_ids, n_slab)),
+        pl.Series('lon', np.repeat(np.asarray(lons, dtype=np.float32), n_slab)),
+        pl.Series('lat', np.repeat(np.asarray(lats, dtype=np.float32), n_slab)),
+        pl.Series('depth', np.tile(np.asarray([k[1] for k in slab_index], dtype=np.float32), n_point)),
+        pl.Series('time_periods', slab_tps, dtype=pl.String).gather(np.tile(np.arange(n_slab), n_point)),
+    ] + [
+        float_column(name, values_of[name].T) if name in values_of else pl.Series(name, [None] * n_row, dtype=pl.Float32)
+        for name in columns
+    ])
+
+def estimate_cells_cost(selections: list, variables: list, lat_idx, lon_idx, n_point: int, chunk_shapes: dict) -> QueryCost:
+    """
+    Cost of reading the given unique cells of each selection (see `estimate_query_cost`), for `n_point` output profiles
+    """
+    slabs = set()
+    cells = chunks = 0
+    for sel in selections:
+        slabs.update(sel.slab_keys())
+        n_value = len(sel.tp_idx) * len(sel.p_idx) * len(sel.depths) * len(lat_idx)
+        for var in sel.variables:
+            cells += n_value
+            shape = chunk_shapes.get((sel.read_path, var))
+            if shape is None:
+                chunks += n_value
+                continue
+            n_tiles = len(cell_chunk_groups(lat_idx, lon_idx, shape[3], shape[4])) if len(lat_idx) else 0
+            chunks += (chunks_spanned(sel.tp_idx, shape[0]) * chunks_spanned(sel.p_idx, shape[1]) *
+                       chunks_spanned(sel.depth_sl, shape[2]) * n_tiles)
+    return QueryCost(len(slabs) * n_point, 5 + len(result_columns(selections, variables)), cells, chunks)
+
+def grid_neighbours(coords, values, periodic: bool = False):
+    """
+    Bilinear neighbours on a regular axis of cell centers: lower and upper cell index and the weight of the upper one.
+    Between the last center and the grid edge a periodic axis (longitude) wraps around, otherwise the outermost
+    cell is used alone. Indices are -1 for values outside the grid.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    n = len(coords)
+    step = coords[1] - coords[0]
+    with np.errstate(invalid='ignore'):
+        valid = (values >= coords[0] - step / 2) & (values <= coords[-1] + step / 2)
+        f = np.where(valid, (values - coords[0]) / step, 0.0)
+    i0 = np.floor(f)
+    w = f - i0
+    i0 = i0.astype(np.int64)
+    i1 = i0 + 1
+    if periodic:
+        i0 %= n
+        i1 %= n
+    else:
+        below, above = i0 < 0, i1 > n - 1
+        i0[below], i1[below], w[below] = 0, 0, 0.0
+        i0[above], i1[above], w[above] = n - 1, n - 1, 0.0
+    i0[~valid] = -1
+    i1[~valid] = -1
+    return i0, i1, w
+
+def depth_neighbours(depths, values):
+    """
+    Depth levels bracketing each value and the weight of the deeper one; -1 outside [first, last] level
+    """
+    depths = np.asarray(depths, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    n = len(depths)
+    k1 = np.searchsorted(depths, values, side='right')
+    k0 = k1 - 1
+    k1 = np.minimum(k1, n - 1)
+    with np.errstate(invalid='ignore'):
+        valid = (values >= depths[0]) & (values <= depths[-1])
+    k0 = np.where(valid, k0, 0)
+    k1 = np.where(valid, k1, 0)
+    span = depths[k1] - depths[k0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w = np.where(span > 0, (values - depths[k0]) / span, 0.0)
+    k0[~valid] = -1
+    k1[~valid] = -1
+    return k0, k1, w
+
+def interpolate_cells(values, t_pos, k0, k1, wz, cells, wy, wx, strict: bool = False):
+    """
+    Trilinear (bilinear in lat/lon, linear in depth) interpolation over the whole batch at once.
+    `values` is (T, D, N) for one parameter/statistic; per row: time position, depth neighbours with weight `wz`
+    of the deeper one, `cells` (4, rows) positions of the (lat0, lon0), (lat0, lon1), (lat1, lon0), (lat1, lon1)
+    neighbours with weights `wy` (lat1) and `wx` (lon1).
+    NaN neighbours are left out and the remaining weights renormalized (or the row is NaN if `strict`).
+    Returns the values and a uint8 mask with bit (4*iz + 2*iy + ix) set where that neighbour is NaN.
+    """
+    n = len(t_pos)
+    total = np.zeros(n, dtype=np.float64)
+    weight = np.zeros(n, dtype=np.float64)
+    nan_weight = np.zeros(n, dtype=np.float64)
+    mask = np.zeros(n, dtype=np.uint8)
+    for iz, (k, fz) in enumerate(((k0, 1.0 - wz), (k1, wz))):
+        for iy, fy in enumerate((1.0 - wy, wy)):
+            for ix, fx in enumerate((1.0 - wx, wx)):
+                v = values[t_pos, k, cells[2 * iy + ix]]
+                w = fz * fy * fx
+                nan = np.isnan(v)
+                mask |= nan.astype(np.uint8) << (4 * iz + 2 * iy + ix)
+                total += np.where(nan, 0.0, v * w)
+                weight += np.where(nan, 0.0, w)
+                nan_weight += np.where(nan, w, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = np.where(weight > 0, total / weight, np.nan)
+    if strict:
+        out[nan_weight > 0] = np.nan
+    return out.astype(np.float32), mask
+
+def cells_read_cost(zarr_array, lat_idx, lon_idx, depth_sl: slice, chunk_overhead: int = 256 * 1024) -> int:
+    """
+    Bytes decoded (plus a fixed per-chunk overhead) to read the given cells and depth levels of one
+    time period/parameter, used to pick the cheaper chunk layout for a set of cells
+    """
+    chunks = zarr_array.chunks
+    n_tiles = len(cell_chunk_groups(lat_idx, lon_idx, chunks[3], chunks[4])) if len(lat_idx) else 0
+    n_chunks = n_tiles * chunks_spanned(depth_sl, chunks[2])
+    return n_chunks * (int(np.prod(chunks[2:])) * zarr_array.dtype.itemsize + chunk_overhead)
+
+def bilinear_cells(values, cells, wy, wx, strict: bool = False):
+    """
+    Bilinear (lat/lon) interpolation of (..., N) cell values at S positions, given their `cells` (4, S) neighbour
+    positions and weights as in `interpolate_cells`. Returns (..., S) float32 values, NaN neighbours handled the same way.
+    """
+    total = weight = nan_weight = 0.0
+    for iy, fy in enumerate((1.0 - wy, wy)):
+        for ix, fx in enumerate((1.0 - wx, wx)):
+            v = values[..., cells[2 * iy + ix]].astype(np.float64)
+            w = fy * fx
+            nan = np.isnan(v)
+            total = total + np.where(nan, 0.0, v * w)
+            weight = weight + np.where(nan, 0.0, w)
+            nan_weight = nan_weight + np.where(nan, w, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = np.where(weight > 0, total / weight, np.nan)
+    if strict:
+        out[nan_weight > 0] = np.nan
+    return out.astype(np.float32)
@@ -0,0 +1,46 @@
+import numpy as np
+import xarray as xr
+
+def pyramid_level_dir(grid_size: float) -> str:
+    """
+    Directory name of a pyramid level, in the style of the grid directories: 0.5 -> '05_degree', 2.0 -> '2_degree'
+    """
+    return f"{grid_size:g}".replace('.', '') + '_degree'
+
+def coarsen_factor(native_size: float, grid_size: float) -> int:
+    factor = grid_size / native_size
+    if factor < 2 or abs(factor - round(factor)) > 1e-9:
+        raise ValueError(f"Pyramid level {grid_size} is not a multiple of the native grid size {native_size}")
+    return int(round(factor))
+
+def coarsen_mean(ds: xr.Dataset, factor: int) -> xr.Dataset:
+    """
+    Coarsen the lat/lon cells of a dataset by `factor` (in both directions) into the NaN-aware, cos(lat) area-weighted
+    mean of the fine cells that have a value; a coarse cell is NaN only if all its fine cells are (land, below bottom).
+    Every statistic is averaged the same way (e.g. `dd` becomes the mean number of observations per fine cell).
+    Coarse coordinates are the centers of the coarse cells.
+    """
+    weights = np.cos(np.radians(ds['lat'].astype(np.float64)))
+    data_vars = {}
+    for name, da in ds.data_vars.items():
+        values = da.astype(np.float64)
+        num = (values.fillna(0) * weights).coarsen(lat=factor, lon=factor, boundary='exact').sum()
+        den = (values.notnull() * weights).coarsen(lat=factor, lon=factor, boundary='exact').sum()
+        data_vars[name] = (num / den).where(den > 0).astype(da.dtype)
+        data_vars[name].attrs = da.attrs
+    coarse = xr.Dataset(data_vars, attrs=ds.attrs)
+    # coordinates: mean of the fine centers, i.e. the coarse centers of a regular grid
+    for dim in ('lat', 'lon'):
+        coarse[dim] = ds[dim].coarsen({dim: factor}, boundary='exact').mean().astype(ds[dim].dtype)
+        coarse[dim].attrs = ds[dim].attrs
+    return coarse
+
+def select_level(levels: list, n_cells, max_cells: int):
+    """
+    Finest grid size of `levels` (sorted finest first) whose cell count `n_cells(grid_size)` is within `max_cells`,
+    or the coarsest level if none is
+    """
+    for grid_size in levels:
+        if n_cells(grid_size) <= max_cells:
+            return grid_size
+    return levels[-1]
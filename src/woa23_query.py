@@ -0,0 +1,450 @@
+import copy
+import math
+import numpy as np
+import polars as pl
+import pyarrow as pa
+from src.woa23_derived import derived_parameters, derivable_vars
+
+DIMS = ('time_periods', 'parameters', 'depth', 'lat', 'lon')
+PARAM_MAJOR_DIMS = ('parameters', 'time_periods', 'depth', 'lat', 'lon')
+
+class QueryPlan:
+    """
+    Normalized query: grid, parameters, time periods, statistics, zarr groups and the snapped bounding box.
+    `pars` are the parameters read, including the `hidden` ones read only to compute the `derived` parameters.
+    `dropna` leaves out the rows without any value (land, below the sea floor).
+    """
+    def __init__(self, grid, grid_size, pars, periods, variables, zarr_group_paths,
+                 lon_min, lon_max, lat_min, lat_max, depth_min, depth_max, derived=None, hidden=None, dropna=False):
+        self.grid = grid
+        self.grid_size = grid_size
+        self.pars = pars
+        self.periods = periods
+        self.variables = variables
+        self.zarr_group_paths = zarr_group_paths
+        self.lon_min, self.lon_max = lon_min, lon_max
+        self.lat_min, self.lat_max = lat_min, lat_max
+        self.depth_min, self.depth_max = depth_min, depth_max
+        self.derived = list(derived or [])
+        self.hidden = list(hidden or [])
+        self.dropna = dropna
+
+    def n_cells(self) -> int:
+        """
+        Number of lon x lat grid cells in the snapped bounding box
+        """
+        return bbox_cells(self.lon_min, self.lon_max, self.lat_min, self.lat_max, self.grid_size)
+
+def bbox_cells(lon_min: float, lon_max: float, lat_min: float, lat_max: float, grid_size: float) -> int:
+    n_lon = math.floor((lon_max - lon_min) / grid_size) + 1
+    n_lat = math.floor((lat_max - lat_min) / grid_size) + 1
+    return n_lon * n_lat
+
+def grid_index_slice(coords, vmin: float, vmax: float) -> slice:
+    """
+    Integer index slice of a regular (constant step) coordinate that covers [vmin, vmax],
+    i.e. the same cells as `ds.sel(dim=slice(vmin, vmax))`, computed by index arithmetic.
+    """
+    size = len(coords)
+    if size == 0:
+        return slice(0, 0)
+    first = float(coords[0])
+    step = float(coords[1]) - first if size > 1 else 1.0
+    i0 = max(math.ceil((vmin - first) / step), 0)
+    i1 = min(math.floor((vmax - first) / step), size - 1)
+    return slice(i0, max(i1 + 1, i0))
+
+def depth_index_slice(depths, dmin: float, dmax: float) -> slice:
+    """
+    Integer index slice of the (irregular, ascending) depth levels within [dmin, dmax]
+    """
+    depths = np.asarray(depths, dtype=np.float64)
+    i0 = int(np.searchsorted(depths, dmin, side='left'))
+    i1 = int(np.searchsorted(depths, dmax, side='right'))
+    return slice(i0, max(i1, i0))
+
+class GroupSelection:
+    """
+    Integer-index selection of a query plan in one zarr group. Labels are kept in the order
+    the result is built in: time periods, then parameters, for each statistic variable present.
+    Values are read from `read_path`: the group itself or a copy of it in another chunk layout.
+    `derived` parameters are computed from the group's parameters, the `hidden` ones are read only for them.
+    Depth levels from `valid_depth_stop` (absolute index, from the group's ocean mask) on hold no values in the
+    selected columns and are not read. `backend` names the woa23_backend.QueryBackend that reads the values.
+    """
+    def __init__(self, zarr_group_path, ds, tp_labels, param_labels, variables, lon_sl, lat_sl, depth_sl):
+        self.zarr_group_path = zarr_group_path
+        self.read_path = zarr_group_path
+        self.tp_labels = [str(tp) for tp in tp_labels]
+        self.param_labels = [str(p) for p in param_labels]
+        self.variables = list(variables)
+        self.tp_idx = [ds.indexes['time_periods'].get_loc(tp) for tp in tp_labels]
+        self.p_idx = [ds.indexes['parameters'].get_loc(p) for p in param_labels]
+        self.lon_sl, self.lat_sl, self.depth_sl = lon_sl, lat_sl, depth_sl
+        self.lons = np.asarray(ds['lon'].values[lon_sl], dtype=np.float32)
+        self.lats = np.asarray(ds['lat'].values[lat_sl], dtype=np.float32)
+        self.depths = np.asarray(ds['depth'].values[depth_sl], dtype=np.float32)
+        self.direct_readable = True
+        self.derived = []
+        self.hidden = []
+        self.valid_depth_stop = None
+        self.backend = 'zarr'
+
+    def is_empty(self) -> bool:
+        return min(len(self.tp_labels), len(self.param_labels), len(self.depths), len(self.lats), len(self.lons)) == 0
+
+    def key(self) -> tuple:
+        """
+        Hashable identity of the selected cells, used to normalize queries (e.g. for response caching)
+        """
+        return (self.zarr_group_path, tuple(self.tp_labels), tuple(self.param_labels), tuple(self.variables),
+                (self.lon_sl.start, self.lon_sl.stop), (self.lat_sl.start, self.lat_sl.stop),
+                (self.depth_sl.start, self.depth_sl.stop), tuple(self.derived), tuple(self.hidden))
+
+    def crop(self, lat_sl: slice, lon_sl: slice, depth_sl: slice):
+        """
+        Narrow the selection to sub-slices (absolute indices) of its lat, lon and depth slices
+        """
+        self.lats = self.lats[lat_sl.start - self.lat_sl.start:lat_sl.stop - self.lat_sl.start]
+        self.lons = self.lons[lon_sl.start - self.lon_sl.start:lon_sl.stop - self.lon_sl.start]
+        self.depths = self.depths[depth_sl.start - self.depth_sl.start:depth_sl.stop - self.depth_sl.start]
+        self.lat_sl, self.lon_sl, self.depth_sl = lat_sl, lon_sl, depth_sl
+        return self
+
+    def output_params(self, var: str) -> list:
+        """
+        Parameters of the result for one statistic variable: the parameters read, less the hidden ones, then the derived ones
+        """
+        params = [p for p in self.param_labels if p not in self.hidden]
+        return params + (self.derived if var in derivable_vars else [])
+
+    def slab_keys(self) -> list:
+        """
+        (time_period, depth) keys of the lat x lon slabs covered, in result order
+        """
+        return [(tp, float(dep)) for tp in self.tp_labels for dep in self.depths]
+
+    def lat_bands(self, chunk_lat: int) -> list:
+        """
+        Copies of the selection over consecutive latitude bands aligned to chunks of `chunk_lat` rows
+        """
+        bands = []
+        start = self.lat_sl.start
+        while start < self.lat_sl.stop:
+            stop = min((start // chunk_lat + 1) * chunk_lat, self.lat_sl.stop)
+            band = copy.copy(self)
+            band.lat_sl = slice(start, stop)
+            band.lats = self.lats[start - self.lat_sl.start:stop - self.lat_sl.start]
+            bands.append(band)
+            start = stop
+        return bands
+
+def select_group(plan: QueryPlan, zarr_group_path: str, ds):
+    """
+    Turn the plan into integer indices of one opened group. Returns None if the group holds none of the
+    requested parameters, periods or statistics.
+    """
+    # Ensure the selected parameters/periods exist in the dataset (keeping the order of the plan)
+    existing_params = set(ds.coords['parameters'].values)
+    selected_params = [p for p in plan.pars if p in existing_params]
+    if not selected_params:
+        return None
+
+    existing_periods = set(ds.coords['time_periods'].values)
+    selected_periods = [tp for tp in plan.periods if tp in existing_periods]
+    if not selected_periods:
+        return None
+
+    present_vars = [var for var in plan.variables if var in ds.data_vars]
+    if not present_vars:
+        return None
+
+    sel = GroupSelection(
+        zarr_group_path, ds, selected_periods, selected_params, present_vars,
+        grid_index_slice(ds['lon'].values, plan.lon_min, plan.lon_max),
+        grid_index_slice(ds['lat'].values, plan.lat_min, plan.lat_max),
+        depth_index_slice(ds['depth'].values, plan.depth_min, plan.depth_max)
+    )
+    sel.derived = [name for name in plan.derived if all(src in selected_params for src in derived_parameters[name])]
+    sel.hidden = [p for p in selected_params if p in plan.hidden]
+    return sel
+
+def chunks_spanned(idx, chunk: int) -> int:
+    """
+    Number of chunks (of size `chunk` along one dimension) holding the given indices or index slice
+    """
+    if isinstance(idx, slice):
+        if idx.stop <= idx.start:
+            return 0
+        return (idx.stop - 1) // chunk - idx.start // chunk + 1
+    return len(set(i // chunk for i in idx))
+
+class QueryCost:
+    """
+    Estimated size of a query, computed from its selections before any data is read:
+    output rows/columns, values read (cells), zarr chunks touched and output bytes (as float32 values)
+    """
+    def __init__(self, rows: int, columns: int, cells: int, chunks: int):
+        self.rows = rows
+        self.columns = columns
+        self.cells = cells
+        self.chunks = chunks
+        self.bytes = rows * columns * 4
+
+    def header(self) -> str:
+        return f"rows={self.rows}; columns={self.columns}; cells={self.cells}; chunks={self.chunks}; bytes={self.bytes}"
+
+def estimate_query_cost(selections: list, variables: list, chunk_shapes: dict) -> QueryCost:
+    """
+    Estimate the cost of reading `selections`. `chunk_shapes` maps (read_path, var) to the
+    zarr chunk shape of that variable (DIMS order); variables without a known shape count one chunk per value.
+    """
+    selections = [sel for sel in selections if not sel.is_empty()]
+    slabs = set()
+    cells = chunks = 0
+    for sel in selections:
+        slabs.update(sel.slab_keys())
+        n_value = len(sel.tp_idx) * len(sel.p_idx) * len(sel.depths) * len(sel.lats) * len(sel.lons)
+        for var in sel.variables:
+            cells += n_value
+            shape = chunk_shapes.get((sel.read_path, var))
+            if shape is None:
+                chunks += n_value
+                continue
+            chunks += (chunks_spanned(sel.tp_idx, shape[0]) * chunks_spanned(sel.p_idx, shape[1]) *
+                       chunks_spanned(sel.depth_sl, shape[2]) * chunks_spanned(sel.lat_sl, shape[3]) *
+                       chunks_spanned(sel.lon_sl, shape[4]))
+    n_cell = len(selections[0].lats) * len(selections[0].lons) if selections else 0
+    n_column = 4 + len(result_columns(selections, variables))
+    return QueryCost(len(slabs) * n_cell, n_column, cells, chunks)
+
+class QueryBlock:
+    """
+    Values read for a (time_periods x depth) part of a GroupSelection, per statistic variable, shaped in
+    PARAM_MAJOR_DIMS order so that the values of one parameter are a contiguous (time_periods, depth, lat, lon) buffer.
+    """
+    def __init__(self, tp_labels, param_labels, depths, lons, lats):
+        self.tp_labels = [str(tp) for tp in tp_labels]
+        self.param_labels = [str(p) for p in param_labels]
+        self.depths = np.asarray(depths, dtype=np.float32)
+        self.lons = np.asarray(lons, dtype=np.float32)
+        self.lats = np.asarray(lats, dtype=np.float32)
+        self.arrays = {}  # var -> ndarray (P, T, D, La, Lo)
+
+    def is_empty(self) -> bool:
+        return min(len(self.tp_labels), len(self.param_labels), len(self.depths), len(self.lats), len(self.lons)) == 0
+
+def read_zarr_block(zarr_arrays: dict, tp_idx, p_idx, depth_sl, lat_sl: slice, lon_sl: slice) -> dict:
+    """
+    Read only the chunks covering the selection directly from zarr arrays (no xarray/dask),
+    with the zarr fill value masked to NaN. Arrays are returned in PARAM_MAJOR_DIMS order.
+    """
+    data = {}
+    for var, zarr_array in zarr_arrays.items():
+        values = zarr_array.oindex[list(tp_idx), list(p_idx), depth_sl, lat_sl, lon_sl]
+        fill_value = zarr_array.fill_value
+        if fill_value is not None and not np.isnan(fill_value):
+            values = np.where(values == fill_value, np.float32(np.nan), values)
+        data[var] = np.ascontiguousarray(np.moveaxis(values, 1, 0))
+    return data
+
+def read_selection_block(sel: GroupSelection, tp_pos: list = None, depth_pos: list = None,
+                         zarr_arrays: dict = None, ds=None, backend=None) -> QueryBlock:
+    """
+    Read a selection (or the given time period/depth positions of it) into a QueryBlock, either directly
+    from `zarr_arrays` (var -> zarr.Array), through the opened xarray dataset `ds` or from a `backend`
+    (woa23_backend.QueryBackend)
+    """
+    if tp_pos is None:
+        tp_pos = list(range(len(sel.tp_labels)))
+    if depth_pos is None:
+        depth_index = sel.depth_sl
+        depths = sel.depths
+    else:
+        depth_index = [sel.depth_sl.start + di for di in depth_pos]
+        depths = sel.depths[depth_pos]
+    tp_idx = [sel.tp_idx[ti] for ti in tp_pos]
+    block = QueryBlock([sel.tp_labels[ti] for ti in tp_pos], sel.param_labels, depths, sel.lons, sel.lats)
+    if block.is_empty():
+        return block
+
+    # Levels below the deepest sea floor of the selected columns are not read: their values are all NaN
+    n_read = len(depths)
+    if sel.valid_depth_stop is not None:
+        if isinstance(depth_index, slice):
+            depth_index = slice(depth_index.start, max(depth_index.start, min(depth_index.stop, sel.valid_depth_stop)))
+            n_read = depth_index.stop - depth_index.start
+        else:
+            # depth positions are ascending, so the levels read are the first ones
+            depth_index = [di for di in depth_index if di < sel.valid_depth_stop]
+            n_read = len(depth_index)
+    if n_read == len(depths):
+        block.arrays = _read_arrays(sel, tp_idx, depth_index, zarr_arrays, ds, backend)
+        return block
+
+    shape = (len(sel.p_idx), len(tp_idx), len(depths), len(sel.lats), len(sel.lons))
+    block.arrays = {var: np.full(shape, np.nan, dtype=np.float32) for var in sel.variables}
+    if n_read > 0:
+        for var, values in _read_arrays(sel, tp_idx, depth_index, zarr_arrays, ds, backend).items():
+            block.arrays[var][:, :, :n_read] = values
+    return block
+
+def read_ds_block(ds, variables: list, tp_idx, p_idx, depth_index, lat_sl: slice, lon_sl: slice) -> dict:
+    """
+    Read the selection through the opened xarray dataset `ds`, arrays in PARAM_MAJOR_DIMS order
+    """
+    # Parameter-major order makes every {param}_{var} column one contiguous buffer
+    loaded = ds[variables].isel(
+        time_periods=tp_idx,
+        parameters=p_idx,
+        depth=depth_index,
+        lat=lat_sl,
+        lon=lon_sl
+    ).transpose(*PARAM_MAJOR_DIMS).compute()
+    return {var: loaded[var].values for var in variables}
+
+def _read_arrays(sel: GroupSelection, tp_idx: list, depth_index, zarr_arrays: dict = None, ds=None, backend=None) -> dict:
+    if backend is not None:
+        return backend.read_arrays(sel, tp_idx, depth_index)
+    if zarr_arrays is not None:
+        return read_zarr_block(zarr_arrays, tp_idx, sel.p_idx, depth_index, sel.lat_sl, sel.lon_sl)
+    return read_ds_block(ds, sel.variables, tp_idx, sel.p_idx, depth_index, sel.lat_sl, sel.lon_sl)
+
+def is_direct_readable(zarr_array) -> bool:
+    """
+    True if raw zarr values equal xarray-decoded values (no scale/offset, DIMS order, float data)
+    """
+    attrs = zarr_array.attrs
+    return (tuple(attrs.get('_ARRAY_DIMENSIONS', ())) == DIMS
+            and 'scale_factor' not in attrs and 'add_offset' not in attrs
+            and np.issubdtype(zarr_array.dtype, np.floating))
+
+def result_columns(selections: list, variables: list) -> list:
+    """
+    Value column names ({param}_{var}) of the wide result, in order of first appearance
+    """
+    columns = {}
+    for sel in selections:
+        if sel.is_empty():
+            continue
+        for var in variables:
+            if var in sel.variables:
+                for param in sel.output_params(var):
+                    columns.setdefault(f"{param}_{var}", None)
+    return list(columns)
+
+def iter_slab_batches(selections: list, max_rows: int):
+    """
+    Split the result into batches of consecutive (time_period, depth) slabs with at most `max_rows` rows
+    (at least one slab). Yields, per batch, a list of (selection, tp positions, depth indices) parts whose
+    blocks assemble to exactly the rows of that batch, in result order.
+    """
+    selections = [sel for sel in selections if not sel.is_empty()]
+    if not selections:
+        return
+    n_cell = len(selections[0].lats) * len(selections[0].lons)
+    slabs_per_batch = max(1, max_rows // n_cell)
+
+    slab_index = {}
+    for sel in selections:
+        for key in sel.slab_keys():
+            slab_index.setdefault(key, len(slab_index))
+
+    for start in range(0, len(slab_index), slabs_per_batch):
+        stop = start + slabs_per_batch
+        parts = []
+        for sel in selections:
+            for ti, tp in enumerate(sel.tp_labels):
+                depth_idx = [di for di, dep in enumerate(sel.depths) if start <= slab_index[(tp, float(dep))] < stop]
+                if depth_idx:
+                    parts.append((sel, [ti], depth_idx))
+        yield parts
+
+def float_column(name: str, values) -> pl.Series:
+    """
+    Float32 column with NaN as null; the contiguous numpy buffer is handed to polars through Arrow without a copy
+    """
+    values = np.ascontiguousarray(values, dtype=np.float32).reshape(-1)
+    return pl.from_arrow(pa.array(values, mask=np.isnan(values))).alias(name)
+
+def assemble_wide(blocks: list, variables: list, columns: list = None, dropna: bool = False) -> pl.DataFrame:
+    """
+    Build the wide result (lon, lat, depth, time_periods, {param}_{var}...) directly from dense blocks.
+    Rows and columns come out in the same order as concatenating the long per-(var, group) frames and
+    pivoting them: rows are (time_period, depth) slabs of lat x lon cells in order of first appearance,
+    columns in order of first appearance of {param}_{var}. NaN becomes null.
+    If `columns` is given, exactly these value columns are returned (all-null where no block has them).
+    `dropna` leaves out the rows where all value columns are NaN, before any column is built.
+    """
+    blocks = [b for b in blocks if not b.is_empty() and any(var in b.arrays for var in variables)]
+    if not blocks:
+        schema = {'lon': pl.Float32, 'lat': pl.Float32, 'depth': pl.Float32, 'time_periods': pl.String}
+        schema.update({name: pl.Float32 for name in (columns or [])})
+        return pl.DataFrame(schema=schema)
+
+    # All blocks of one query share the same lat/lon selection (same grid)
+    lons, lats = blocks[0].lons, blocks[0].lats
+    n_cell = len(lats) * len(lons)
+
+    slab_index = {}
+    block_slabs = []
+    for b in blocks:
+        idx = []
+        for tp in b.tp_labels:
+            for dep in b.depths:
+                idx.append(slab_index.setdefault((tp, float(dep)), len(slab_index)))
+        block_slabs.append(np.asarray(idx, dtype=np.int64))
+    n_slab = len(slab_index)
+    slab_tps = [k[0] for k in slab_index]
+    slab_depths = np.asarray([k[1] for k in slab_index], dtype=np.float32)
+
+    values_of = {}
+    single = len(blocks) == 1
+    for b, slabs in zip(blocks, block_slabs):
+        for var in variables:
+            if var not in b.arrays:
+                continue
+            values = b.arrays[var]
+            for pi, param in enumerate(b.param_labels):
+                name = f"{param}_{var}"
+                part = values[pi].reshape(len(slabs), n_cell)
+                if single:
+                    values_of.setdefault(name, part)
+                    continue
+                if name not in values_of:
+                    values_of[name] = np.full((n_slab, n_cell), np.nan, dtype=np.float32)
+                values_of[name][slabs] = part
+
+    if columns is None:
+        columns = list(values_of)
+    n_row = n_slab * n_cell
+    slab_of_row = np.repeat(np.arange(n_slab), n_cell)
+    lon_of_row = np.tile(lons, n_slab * len(lats))
+    lat_of_row = np.tile(np.repeat(lats, len(lons)), n_slab)
+    if dropna:
+        keep = np.zeros(n_row, dtype=bool)
+        for name in columns:
+            if name in values_of:
+                keep |= ~np.isnan(values_of[name].reshape(-1))
+        rows = np.flatnonzero(keep)
+        n_row = len(rows)
+        slab_of_row, lon_of_row, lat_of_row = slab_of_row[rows], lon_of_row[rows], lat_of_row[rows]
+        values_of = {name: values.reshape(-1)[rows] for name, values in values_of.items()}
+    return pl.DataFrame([
+        pl.Series('lon', lon_of_row),
+        pl.Series('lat', lat_of_row),
+        pl.Series('depth', slab_depths[slab_of_row]),
+        pl.Series('time_periods', slab_tps, dtype=pl.String).gather(slab_of_row),
+    ] + [
+        float_column(name, values_of[name]) if name in values_of else pl.Series(name, [None] * n_row, dtype=pl.Float32)
+        for name in columns
+    ])
+
+def finalize_columns(result_df: pl.DataFrame, plan: QueryPlan) -> pl.DataFrame:
+    # Optionally rename {param}_mn to {param} if `mn` is present in the query variables
+    if 'mn' in plan.variables:
+        rename_dict = {f"{param}_mn": param for param in plan.pars + plan.derived if f"{param}_mn" in result_df.columns}
+        if rename_dict:  # Check if there are columns to rename
+            result_df = result_df.rename(rename_dict)
+
+    return result_df.rename({"time_periods": "time_period"})
@@ -0,0 +1,94 @@
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+
+section_tracks = ['great_circle', 'lonlat']
+section_methods = ['nearest', 'bilinear']
+
+def parse_path(path: str, name: str = 'path', min_vertices: int = 2) -> np.ndarray:
+    """
+    Parse a polyline (or polygon) given as 'lon,lat;lon,lat;...' into a (n, 2) array
+    """
+    try:
+        vertices = np.asarray([[float(v) for v in vertex.split(',')] for vertex in path.strip().strip(';').split(';')], dtype=np.float64)
+    except ValueError:
+        raise ValueError(f"Invalid {name}. Expected 'lon,lat;lon,lat;...'")
+    if vertices.ndim != 2 or vertices.shape[1] != 2 or len(vertices) < min_vertices or not np.isfinite(vertices).all():
+        raise ValueError(f"Invalid {name}. Expected at least {min_vertices} 'lon,lat' vertices separated by ';'")
+    return vertices
+
+def wrap_lon(lons):
+    return (np.asarray(lons, dtype=np.float64) + 180.0) % 360.0 - 180.0
+
+def _unit_vectors(lons, lats):
+    lon, lat = np.radians(lons), np.radians(lats)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+def haversine_km(lon0, lat0, lon1, lat1):
+    lon0, lat0, lon1, lat1 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lon0, lat0, lon1, lat1))
+    h = np.sin((lat1 - lat0) / 2) ** 2 + np.cos(lat0) * np.cos(lat1) * np.sin((lon1 - lon0) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+def sample_path(vertices, spacing_km: float, track: str = 'great_circle'):
+    """
+    Sample a polyline every `spacing_km` (each segment split evenly, vertices always included).
+    Segments follow great circles, or straight lines in lon/lat for `track='lonlat'` (e.g. along a parallel;
+    longitudes beyond 180 cross the antimeridian). Returns lons (wrapped to [-180, 180)), lats and the distance
+    along the path in km of each sample.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    lons, lats, dists = [], [], []
+    offset = 0.0
+    for (lon0, lat0), (lon1, lat1) in zip(vertices[:-1], vertices[1:]):
+        if track == 'great_circle':
+            a, b = _unit_vectors(np.array([lon0, lon1]), np.array([lat0, lat1]))
+            angle = np.arctan2(np.linalg.norm(np.cross(a, b)), np.dot(a, b))
+            length = angle * EARTH_RADIUS_KM
+        else:
+            length = haversine_km(lon0, lat0, lon1, lat1)
+        n = max(1, int(np.ceil(length / spacing_km)))
+        f = np.arange(n) / n
+        if track == 'great_circle':
+            if angle > 0:
+                xyz = (np.sin((1 - f) * angle)[:, None] * a + np.sin(f * angle)[:, None] * b) / np.sin(angle)
+            else:
+                xyz = np.repeat(a[None], n, axis=0)
+            seg_lons = np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0]))
+            seg_lats = np.degrees(np.arcsin(np.clip(xyz[:, 2], -1.0, 1.0)))
+            seg_dists = offset + f * length
+            offset += length
+        else:
+            seg_lons = lon0 + f * (lon1 - lon0)
+            seg_lats = lat0 + f * (lat1 - lat0)
+            ends_lon, ends_lat = np.append(seg_lons, lon1), np.append(seg_lats, lat1)
+            steps = haversine_km(ends_lon[:-1], ends_lat[:-1], ends_lon[1:], ends_lat[1:])
+            seg_dists = offset + np.concatenate([[0.0], np.cumsum(steps)[:-1]])
+            offset += steps.sum()
+        lons.append(seg_lons)
+        lats.append(seg_lats)
+        dists.append(seg_dists)
+    lons.append([vertices[-1, 0]])
+    lats.append([vertices[-1, 1]])
+    dists.append([offset])
+    return wrap_lon(np.concatenate(lons)), np.concatenate(lats), np.concatenate(dists)
+
+def section_arrays(blocks: list, variables: list, columns: list, n_sample: int):
+    """
+    Dense section of each result column as a (time_period, depth, distance) array, over the time periods
+    (in order of first appearance) and the union of the depth levels of the blocks (PointBlocks of the samples)
+    """
+    tp_axis = []
+    for b in blocks:
+        tp_axis += [tp for tp in b.tp_labels if tp not in tp_axis]
+    depth_axis = np.unique(np.concatenate([b.depths for b in blocks])) if blocks else np.zeros(0, dtype=np.float32)
+    arrays = {name: np.full((len(tp_axis), len(depth_axis), n_sample), np.nan, dtype=np.float32) for name in columns}
+    for b in blocks:
+        t_pos = np.asarray([tp_axis.index(tp) for tp in b.tp_labels], dtype=np.int64)
+        d_pos = np.searchsorted(depth_axis, b.depths)
+        for var in variables:
+            if var not in b.arrays:
+                continue
+            for pi, param in enumerate(b.param_labels):
+                if f"{param}_{var}" in arrays:
+                    arrays[f"{param}_{var}"][np.ix_(t_pos, d_pos)] = b.arrays[var][pi]
+    return tp_axis, depth_axis, arrays
@@ -75,3 +75,96 @@ def calculate_sea_density(temperature, salinity, pressure, sigma0=False):
 
     return density
 
+
+# EOS-80 coefficients of `calculate_sea_density` as Horner polynomials in temperature (highest power first)
+_RHO_A = (6.536332e-9, -1.120083e-6, 1.001685e-4, -9.09529e-3, 6.793952e-2, 999.842594)
+_RHO_B = (5.3875e-9, -8.2467e-7, 7.6438e-5, -4.0899e-3, 0.824493)
+_RHO_C = (-1.6546e-6, 1.0227e-4, -5.72466e-3)
+_RHO_D = 4.8314e-4
+_K_W = (-5.155288e-5, 1.360477e-2, -2.327105, 148.4206, 19652.21)
+_K_S = (-6.167e-5, 1.09987e-2, -0.603459, 54.6746)
+_K_S15 = (-5.3009e-4, 1.6483e-2, 7.944e-2)
+_A_W = (-5.77905e-7, 1.16092e-4, 1.43713e-3, 3.239908)
+_A_S = (-1.6078e-6, -1.0981e-5, 2.2838e-3)
+_A_S15 = 1.91075e-4
+_B_W = (5.2787e-8, -6.12293e-6, 8.50935e-5)
+_B_S = (9.1697e-10, 2.0816e-8, -9.9348e-7)
+
+def _horner(x, coefs, out):
+    out.fill(coefs[0])
+    for c in coefs[1:]:
+        out *= x
+        out += c
+    return out
+
+def sea_density(temperature, salinity, pressure=0.0, sigma0=False, out=None, dtype=None, block_size=8192):
+    """
+    Same result as `calculate_sea_density` for numpy arrays, without its full-size temporaries: the inputs are
+    broadcast and walked in blocks of `block_size` values (np.nditer), and every polynomial is evaluated in
+    Horner form in place on a few float64 scratch buffers. Pressure in dbar (scalar 0 skips the pressure term).
+    Returns `out` if given, else a new array of `dtype` (default float64).
+    """
+    import numpy as np
+
+    with_pressure = not (np.ndim(pressure) == 0 and float(pressure) == 0.0)
+    out_dtype = out.dtype if out is not None else np.dtype(dtype or np.float64)
+    it = np.nditer([temperature, salinity, pressure, out],
+                   flags=['external_loop', 'buffered', 'zerosize_ok'],
+                   op_flags=[['readonly'], ['readonly'], ['readonly'], ['writeonly', 'allocate', 'no_broadcast']],
+                   op_dtypes=[np.float64, np.float64, np.float64, out_dtype],
+                   casting='same_kind', buffersize=block_size)
+    scratch = np.empty((5, block_size), dtype=np.float64)
+    with it:
+        for t, s, p, o in it:
+            n = len(t)
+            rho, b, c, sq, f = (buf[:n] for buf in scratch)
+            np.sqrt(s, out=sq)
+            # rho0 = A(t) + S * (B(t) + sqrt(S) * C(t) + d * S)
+            _horner(t, _RHO_C, c)
+            c *= sq
+            _horner(t, _RHO_B, b)
+            b += c
+            np.multiply(s, _RHO_D, out=c)
+            b += c
+            b *= s
+            _horner(t, _RHO_A, rho)
+            rho += b
+            if with_pressure:
+                # secant bulk modulus K = Kw + S * (Ks + sqrt(S) * Ks15) + P * (Ah + P * Bh), P in bar
+                _horner(t, _B_S, c)
+                c *= s
+                _horner(t, _B_W, b)
+                b += c
+                _horner(t, _A_S, f)
+                np.multiply(sq, _A_S15, out=c)
+                f += c
+                f *= s
+                _horner(t, _A_W, c)
+                f += c
+                np.multiply(p, 0.1, out=c)
+                b *= c
+                b += f
+                b *= c
+                _horner(t, _K_S15, f)
+                f *= sq
+                f += _horner(t, _K_S, sq)
+                f *= s
+                f += _horner(t, _K_W, sq)
+                b += f
+                # rho = rho0 / (1 - P / K)
+                np.divide(c, b, out=c)
+                np.subtract(1.0, c, out=c)
+                rho /= c
+            if sigma0:
+                rho -= 1000
+            o[...] = rho
+        return it.operands[3]
+
+def depth_to_pressure(depth, lat):
+    """
+    Pressure (dbar) at depth (m) and latitude (degrees), after Saunders (1981)
+    """
+    import numpy as np
+
+    c1 = 5.92e-3 + 5.25e-3 * np.sin(np.radians(lat)) ** 2
+    return ((1 - c1) - np.sqrt((1 - c1) ** 2 - 8.84e-6 * depth)) / 4.42e-6
@@ -0,0 +1,138 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import xarray as xr
+import zarr
+
+def signature_version(signature: tuple) -> str:
+    return hashlib.sha1(repr(signature).encode()).hexdigest()[:16]
+
+class ZarrDatasetCache:
+    """
+    Process-wide, bounded LRU cache of opened Zarr groups (xarray Datasets) keyed by group path.
+    A cached handle is re-opened when the store on disk changes (checked at most every `check_interval` seconds).
+    """
+    def __init__(self, maxsize: int = 32, check_interval: float = 5.0):
+        self.maxsize = maxsize
+        self.check_interval = check_interval
+        self._entries = OrderedDict()  # path -> [ds, signature, last_checked, {var: zarr.Array}]
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    @staticmethod
+    def store_signature(zarr_group_path: str) -> tuple:
+        """
+        Cheap fingerprint of a Zarr group on disk: mtimes of the group directory and its direct entries.
+        Chunk (re)writes replace files inside the variable directories, which bumps their mtime.
+        """
+        entries = [('', os.stat(zarr_group_path).st_mtime_ns)]
+        with os.scandir(zarr_group_path) as it:
+            for entry in it:
+                entries.append((entry.name, entry.stat().st_mtime_ns))
+        return tuple(sorted(entries))
+
+    @classmethod
+    def store_version(cls, zarr_group_path: str) -> str:
+        """
+        Version of a Zarr group as currently on disk (same digest as `version`), e.g. for ingestion scripts
+        """
+        return signature_version(cls.store_signature(zarr_group_path))
+
+    def _open(self, zarr_group_path: str):
+        signature = self.store_signature(zarr_group_path)
+        ds = xr.open_zarr(zarr_group_path)
+        self._entries[zarr_group_path] = [ds, signature, time.monotonic(), {}]
+        self._entries.move_to_end(zarr_group_path)
+        while len(self._entries) > self.maxsize:
+            _, old_entry = self._entries.popitem(last=False)
+            old_entry[0].close()
+            self.evictions += 1
+        return ds
+
+    def _is_stale(self, zarr_group_path: str, entry: list) -> bool:
+        now = time.monotonic()
+        if now - entry[2] < self.check_interval:
+            return False
+        entry[2] = now
+        try:
+            return self.store_signature(zarr_group_path) != entry[1]
+        except FileNotFoundError:
+            return True
+
+    def get(self, zarr_group_path: str):
+        """
+        Return the opened dataset for `zarr_group_path`, opening (or re-opening a stale one) on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(zarr_group_path)
+            if entry is not None:
+                if not self._is_stale(zarr_group_path, entry):
+                    self.hits += 1
+                    self._entries.move_to_end(zarr_group_path)
+                    return entry[0]
+                self.invalidate(zarr_group_path)
+            self.misses += 1
+            return self._open(zarr_group_path)
+
+    def get_array(self, zarr_group_path: str, var: str):
+        """
+        Return the raw zarr.Array of `var` in a cached group (None if the group has no such variable),
+        for direct chunk reads that bypass xarray/dask
+        """
+        ds = self.get(zarr_group_path)
+        with self._lock:
+            arrays = self._entries[zarr_group_path][3]
+            if var not in arrays:
+                arrays[var] = zarr.open_array(f"{zarr_group_path}/{var}", mode='r') if var in ds.data_vars else None
+            return arrays[var]
+
+    def version(self, zarr_group_path: str) -> str:
+        """
+        Short hex digest of the store signature the cached handle was opened with
+        """
+        with self._lock:
+            entry = self._entries.get(zarr_group_path)
+            signature = entry[1] if entry is not None else self.store_signature(zarr_group_path)
+        return signature_version(signature)
+
+    def preload(self, zarr_group_paths):
+        """
+        Open all existing groups in `zarr_group_paths` ahead of the first request
+        """
+        loaded = 0
+        for zarr_group_path in zarr_group_paths:
+            if os.path.isdir(zarr_group_path):
+                with self._lock:
+                    if zarr_group_path not in self._entries:
+                        self._open(zarr_group_path)
+                        loaded += 1
+        return loaded
+
+    def invalidate(self, zarr_group_path: str = None):
+        """
+        Drop one cached handle, or all of them if no path is given
+        """
+        with self._lock:
+            paths = list(self._entries) if zarr_group_path is None else [zarr_group_path]
+            for path in paths:
+                entry = self._entries.pop(path, None)
+                if entry is not None:
+                    entry[0].close()
+                    self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions,
+                'groups': list(self._entries),
+            }
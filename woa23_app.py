@@ -1,20 +1,50 @@
-import xarray as xr
-import pandas as pd
 import numpy as np
 import polars as pl
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Query, HTTPException, Request
 from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi.openapi.utils import get_openapi
-from fastapi.responses import JSONResponse, ORJSONResponse, FileResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, Response, StreamingResponse, FileResponse
 from contextlib import asynccontextmanager
-from typing import Optional, List
-from tempfile import NamedTemporaryFile
-import json, math
+from typing import Optional, List, Annotated
+from pydantic import BaseModel, Field
+import math, os
+import logging
+import orjson
 from datetime import datetime
 # from dask.distributed import Client
 # client = Client('tcp://localhost:8786')
 from src.dask_client_manager import get_dask_client
+from src.zarr_cache import ZarrDatasetCache
+from src.query_executor import QueryExecutor, QueryQueueFull, QueryBudgetExceeded
+from src.woa23_output import output_formats, iter_encoded, read_frame
+from src.response_cache import ResponseCache, make_etag, etag_matches
+from src.export_jobs import ExportJobManager, export_formats
+from src.woa23_points import snap_to_grid_index, unique_cells, read_zarr_cells, read_ds_cells, PointBlock, assemble_points, estimate_cells_cost, grid_neighbours, depth_neighbours, interpolate_cells, cells_read_cost, bilinear_cells
+from src.woa23_derived import derived_parameters, derivable_vars, derive_block, compute_derived, SlabCache
+from src.woa23_utils import depth_to_pressure
+from src.woa23_aggregate import ProfileAggregator, polygon_mask, area_weights
+from src.woa23_pyramid import pyramid_level_dir, select_level
+from src.woa23_mask import OceanMasks
+from src.woa23_backend import QueryBackend, ZarrBackend, ColumnarBackend, ColumnarExports, zarr_read_cells, columnar_read_cells
+from src.woa23_section import section_tracks, section_methods, parse_path, wrap_lon, sample_path, section_arrays
+from src.woa23_query import QueryPlan, GroupSelection, QueryBlock, select_group, read_selection_block, finalize_columns, bbox_cells, is_direct_readable, result_columns, iter_slab_batches, assemble_wide, QueryCost, estimate_query_cost, float_column
+from src.config import ZARR_CACHE_SIZE, ZARR_CACHE_CHECK_INTERVAL, FAST_PATH_MAX_CELLS, QUERY_MAX_WORKERS, QUERY_MAX_QUEUE, STREAM_BATCH_ROWS, RESPONSE_CACHE_BYTES, RESPONSE_CACHE_MAX_ENTRY
+from src.config import LON_RANGE_LIMIT, LAT_RANGE_LIMIT, AREA_LIMIT, QUERY_MAX_CHUNKS, QUERY_MAX_BYTES, QUERY_JSON_MAX_BYTES, QUERY_INFLIGHT_BYTES
+from src.config import PROFILE_LAYOUT_MAX_CELLS, POINTS_MAX_POINTS, MATCHUP_MAX_ROWS, SECTION_MAX_SAMPLES, DERIVED_CACHE_BYTES, EXPORT_RESULTS_DIR, EXPORT_BATCH_ROWS, EXPORT_MAX_BYTES, EXPORT_JOB_TTL, EXPORT_JOB_STALL_TIMEOUT
+from src.config import PYRAMID_LEVELS, PYRAMID_AUTO_MAX_CELLS, QUERY_BACKEND, COLUMNAR_COST_FACTOR
 client = get_dask_client("woa23api")
+zarr_cache = ZarrDatasetCache(maxsize=ZARR_CACHE_SIZE, check_interval=ZARR_CACHE_CHECK_INTERVAL)
+# Query execution runs off the event loop with bounded concurrency
+query_executor = QueryExecutor(max_workers=QUERY_MAX_WORKERS, max_queue=QUERY_MAX_QUEUE, max_inflight_bytes=QUERY_INFLIGHT_BYTES)
+# Encoded responses of normalized queries, revalidated by ETag against the zarr store version
+response_cache = ResponseCache(max_bytes=RESPONSE_CACHE_BYTES, max_entry_bytes=RESPONSE_CACHE_MAX_ENTRY)
+# Derived parameter (density, sigma0) slabs, shared by all queries over the same selection
+derived_cache = SlabCache(max_bytes=DERIVED_CACHE_BYTES)
+ocean_masks = OceanMasks()
+columnar_exports = ColumnarExports()
+# Large extractions run as export jobs (Dask futures) writing files into the results directory
+export_jobs = ExportJobManager(client, EXPORT_RESULTS_DIR, batch_rows=EXPORT_BATCH_ROWS, ttl=EXPORT_JOB_TTL,
+                               stall_timeout=EXPORT_JOB_STALL_TIMEOUT)
 
 def generate_custom_openapi():
     if app.openapi_schema:
@@ -39,13 +69,36 @@ def generate_custom_openapi():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("App start at ", datetime.now())
+    zarr_group_paths = all_zarr_group_paths()
+    loaded = zarr_cache.preload(zarr_group_paths + [path.replace(zarr_store_path, profile_store_path, 1) for path in zarr_group_paths])
+    print(f"Preloaded {loaded} zarr groups into dataset cache")
     yield
     # below code to execute when app is shutting down
+    query_executor.shutdown()
+    zarr_cache.invalidate()
     client.close()
     print("App end at ", datetime.now())
 
 
 app = FastAPI(lifespan=lifespan, docs_url=None, default_response_class=ORJSONResponse)
+logger = logging.getLogger(__name__)
+
+# Errors raised by the query endpoints (HTTPException is answered as raised)
+@app.exception_handler(QueryQueueFull)
+async def query_queue_full_handler(request: Request, exc: QueryQueueFull):
+    return ORJSONResponse(status_code=503, content={"detail": f"Server busy: {exc}. Please try it later."})
+
+@app.exception_handler(QueryBudgetExceeded)
+async def query_budget_exceeded_handler(request: Request, exc: QueryBudgetExceeded):
+    return ORJSONResponse(status_code=429, content={"detail": f"{exc}. Please try it later."}, headers={"Retry-After": "10"})
+
+@app.exception_handler(ValueError)
+async def value_error_handler(request: Request, exc: ValueError):
+    return ORJSONResponse(status_code=400, content={"detail": str(exc)})
+
+@app.exception_handler(Exception)
+async def internal_error_handler(request: Request, exc: Exception):
+    return ORJSONResponse(status_code=500, content={"detail": "Internal server error. Please try it later or inform admin"})
 
 @app.get("/api/swagger/woa23/openapi.json", include_in_schema=False)
 async def custom_openapi():
@@ -61,6 +114,12 @@ async def custom_swagger_ui_html():
 
 # Path to your Zarr store
 zarr_store_path = "data/"
+# Optional copy of the store chunked for profiles (all depths in one chunk, small lat/lon tiles)
+profile_store_path = "data_profile/"
+# Optional coarsened overview levels of the store (pyramid) for map-scale queries
+pyramid_store_path = "data_pyramid/"
+# Optional GeoParquet export of the store (columnar query backend)
+columnar_store_path = "data_parquet/"
 
 # Initialize global definitions
 grid_resolutions = {'01': '1.00', '04': '0.25'}  # Two gridded resolutions data: 1-degree and 0.25-degree in WOA23
@@ -110,6 +169,21 @@ time_periods = {
 
 available_vars = ['an', 'mn', 'dd', 'ma', 'sd', 'se', 'oa', 'gp', 'sdo', 'sea']
 
+# Query parameters shared by the endpoints (defaults are set in each signature)
+Lon0Query = Annotated[Optional[float], Query(description="Minimum longitude, range: [-180, 180].")]
+Lat0Query = Annotated[Optional[float], Query(description="Minimum latitude, range: [-90, 90].")]
+Lon1Query = Annotated[Optional[float], Query(description="Maximum longitude, range: [-180, 180].")]
+Lat1Query = Annotated[Optional[float], Query(description="Maximum latitude, range: [-90, 90].")]
+Dep0Query = Annotated[Optional[float], Query(description="Minimum depth. Optional, default is 0.")]
+Dep1Query = Annotated[Optional[float], Query(description="Maximum depth. Optional, default is maximum depth 5500m in WOA23.")]
+GridQuery = Annotated[Optional[str], Query(description="Grid resoultion: 1 for 1-degree, 0.25 for 0.25-degree. Default is 1.")]
+AppendQuery = Annotated[Optional[str], Query(description=f"Statistics to append, separated by commas. Default is 'mn': Statistical mean. Allowed: {', '.join(available_vars)}.")]
+ParameterQuery = Annotated[Optional[str], Query(description="WOA23 parameteres, separated by commas. Default is 'temperature'. Allowed: temperature, salinity (both 0.25/1-degree data), oxygen, o2sat, AOU, silicate, phosphate, nitrate (only 1-degree data). Derived: density, sigma0 (from temperature and salinity).")]
+TimePeriodQuery = Annotated[Optional[str], Query(description="Time periods for statistics, separated by commas. Default is '0' (annual). Allowed: 0 (annual). 1-12 (monthly), 13-16 (seasonal).")]
+ResolutionQuery = Annotated[Optional[str], Query(description="Output grid size in degrees, served from coarsened (area-weighted mean) levels: 0.5, 1, 2, 5 for 0.25-degree data; 2, 5 for 1-degree data; or 'auto': the finest level within max_cells. Default is the native grid.")]
+MaxCellsQuery = Annotated[Optional[int], Query(ge=1, description=f"Maximum lon x lat cells per depth level for resolution=auto (implies auto). Default for auto is {PYRAMID_AUTO_MAX_CELLS}.")]
+DropnaQuery = Annotated[Optional[bool], Query(description="Leave out the rows without any value (land, below the sea floor). Default is false.")]
+
 def to_lowest_grid_point(lon: float, lat: float, grid_size: float) -> tuple:
     # Calculate the grid snapping offset based on grid size
     offset = 0.5 * grid_size
@@ -136,16 +210,204 @@ def determine_subgroup(param, period):
 
     return subgroup
 
+def all_zarr_group_paths():
+    paths = []
+    for grid_path in grid_dir.values():
+        for period_group in ['annual', 'monthly', 'seasonal']:
+            for param_group in ['TS', 'Oxy', 'Nutrients']:
+                paths.append(f"{zarr_store_path}/{grid_path}/{period_group}/{param_group}")
+    return paths
+
 def custom_json_serializer(obj):
     if isinstance(obj, float):
         if np.isnan(obj) or np.isinf(obj):
             return None
     return obj
 
-async def process_woa23_data(lon0: float, lat0: float, lon1: Optional[float], lat1: Optional[float], dep0: Optional[float], dep1: Optional[float], grid: Optional[str], append: Optional[str], parameter: Optional[str], time_period: Optional[str]):
-    init_time = datetime.now()
-    # start_time = datetime.now()
+def profile_layout_path(zarr_group_path: str):
+    """
+    Path of the profile-layout copy of a zarr group (built by dev/zarr_rechunk_profile_woa23.py),
+    or None if there is no copy or it was built from another version of the group
+    """
+    if not zarr_group_path.startswith(zarr_store_path):
+        return None  # pyramid levels have no profile layout
+    path = zarr_group_path.replace(zarr_store_path, profile_store_path, 1)
+    if not os.path.isdir(path):
+        return None
+    if zarr_cache.get(path).attrs.get('source_version') != zarr_cache.version(zarr_group_path):
+        return None
+    return path
+
+def columnar_export(zarr_group_path: str):
+    """
+    Listing of the GeoParquet export of a zarr group (built by dev/zarr_geoparquet_woa23.py),
+    or None if there is no export or it was written from another version of the group
+    """
+    if not zarr_group_path.startswith(zarr_store_path):
+        return None  # pyramid levels have no export
+    return columnar_exports.get(zarr_group_path.replace(zarr_store_path, columnar_store_path, 1), zarr_cache.version(zarr_group_path))
+
+def pyramid_levels(grid: str, zarr_group_paths: list) -> dict:
+    """
+    Coarsened levels of the given zarr groups (built by dev/zarr_pyramid_woa23.py) that exist for all of them and are
+    up to date with their source group: grid size -> zarr group paths, finest first
+    """
+    levels = {}
+    native_prefix = f"{zarr_store_path}/{grid_dir[grid]}/"
+    for grid_size in PYRAMID_LEVELS.get(grid, []):
+        paths = [path.replace(native_prefix, f"{pyramid_store_path}/{grid_dir[grid]}/{pyramid_level_dir(grid_size)}/", 1) for path in zarr_group_paths]
+        if all(os.path.isdir(path) and zarr_cache.get(path).attrs.get('source_version') == zarr_cache.version(src)
+               for path, src in zip(paths, zarr_group_paths)):
+            levels[grid_size] = paths
+    return levels
+
+def snap_bbox(lon0: float, lat0: float, lon1: Optional[float], lat1: Optional[float], grid_size: float) -> tuple:
+    """
+    Bounding box (lon_min, lon_max, lat_min, lat_max) snapped to the cell centers of a grid
+    """
+    if lon1 is None or lat1 is None or (lon0 == lon1 and lat0 == lat1):
+        # Only one point
+        lon0, lat0 = to_lowest_grid_point(lon0, lat0, grid_size)
+        return lon0, lon0+0.1, lat0, lat0+0.1
 
+    # Bounding box
+    lon0, lat0 = to_lowest_grid_point(lon0, lat0, grid_size)
+    lon1, lat1 = to_lowest_grid_point(lon1, lat1, grid_size)
+
+    if lon0 <= lon1:
+        lon_min, lon_max = lon0, lon1+0.1
+    else:
+        lon_min, lon_max = lon1, lon0+0.1
+
+    if lat0 <= lat1:
+        lat_min, lat_max = lat0, lat1+0.1
+    else:
+        lat_min, lat_max = lat1, lat0+0.1
+    return lon_min, lon_max, lat_min, lat_max
+
+def select_woa23_groups(plan: QueryPlan, profile_layout: bool = None) -> list:
+    """
+    Index selections of the query plan in each of its (cached) zarr groups
+    """
+    selections = []
+    # Profiles and narrow boxes are read from the profile-layout copy (all depths in one chunk) when it is up to date
+    use_profile_layout = plan.n_cells() <= PROFILE_LAYOUT_MAX_CELLS if profile_layout is None else profile_layout
+    # Note some parameters and time_periods belong to the same subgroups in zarr.
+    for zarr_group_path in plan.zarr_group_paths:
+        ds = zarr_cache.get(zarr_group_path)
+        sel = select_group(plan, zarr_group_path, ds)
+        if sel is None:
+            continue
+        if use_profile_layout:
+            sel.read_path = profile_layout_path(zarr_group_path) or zarr_group_path
+        sel.direct_readable = all(is_direct_readable(zarr_cache.get_array(sel.read_path, var)) for var in sel.variables)
+        selections.append(sel)
+
+    if not selections:
+        raise HTTPException(status_code=404, detail="No data found for the specified query parameters")
+    apply_ocean_masks(plan, selections)
+    choose_query_backends(selections)
+    return selections
+
+def choose_query_backends(selections: list):
+    """
+    Backend of each selection (QUERY_BACKEND): the zarr store, or the columnar export of its group when up to date and
+    holding the selected columns. With 'auto' the export is used only if it decodes COLUMNAR_COST_FACTOR times fewer
+    values than the zarr chunks touched, e.g. for one or a few depth levels over a wide box.
+    """
+    if QUERY_BACKEND == 'zarr':
+        return
+    for sel in selections:
+        if sel.is_empty() or sel.read_path != sel.zarr_group_path:
+            continue  # the profile-layout copy serves profiles and narrow boxes
+        export = columnar_export(sel.zarr_group_path)
+        if export is None or not export.covers(sel):
+            continue
+        if QUERY_BACKEND == 'auto':
+            chunk_shapes = {var: zarr_cache.get_array(sel.read_path, var).chunks for var in sel.variables}
+            if columnar_read_cells(sel, export) * COLUMNAR_COST_FACTOR >= zarr_read_cells(sel, chunk_shapes):
+                continue
+        sel.backend = ColumnarBackend.name
+
+def query_backend(sel: GroupSelection, direct: bool = False) -> QueryBackend:
+    """
+    Backend reading a selection: the columnar export chosen for it while still up to date, else the zarr store
+    """
+    if sel.backend == ColumnarBackend.name:
+        export = columnar_export(sel.zarr_group_path)
+        if export is not None:
+            return ColumnarBackend(export)
+    return ZarrBackend(zarr_cache, direct)
+
+def apply_ocean_masks(plan: QueryPlan, selections: list):
+    """
+    Prune the selections with the ocean masks of their groups (built by dev/zarr_ocean_mask_woa23.py): depth levels
+    below the deepest sea floor of the selected columns are not read. With dropna, the selections are also cropped to
+    the lat/lon rectangle of the ocean columns and the depth levels holding values.
+    """
+    bottoms = []
+    for sel in selections:
+        bottom = ocean_masks.get(sel.zarr_group_path, zarr_cache.version(sel.zarr_group_path))
+        if bottom is None:
+            bottoms.append(None)
+            continue
+        bottom = bottom[sel.lat_sl, sel.lon_sl]
+        sel.valid_depth_stop = int(bottom.max()) if bottom.size else 0
+        bottoms.append(bottom)
+    if not plan.dropna or any(bottom is None for bottom in bottoms):
+        return
+
+    # All groups of one query share the same lat/lon selection, so they are cropped alike.
+    # A selection without any value is left as is (nothing is read, and the result keeps its columns).
+    ocean = np.logical_or.reduce([bottom > 0 for bottom in bottoms])
+    rows, cols = np.flatnonzero(ocean.any(axis=1)), np.flatnonzero(ocean.any(axis=0))
+    if len(rows) == 0:
+        return
+    for sel in selections:
+        depth_stop = min(sel.depth_sl.stop, sel.valid_depth_stop)
+        if depth_stop <= sel.depth_sl.start:
+            continue
+        sel.crop(slice(sel.lat_sl.start + rows[0], sel.lat_sl.start + rows[-1] + 1),
+                 slice(sel.lon_sl.start + cols[0], sel.lon_sl.start + cols[-1] + 1),
+                 slice(sel.depth_sl.start, depth_stop))
+
+def read_woa23_block(sel: GroupSelection, tp_pos: list = None, depth_pos: list = None, direct: bool = False) -> QueryBlock:
+    """
+    Read a selection (or the given time period/depth positions of it) into a QueryBlock from its backend.
+    direct=True reads zarr chunks by index (point profiles, small boxes), otherwise through xarray/Dask.
+    """
+    block = read_selection_block(sel, tp_pos, depth_pos, backend=query_backend(sel, direct))
+    if (sel.derived or sel.hidden) and not block.is_empty():
+        # derived slabs are cached per store version and lat/lon selection
+        cache_key = (sel.zarr_group_path, zarr_cache.version(sel.zarr_group_path),
+                     (sel.lat_sl.start, sel.lat_sl.stop), (sel.lon_sl.start, sel.lon_sl.stop))
+        derive_block(block, sel.derived, sel.hidden, block.lats[:, None], derived_cache, cache_key)
+    return block
+
+def iter_woa23_frames(plan: QueryPlan, selections: list, max_rows: int):
+    """
+    Generate the query result as consecutive row batches (slabs of time_period x depth levels),
+    so that memory stays bounded whatever the size of the bounding box
+    """
+    direct = plan.n_cells() <= FAST_PATH_MAX_CELLS
+    columns = result_columns(selections, plan.variables)
+    n_batch = 0
+    for parts in iter_slab_batches(selections, max_rows):
+        blocks = [read_woa23_block(sel, tp_pos, depth_pos, direct=direct) for sel, tp_pos, depth_pos in parts]
+        yield finalize_columns(assemble_wide(blocks, plan.variables, columns, plan.dropna), plan)
+        n_batch += 1
+    if n_batch == 0:
+        # empty result still carries its schema (for Arrow/Parquet)
+        yield finalize_columns(assemble_wide([], plan.variables, columns), plan)
+
+def plan_woa23_query(lon0: float, lat0: float, lon1: Optional[float], lat1: Optional[float], dep0: Optional[float], dep1: Optional[float], grid: Optional[str], append: Optional[str], parameter: Optional[str], time_period: Optional[str],
+                     resolution: Optional[str] = None, max_cells: Optional[int] = None, dropna: Optional[bool] = None) -> QueryPlan:
+    """
+    Validate the query parameters and normalize them into a QueryPlan (snapped bbox, depth range, zarr groups).
+    `resolution` (grid size in degrees, or 'auto') and `max_cells` select a coarsened pyramid level of the grid:
+    auto serves the finest level whose bbox holds at most `max_cells` (default PYRAMID_AUTO_MAX_CELLS) lon x lat cells.
+    `dropna` leaves out the rows without any value.
+    """
     if grid is None:
         grid = '01'
     else:
@@ -157,8 +419,9 @@ async def process_woa23_data(lon0: float, lat0: float, lon1: Optional[float], la
     if append is None:
         append = 'mn'
 
-    variables = list(set([var.strip() for var in append.split(
-        ',') if var.strip() in available_vars]))
+    # De-duplicate and keep a fixed order, so equivalent queries give identical results
+    requested_vars = set([var.strip() for var in append.split(',')])
+    variables = [var for var in available_vars if var in requested_vars]
     if not variables:
         raise HTTPException(
             status_code=400, detail=f"Invalid variables. Allowed variables are {', '.join(available_vars)}")
@@ -168,10 +431,17 @@ async def process_woa23_data(lon0: float, lat0: float, lon1: Optional[float], la
 
     available_pars = ['temperature', 'salinity'] if gridSz == 0.25 else ['temperature', 'salinity', 'oxygen', 'o2sat', 'AOU', 'silicate', 'phosphate', 'nitrate']
 
-    pars = list(set([c.strip() for c in parameter.split(',') if c.strip() in available_pars]))
+    requested_pars = set([c.strip() for c in parameter.split(',')])
+    # Derived parameters are computed from source parameters, which are read but left out of the result unless requested
+    derived = [c for c in derived_parameters if c in requested_pars]
+    hidden = [src for src in available_pars if src not in requested_pars and any(src in derived_parameters[c] for c in derived)]
+    pars = [c for c in available_pars if c in requested_pars or c in hidden]
     if not pars:
         raise HTTPException(
-            status_code=400, detail=f"Invalid parameters. Allowed parameters are {', '.join(available_pars)} for grid size = {gridSz}")
+            status_code=400, detail=f"Invalid parameters. Allowed parameters are {', '.join(available_pars + list(derived_parameters))} for grid size = {gridSz}")
+    if derived and not any(var in derivable_vars for var in variables):
+        raise HTTPException(
+            status_code=400, detail=f"Derived parameters ({', '.join(derived)}) are computed for the means only. Please append {' or '.join(derivable_vars)}")
 
     if time_period is None:
         time_period = '0'
@@ -192,6 +462,7 @@ async def process_woa23_data(lon0: float, lat0: float, lon1: Optional[float], la
         for period in periods:
             subgroup = determine_subgroup(param, period)
             zarr_group_paths.add(f"{zarr_store_path}/{grid_path}/{subgroup}")
+    zarr_group_paths = sorted(zarr_group_paths)
 
     if dep0 is None:
         dep0 = 0
@@ -204,195 +475,177 @@ async def process_woa23_data(lon0: float, lat0: float, lon1: Optional[float], la
     else:
         depth_min, depth_max = dep1, dep0
 
-    if lon1 is None or lat1 is None or (lon0 == lon1 and lat0 == lat1):
-        # Only one point
-        lon0, lat0 = to_lowest_grid_point(lon0, lat0, gridSz)
-        lon_min, lon_max = lon0, lon0+0.1
-        lat_min, lat_max = lat0, lat0+0.1
-    else:
-        # Bounding box
-        lon0, lat0 = to_lowest_grid_point(lon0, lat0, gridSz)
-        lon1, lat1 = to_lowest_grid_point(lon1, lat1, gridSz)
-
-        if lon0 <= lon1:
-            lon_min, lon_max = lon0, lon1+0.1
+    if resolution is not None or max_cells is not None:
+        # Map-scale queries: the native grid or one of its coarsened pyramid levels
+        levels = {gridSz: zarr_group_paths, **pyramid_levels(grid, zarr_group_paths)}
+        if resolution is None or str(resolution).strip().lower() == 'auto':
+            budget = max_cells if max_cells is not None else PYRAMID_AUTO_MAX_CELLS
+            gridSz = select_level(list(levels), lambda size: bbox_cells(*snap_bbox(lon0, lat0, lon1, lat1, size), size), budget)
         else:
-            lon_min, lon_max = lon1, lon0+0.1
-
-        if lat0 <= lat1:
-            lat_min, lat_max = lat0, lat1+0.1
-        else:
-            lat_min, lat_max = lat1, lat0+0.1
-
-    result_list = []
-    all_columns = set()
-    # end_time = datetime.now()
-    # print(f"Time taken to handle query parameters: {(end_time - start_time).total_seconds()} seconds")
-
-    start_time = datetime.now()
-    for zarr_group_path in zarr_group_paths:
-        ds = xr.open_zarr(zarr_group_path)
-
-        # Ensure the selected parameters exist in the dataset
-        # intersect_params_start_time = datetime.now()
-        existing_params = set(ds.coords['parameters'].values)
-        selected_params = existing_params.intersection(pars)
-        # end_time = datetime.now()
-        # print(f"Time taken to intersect parameters: {(end_time - intersect_params_start_time).total_seconds()} seconds")
-
-        if not selected_params:
-            continue
-
-        # Ensure the selected time periods exist in the dataset
-        # intersect_periods_start_time = datetime.now()
-        existing_periods = set(ds.coords['time_periods'].values)
-        selected_periods = existing_periods.intersection(periods)
-        # end_time = datetime.now()
-        # print(f"Time taken to intersect periods: {(end_time - intersect_periods_start_time).total_seconds()} seconds")
-        if not selected_periods:
-            continue
-
-        # Select the appropriate data based on the query parameters
-        # filtering_start_time = datetime.now()
-        filtered_data = ds.sel(
-            lon=slice(lon_min, lon_max),
-            lat=slice(lat_min, lat_max),
-            depth=slice(depth_min, depth_max),
-            parameters=list(selected_params),
-            time_periods=list(selected_periods)
-        )
-        # end_time = datetime.now()
-        # print(f"Time taken to filtering ds: {(end_time - filtering_start_time).total_seconds()} seconds")
-        # Append the data variables to the result list
-        appending_start_time = datetime.now()
-        """ pandas version """
-        for var in variables:
-            if var in filtered_data:
-                data = filtered_data[var].to_dataframe().reset_index()
-                # Append the data variable to the DataFrame
-                """ pandas version
-                data[var] = data.apply(lambda row: row[var], axis=1)
-                result_list.append(data)
-                """
-                # Convert to polars directly
-                data_polars = pl.from_pandas(data)
-                data_polars = data_polars.with_columns([
-                    pl.lit(var).alias("variable_type"),
-                    pl.col(var).alias("value")
-                ])
-                # Drop original var columns if exist
-                data_polars = data_polars.drop(var)
-                result_list.append(data_polars)
-
-        # end_time = datetime.now()
-        # print(f"Time taken to appending result_list: {(end_time - appending_start_time).total_seconds()} seconds")
-
-    # end_time = datetime.now()
-    # print(f"Time taken to open and filter Zarr stores: {(end_time - start_time).total_seconds()} seconds")
-
-    if not result_list:
-        raise HTTPException(status_code=404, detail="No data found for the specified query parameters")
-
-    # print("result list: ", result_list)
-    """ pandas version
-    # Concatenate all dataframes in the result list
-    result_df = pd.concat(result_list, ignore_index=True)
-
-    # Pivot to wide format
-    result_df = result_df.pivot_table(
-        index=["lon", "lat", "depth", "time_periods"],
-        columns="parameters",
-        values=[var for var in variables],
-        aggfunc='first'
-    ).reset_index()
+            try:
+                size = float(resolution)
+            except ValueError:
+                size = None
+            if size not in levels:
+                raise HTTPException(
+                    status_code=400, detail=f"Invalid resolution. Available resolutions are auto, {', '.join(f'{s:g}' for s in levels)} for grid size = {gridSz}")
+            gridSz = size
+        zarr_group_paths = levels[gridSz]
+
+    lon_min, lon_max, lat_min, lat_max = snap_bbox(lon0, lat0, lon1, lat1, gridSz)
+
+    return QueryPlan(grid, gridSz, pars, periods, variables, zarr_group_paths,
+                     lon_min, lon_max, lat_min, lat_max, depth_min, depth_max, derived=derived, hidden=hidden, dropna=bool(dropna))
+
+def process_woa23_data(lon0: float, lat0: float, lon1: Optional[float], lat1: Optional[float], dep0: Optional[float], dep1: Optional[float], grid: Optional[str], append: Optional[str], parameter: Optional[str], time_period: Optional[str]):
+    plan = plan_woa23_query(lon0, lat0, lon1, lat1, dep0, dep1, grid, append, parameter, time_period)
+    return execute_woa23_query(plan, select_woa23_groups(plan))
+
+def execute_woa23_query(plan: QueryPlan, selections: list) -> pl.DataFrame:
+    init_time = datetime.now()
+    # Point profiles and small boxes: read chunks directly by index arithmetic
+    direct = plan.n_cells() <= FAST_PATH_MAX_CELLS
+    blocks = [read_woa23_block(sel, direct=direct) for sel in selections]
+    result_df = finalize_columns(assemble_wide(blocks, plan.variables, result_columns(selections, plan.variables), plan.dropna), plan)
 
-    # Flatten the column multi-index after pivoting
-    result_df.columns = [f"{param}_{var}" if param != "lon" and param != "lat" and param != "depth" and param != "time_periods" else param for param, var in result_df.columns]
+    end_time = datetime.now()
+    print(f"Total time for this query taken: {(end_time - init_time).total_seconds()} seconds")
+    return result_df
 
-    # Optionally rename {param}_mn to {param} if `mn` is present in the query variables
-    if 'mn' in variables:
-        result_df.columns = [col.replace('mn_', '') for col in result_df.columns]
+@app.get("/api/woa23/cache", include_in_schema=False)
+async def get_cache_stats():
+    return {**zarr_cache.stats(), 'responses': response_cache.stats(), 'derived': derived_cache.stats(), 'masks': ocean_masks.stats(),
+            'columnar': columnar_exports.stats()}
 
-    result_df = result_df.rename(columns={"time_periods": "time_period"})
-    result_data = result_df.to_dict(orient="records")
+@app.get("/api/woa23/executor", include_in_schema=False)
+async def get_executor_stats():
+    return {**query_executor.stats(), 'exports': export_jobs.stats()}
 
-    return ORJSONResponse(content=result_data)
+def prepare_woa23_query(fmt, *args):
     """
-    """ polars version """
-    # Convert each dataframe in result_list to polars and add the variable type
-    # start_time = datetime.now()
-
-    # Concatenate the dataframes
-    result_df = pl.concat(result_list, how="vertical")
-    # print("result df: ", result_df)
-
-    # Combine the parameter and variable type columns
-    result_df = result_df.with_columns(
-        (pl.col("parameters") + "_" + pl.col("variable_type")).alias("parameter_variable")
-    )
-    # end_time = datetime.now()
-    # print(f"Time taken for converting to polars and concatenating: {(end_time - start_time).total_seconds()} seconds")
-
-    # print("result_df after rename, before pivot: ", result_df)
-    """ Check for duplicates
-    duplicates = result_df.groupby(["lon", "lat", "depth", "time_periods", "parameter_variable"]).count()
-    duplicated_rows = duplicates.filter(pl.col("count") > 1)
-
-    if duplicated_rows.height > 0:
-        # Get the duplicated keys
-        duplicated_keys = duplicated_rows.select(["lon", "lat", "depth", "time_periods", "parameter_variable"])
-        # Join with the original result_df to get all duplicated rows
-        duplicated_data = result_df.join(duplicated_keys, on=["lon", "lat", "depth", "time_periods", "parameter_variable"], how="inner")
-        # Sort the duplicated data
-        duplicated_data = duplicated_data.sort(["lon", "lat", "depth", "time_periods", "parameter_variable"])
-        print("Duplicated Rows:", duplicated_rows.height)
-        print(duplicated_data)
-    """
-    # Pivot to wide format
-    # start_time = datetime.now()
-    result_df = result_df.pivot(
-        index=["lon", "lat", "depth", "time_periods"],
-        columns="parameter_variable",
-        values="value"
-    )
-    # end_time = datetime.now()
-    # print(f"Time taken for pivoting: {(end_time - start_time).total_seconds()} seconds")
-
-    # Optionally rename {param}_mn to {param} if `mn` is present in the query variables
-    # start_time = datetime.now()
-    if 'mn' in variables:
-        rename_dict = {f"{param}_mn": param for param in pars if f"{param}_mn" in result_df.columns}
-        if rename_dict:  # Check if there are columns to rename
-            result_df = result_df.rename(rename_dict)
+    Plan the query and derive its normalized cache key and ETag (store version aware) before reading any data
+    """
+    plan = plan_woa23_query(*args)
+    selections = select_woa23_groups(plan)
+    cost = estimate_woa23_cost(plan, selections)
+    check_query_limits(plan, cost, fmt)
+    key = (fmt, tuple(plan.variables), plan.dropna, tuple(sel.key() for sel in selections))
+    etag = make_etag(key, [zarr_cache.version(sel.zarr_group_path) for sel in selections])
+    return plan, selections, cost, key, etag
+
+def estimate_woa23_cost(plan: QueryPlan, selections: list) -> QueryCost:
+    chunk_shapes = {}
+    for sel in selections:
+        for var in sel.variables:
+            zarr_array = zarr_cache.get_array(sel.read_path, var)
+            if zarr_array is not None:
+                chunk_shapes[(sel.read_path, var)] = zarr_array.chunks
+    return estimate_query_cost(selections, plan.variables, chunk_shapes)
+
+def check_query_limits(plan: QueryPlan, cost: QueryCost, fmt: str):
+    """
+    Admission control before any data is read: bbox limits (degrees) and the estimated cost budgets.
+    JSON is built in memory, so larger JSON queries are pointed to the streamed formats.
+    """
+    lon_range = plan.lon_max - plan.lon_min
+    lat_range = plan.lat_max - plan.lat_min
+    if LON_RANGE_LIMIT is not None and lon_range > LON_RANGE_LIMIT:
+        raise HTTPException(status_code=413, detail=f"Longitude range too large: {lon_range:.2f} > {LON_RANGE_LIMIT} degrees")
+    if LAT_RANGE_LIMIT is not None and lat_range > LAT_RANGE_LIMIT:
+        raise HTTPException(status_code=413, detail=f"Latitude range too large: {lat_range:.2f} > {LAT_RANGE_LIMIT} degrees")
+    if AREA_LIMIT is not None and lon_range * lat_range > AREA_LIMIT:
+        raise HTTPException(status_code=413, detail=f"Bounding box too large: {lon_range * lat_range:.2f} > {AREA_LIMIT} square degrees")
+
+    if QUERY_MAX_CHUNKS is not None and cost.chunks > QUERY_MAX_CHUNKS:
+        raise HTTPException(status_code=413, detail=f"Query touches too many data chunks ({cost.chunks} > {QUERY_MAX_CHUNKS}). Please narrow the bounding box, depth range, parameters or time_periods.")
+    if QUERY_MAX_BYTES is not None and cost.bytes > QUERY_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Query too large (estimated {cost.bytes} bytes > {QUERY_MAX_BYTES}). Please narrow the bounding box, depth range, parameters or time_periods.")
+    if fmt == 'json' and QUERY_JSON_MAX_BYTES is not None and cost.bytes > QUERY_JSON_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Query too large for JSON (estimated {cost.bytes} bytes > {QUERY_JSON_MAX_BYTES}). Please use /api/woa23/csv or format=parquet|arrow|ndjson, which are streamed.")
+
+def query_json(plan, selections):
+    df = execute_woa23_query(plan, selections)
+    # same serialization as ORJSONResponse, but done on the query executor instead of the event loop
+    return orjson.dumps(df.to_dicts(), option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+def prepare_stream(fmt, plan, selections):
+    if fmt == 'csv' and all(sel.is_empty() for sel in selections):
+        raise HTTPException(status_code=400, detail="No data available for the given parameters.")
+
+    return iter_encoded(iter_woa23_frames(plan, selections, STREAM_BATCH_ROWS), fmt)
+
+async def respond_woa23(request: Request, fmt: str, *args):
+    """
+    Shared response path of the query endpoints: cost estimate and limits, ETag revalidation (304), response cache,
+    in-flight budget, then JSON built on the query executor or other formats streamed from it
+    """
+    (plan, selections, cost, key, etag), queue_time = await query_executor.run(prepare_woa23_query, fmt, *args)
+    headers = {"ETag": etag, "X-Queue-Time": f"{queue_time:.3f}", "X-Query-Estimate": cost.header(), "X-Resolution": f"{plan.grid_size:g}"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    media_type = "application/json"
+    if fmt != 'json':
+        media_type, ext = output_formats[fmt]
+        out_file = f"woa23_from_ODB_{datetime.today().strftime('%Y-%m-%d')}.{ext}"
+        headers["Content-Disposition"] = f'attachment; filename="{out_file}"'
+
+    cached = response_cache.get(key, etag)
+    if cached is not None:
+        headers["X-Cache"] = "HIT"
+        return Response(content=cached, media_type=media_type, headers=headers)
+    headers["X-Cache"] = "MISS"
+
+    query_executor.reserve(cost.bytes)
+    if fmt == 'json':
+        try:
+            body, _ = await query_executor.run(query_json, plan, selections)
+        finally:
+            query_executor.release(cost.bytes)
+        response_cache.put(key, etag, body)
+        return Response(content=body, media_type=media_type, headers=headers)
 
-    result_df = result_df.rename({"time_periods": "time_period"})
-    end_time = datetime.now()
-    # print(f"Time taken for renaming and generating JSON: {(end_time - start_time).total_seconds()} seconds")
-    print(f"Total time for this query taken: {(end_time - init_time).total_seconds()} seconds")
-    return result_df
+    try:
+        chunks, _ = await query_executor.run(prepare_stream, fmt, plan, selections)
+    except BaseException:
+        query_executor.release(cost.bytes)
+        raise
+    chunks = response_cache.collect(chunks, key, etag)
+    return StreamingResponse(stream_from_executor(chunks, cost.bytes), media_type=media_type, headers=headers)
+
+async def stream_from_executor(chunks, reserved: int = 0):
+    """
+    Pull each chunk of a (blocking) generator on the query executor, so that slabs are read and encoded off the event loop.
+    The query was admitted when its stream was prepared: the chunks are continuations of it, so a full queue cannot cut
+    off a response whose headers are already sent. The `reserved` in-flight bytes are released when the stream ends or
+    the client goes away.
+    """
+    try:
+        while True:
+            chunk = await query_executor.run_continuation(next, chunks, None)
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        query_executor.release(reserved)
 
 @app.get("/api/woa23", tags=["WOA23"], summary="Query WOA23 data (in JSON)")
 async def get_woa23(
-    lon0: float = Query(...,
-                        description="Minimum longitude, range: [-180, 180]."),
-    lat0: float = Query(..., description="Minimum latitude, range: [-90, 90]."),
-    lon1: Optional[float] = Query(
-        None, description="Maximum longitude, range: [-180, 180]."),
-    lat1: Optional[float] = Query(
-        None, description="Maximum latitude, range: [-90, 90]."),
-    dep0: Optional[float] = Query(
-        None, description="Minimum depth. Optional, default is 0."),
-    dep1: Optional[float] = Query(
-        None, description="Maximum depth. Optional, default is maximum depth 5500m in WOA23."),
-    grid: Optional[str] = Query(
-        None, description="Grid resoultion: 1 for 1-degree, 0.25 for 0.25-degree. Default is 1."),
-    append: Optional[str] = Query(
-        None, description=f"Statistics to append, separated by commas. Default is 'mn': Statistical mean. Allowed: {', '.join(available_vars)}."),
-    parameter: Optional[str] = Query(
-        None,
-        description="WOA23 parameteres, separated by commas. Default is 'temperature'. Allowed: temperature, salinity (both 0.25/1-degree data), oxygen, o2sat, AOU, silicate, phosphate, nitrate (only 1-degree data)."),
-    time_period: Optional[str] = Query(
-        None, description="Time periods for statistics, separated by commas. Default is '0' (annual). Allowed: 0 (annual). 1-12 (monthly), 13-16 (seasonal)."),
+    request: Request,
+    lon0: Lon0Query,
+    lat0: Lat0Query,
+    lon1: Lon1Query = None,
+    lat1: Lat1Query = None,
+    dep0: Dep0Query = None,
+    dep1: Dep1Query = None,
+    grid: GridQuery = None,
+    append: AppendQuery = None,
+    parameter: ParameterQuery = None,
+    time_period: TimePeriodQuery = None,
+    resolution: ResolutionQuery = None,
+    max_cells: MaxCellsQuery = None,
+    dropna: DropnaQuery = False,
+    fmt: Optional[str] = Query(None, alias="format", description="Output format: json (default), arrow (Arrow IPC stream), parquet, ndjson. Non-JSON formats are streamed."),
 ):
     """
     Query WOA23 data (in JSON), including sea temperature, salinity, dissolved oxygen, and nutrients.
@@ -400,30 +653,30 @@ async def get_woa23(
     #### Usage
     * /api/woa23?lon0=125&lat0=15&dep0=100&grid=1&parameter=temperature,salinity&time_period=13,14,15,16
     * parameter: temperature, salinity, oxygen, o2sat, AOU, silicate, phosphate, nitrate
+    * format=arrow|parquet|ndjson for columnar/streamed output, e.g. `pl.read_ipc_stream(url)` or `pl.read_parquet(url)`
+    * resolution=auto (optionally max_cells=...) for maps: wide boxes are served from coarsened levels (X-Resolution header), small boxes at native resolution
     """
-    try:
-        df = await process_woa23_data(lon0, lat0, lon1, lat1, dep0, dep1, grid, append, parameter, time_period)
-        result_data = df.to_dicts()
-        return ORJSONResponse(content=result_data)
-    except HTTPException as herr:
-        raise herr
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    except Exception as e:
-        raise HTTPException(status_code=500, detail="Internal server error. Please try it later or inform admin")
+    if fmt is not None and fmt not in ['json', 'arrow', 'parquet', 'ndjson']:
+        raise HTTPException(status_code=400, detail="Invalid format. Allowed formats are json, arrow, parquet, ndjson")
+
+    return await respond_woa23(request, fmt or 'json', lon0, lat0, lon1, lat1, dep0, dep1, grid, append, parameter, time_period, resolution, max_cells, dropna)
 
 @app.get("/api/woa23/csv", tags=["WOA23"], summary="Query WOA23 data (in CSV)")
 async def get_woa23_csv(
-    lon0: float = Query(..., description="Minimum longitude, range: [-180, 180]."),
-    lat0: float = Query(..., description="Minimum latitude, range: [-90, 90]."),
-    lon1: Optional[float] = Query(None, description="Maximum longitude, range: [-180, 180]."),
-    lat1: Optional[float] = Query(None, description="Maximum latitude, range: [-90, 90]."),
-    dep0: Optional[float] = Query(None, description="Minimum depth. Optional, default is 0."),
-    dep1: Optional[float] = Query(None, description="Maximum depth. Optional, default is maximum depth 5500m in WOA23."),
-    grid: Optional[str] = Query(None, description="Grid resoultion: 1 for 1-degree, 0.25 for 0.25-degree. Default is 1."),
-    append: Optional[str] = Query(None, description=f"Statistics to append, separated by commas. Default is 'mn': Statistical mean. Allowed: {', '.join(available_vars)}."),
-    parameter: Optional[str] = Query(None, description="WOA23 parameteres, separated by commas. Default is 'temperature'. Allowed: temperature, salinity (both 0.25/1-degree data), oxygen, o2sat, AOU, silicate, phosphate, nitrate (only 1-degree data)."),
-    time_period: Optional[str] = Query(None, description="Time periods for statistics, separated by commas. Default is '0' (annual). Allowed: 0 (annual). 1-12 (monthly), 13-16 (seasonal)."),
+    request: Request,
+    lon0: Lon0Query,
+    lat0: Lat0Query,
+    lon1: Lon1Query = None,
+    lat1: Lat1Query = None,
+    dep0: Dep0Query = None,
+    dep1: Dep1Query = None,
+    grid: GridQuery = None,
+    append: AppendQuery = None,
+    parameter: ParameterQuery = None,
+    time_period: TimePeriodQuery = None,
+    resolution: ResolutionQuery = None,
+    max_cells: MaxCellsQuery = None,
+    dropna: DropnaQuery = False,
 ):
     """
     Query WOA23 data (in CSV), including sea temperature, salinity, dissolved oxygen, and nutrients.
@@ -432,19 +685,532 @@ async def get_woa23_csv(
     * /api/woa23/csv?lon0=125&lat0=15&dep0=100&grid=1&parameter=temperature,salinity&time_period=13,14,15,16
     * parameter: temperature, salinity, oxygen, o2sat, AOU, silicate, phosphate, nitrate
     """
+    return await respond_woa23(request, 'csv', lon0, lat0, lon1, lat1, dep0, dep1, grid, append, parameter, time_period, resolution, max_cells, dropna)
+
+def submit_export(fmt, *args):
+    plan = plan_woa23_query(*args)
+    selections = select_woa23_groups(plan)
+    cost = estimate_woa23_cost(plan, selections)
+    if EXPORT_MAX_BYTES is not None and cost.bytes > EXPORT_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Export too large (estimated {cost.bytes} bytes > {EXPORT_MAX_BYTES}). Please split it into smaller regions or time_periods.")
+    for sel in selections:
+        sel.read_path = os.path.abspath(sel.read_path)  # Dask workers may run in another directory
+    query = dict(zip(['lon0', 'lat0', 'lon1', 'lat1', 'dep0', 'dep1', 'grid', 'append', 'parameter', 'time_period', 'resolution', 'max_cells', 'dropna'], args))
+    return export_jobs.submit(plan, selections, fmt, query, cost.header()), cost
+
+@app.post("/api/woa23/jobs", tags=["WOA23"], summary="Submit a WOA23 export job", status_code=202)
+async def post_woa23_job(
+    lon0: Lon0Query,
+    lat0: Lat0Query,
+    lon1: Lon1Query = None,
+    lat1: Lat1Query = None,
+    dep0: Dep0Query = None,
+    dep1: Dep1Query = None,
+    grid: GridQuery = None,
+    append: AppendQuery = None,
+    parameter: ParameterQuery = None,
+    time_period: TimePeriodQuery = None,
+    resolution: ResolutionQuery = None,
+    max_cells: MaxCellsQuery = None,
+    dropna: DropnaQuery = False,
+    fmt: Optional[str] = Query('csv', alias="format", description="Output file format: csv (default), parquet, netcdf."),
+):
+    """
+    Submit a large WOA23 extraction (e.g. whole ocean basins) as a background job on the Dask cluster.
+    Poll /api/woa23/jobs/{job_id} for status and progress, then download /api/woa23/jobs/{job_id}/result.
+
+    #### Usage
+    * POST /api/woa23/jobs?lon0=120&lat0=-60&lon1=290&lat1=60&parameter=temperature,salinity&time_period=1,2,3&format=parquet
+    """
+    if fmt not in export_formats:
+        raise HTTPException(status_code=400, detail="Invalid format. Allowed formats are csv, parquet, netcdf")
+
+    (job_id, cost), _ = await query_executor.run(submit_export, fmt, lon0, lat0, lon1, lat1, dep0, dep1, grid, append, parameter, time_period, resolution, max_cells, dropna)
+    return ORJSONResponse(status_code=202, headers={"X-Query-Estimate": cost.header()}, content={
+        "job_id": job_id,
+        "status_url": f"/api/woa23/jobs/{job_id}",
+        "result_url": f"/api/woa23/jobs/{job_id}/result",
+    })
+
+@app.get("/api/woa23/jobs/{job_id}", tags=["WOA23"], summary="Status and progress of a WOA23 export job")
+async def get_woa23_job(job_id: str):
+    info = export_jobs.status(job_id)
+    if info is None:
+        raise HTTPException(status_code=404, detail="Job not found (or expired)")
+    return info
+
+@app.get("/api/woa23/jobs/{job_id}/result", tags=["WOA23"], summary="Download the result of a WOA23 export job")
+async def get_woa23_job_result(job_id: str):
+    info = export_jobs.status(job_id)
+    if info is None:
+        raise HTTPException(status_code=404, detail="Job not found (or expired)")
+    if info['status'] == 'failed':
+        raise HTTPException(status_code=500, detail=f"Job failed: {info.get('error')}")
+    result = export_jobs.result_path(job_id)
+    if result is None:
+        raise HTTPException(status_code=409, detail=f"Job not finished yet ({info['status']}, progress {info['progress']})")
+    path, file_name = result
+    return FileResponse(path, media_type=export_formats[info['format']][0], filename=file_name)
+
+class PointsQuery(BaseModel):
+    points: List[List[float]] = Field(..., description="Stations or cruise track as [[lon, lat], ...].")
+
+def route_cells_layout(sel: GroupSelection, lat_idx, lon_idx, depth_sl: slice = None):
+    """
+    Read scattered cells from the layout (main or profile copy) that decodes the fewest bytes for them
+    """
+    if depth_sl is None:
+        depth_sl = sel.depth_sl
+    var = sel.variables[0]
+    read_path = sel.zarr_group_path
+    profile_path = profile_layout_path(sel.zarr_group_path)
+    if profile_path is not None:
+        main_cost = cells_read_cost(zarr_cache.get_array(read_path, var), lat_idx, lon_idx, depth_sl)
+        if cells_read_cost(zarr_cache.get_array(profile_path, var), lat_idx, lon_idx, depth_sl) < main_cost:
+            read_path = profile_path
+    sel.read_path = read_path
+    sel.direct_readable = all(is_direct_readable(zarr_cache.get_array(read_path, v)) for v in sel.variables)
+
+def read_woa23_cells(sel: GroupSelection, lat_idx, lon_idx, depth_sl: slice = None) -> dict:
+    """
+    Values of a selection (or of the given depth levels of it) at the given unique cells, var -> (P, T, D, N)
+    """
+    if depth_sl is None:
+        depth_sl = sel.depth_sl
+    if sel.direct_readable:
+        zarr_arrays = {var: zarr_cache.get_array(sel.read_path, var) for var in sel.variables}
+        return read_zarr_cells(zarr_arrays, sel.tp_idx, sel.p_idx, depth_sl, lat_idx, lon_idx)
+    return read_ds_cells(zarr_cache.get(sel.read_path), sel.variables, sel.tp_idx, sel.p_idx, depth_sl, lat_idx, lon_idx)
+
+def query_woa23_points(fmt, points, dep0, dep1, grid, append, parameter, time_period):
+    """
+    Profiles at many stations in one pass: snap all points at once, read each chunk they touch once
+    """
+    coords = np.asarray(points, dtype=np.float64)
+    if coords.ndim != 2 or coords.shape[1] != 2 or len(coords) == 0 or not np.isfinite(coords).all():
+        raise HTTPException(status_code=400, detail="Invalid points. Expected a non-empty list of [lon, lat] pairs")
+    if len(coords) > POINTS_MAX_POINTS:
+        raise HTTPException(status_code=413, detail=f"Too many points ({len(coords)} > {POINTS_MAX_POINTS}). Please split the request.")
+    lons, lats = coords[:, 0], coords[:, 1]
+
+    plan = plan_woa23_query(lons.min(), lats.min(), lons.max(), lats.max(), dep0, dep1, grid, append, parameter, time_period)
+    selections = select_woa23_groups(plan, profile_layout=False)
+    ds = zarr_cache.get(selections[0].zarr_group_path)
+    grid_lons, grid_lats = ds['lon'].values, ds['lat'].values
+    lon_idx = snap_to_grid_index(grid_lons, lons, plan.grid_size)
+    lat_idx = snap_to_grid_index(grid_lats, lats, plan.grid_size)
+    point_ids = np.flatnonzero((lon_idx >= 0) & (lat_idx >= 0))
+    cell_lat, cell_lon, inverse = unique_cells(lat_idx[point_ids], lon_idx[point_ids])
+    for sel in selections:
+        route_cells_layout(sel, cell_lat, cell_lon)
+
+    chunk_shapes = {(sel.read_path, var): zarr_cache.get_array(sel.read_path, var).chunks for sel in selections for var in sel.variables}
+    cost = estimate_cells_cost(selections, plan.variables, cell_lat, cell_lon, len(point_ids), chunk_shapes)
+    max_bytes = QUERY_JSON_MAX_BYTES if fmt == 'json' else QUERY_MAX_BYTES
+    if max_bytes is not None and cost.bytes > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Query too large (estimated {cost.bytes} bytes > {max_bytes}). Please split the points or narrow the depth range, parameters or time_periods.")
+
+    init_time = datetime.now()
+    blocks = []
+    for sel in selections:
+        block = PointBlock(sel.tp_labels, sel.param_labels, sel.depths)
+        block.arrays = read_woa23_cells(sel, cell_lat, cell_lon)
+        if sel.derived or sel.hidden:
+            derive_block(block, sel.derived, sel.hidden, grid_lats[cell_lat])
+        block.arrays = {var: values[..., inverse] for var, values in block.arrays.items()}
+        blocks.append(block)
+    df = finalize_columns(assemble_points(blocks, plan.variables, point_ids, grid_lons[lon_idx[point_ids]], grid_lats[lat_idx[point_ids]],
+                                          columns=result_columns(selections, plan.variables)), plan)
+    logger.debug(f"Points query of {len(coords)} points ({len(cell_lat)} grid cells) taken: {(datetime.now() - init_time).total_seconds()} seconds")
+
+    return encode_frame(df, fmt), cost
+
+@app.post("/api/woa23/points", tags=["WOA23"], summary="Query WOA23 profiles at many stations or along a cruise track")
+async def post_woa23_points(
+    query: PointsQuery,
+    dep0: Dep0Query = None,
+    dep1: Dep1Query = None,
+    grid: GridQuery = None,
+    append: AppendQuery = None,
+    parameter: ParameterQuery = None,
+    time_period: TimePeriodQuery = None,
+    fmt: Optional[str] = Query('json', alias="format", description="Output format: json (default), csv, arrow, parquet, ndjson."),
+):
+    """
+    Query WOA23 profiles at many (lon, lat) points in one request, e.g. all stations of a cruise.
+    Rows carry `point`, the position of the station in the request; points outside the grid are left out.
+
+    #### Usage
+    * POST /api/woa23/points?parameter=temperature,salinity&time_period=0 with body {"points": [[121.5, 22.3], [122.0, 22.8]]}
+    """
+    if fmt != 'json' and fmt not in output_formats:
+        raise HTTPException(status_code=400, detail="Invalid format. Allowed formats are json, csv, arrow, parquet, ndjson")
+
+    (body, cost), queue_time = await query_executor.run(query_woa23_points, fmt, query.points, dep0, dep1, grid, append, parameter, time_period)
+    headers = {"X-Queue-Time": f"{queue_time:.3f}", "X-Query-Estimate": cost.header()}
+    if fmt == 'json':
+        return Response(content=body, media_type="application/json", headers=headers)
+    media_type, ext = output_formats[fmt]
+    out_file = f"woa23_points_from_ODB_{datetime.today().strftime('%Y-%m-%d')}.{ext}"
+    headers["Content-Disposition"] = f'attachment; filename="{out_file}"'
+    return Response(content=body, media_type=media_type, headers=headers)
+
+def encode_frame(df: pl.DataFrame, fmt: str) -> bytes:
+    if fmt == 'json':
+        return orjson.dumps(df.to_dicts(), option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return b''.join(iter_encoded([df], fmt))
+
+def query_woa23_matchup(body: bytes, content_type: str, fmt, grid, append, parameter, time_period, nan_policy):
+    """
+    Interpolate WOA23 at observation positions: bilinear in lon/lat, linear in depth, vectorized over the whole upload
+    """
     try:
-        df = await process_woa23_data(lon0, lat0, lon1, lat1, dep0, dep1, grid, append, parameter, time_period)
-        if df.is_empty():
-            raise HTTPException(status_code=400, detail="No data available for the given parameters.")
-
-        temp_file = NamedTemporaryFile(delete=False)
-        df.write_csv(temp_file.name)  # polars version
-        out_file = f"woa23_from_ODB_{datetime.today().strftime('%Y-%m-%d')}.csv"
-        return FileResponse(temp_file.name, media_type="text/csv", filename=out_file)
-
-    except HTTPException as herr:
-        raise herr
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=str(e))
+        obs, in_fmt = read_frame(body, content_type)
     except Exception as e:
-        raise HTTPException(status_code=500, detail="Internal server error. Please try it later or inform admin")
+        raise HTTPException(status_code=400, detail=f"Cannot read the uploaded table: {e}")
+    missing = [col for col in ('lon', 'lat', 'depth') if col not in obs.columns]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Missing columns: {', '.join(missing)}. Required: lon, lat, depth, optional: time_period or month")
+    if len(obs) > MATCHUP_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"Too many observations ({len(obs)} > {MATCHUP_MAX_ROWS}). Please split the upload.")
+    fmt = fmt or in_fmt
+
+    # Time period of each observation: a time_period or month column, else the single query time_period
+    if 'time_period' in obs.columns:
+        periods = obs['time_period'].cast(pl.Int64, strict=False).cast(pl.String)
+    elif 'month' in obs.columns:
+        periods = obs['month'].cast(pl.Int64, strict=False).cast(pl.String)
+    else:
+        period = '0' if time_period is None else str(time_period).strip()
+        if period not in time_periods:
+            raise HTTPException(status_code=400, detail="Without a time_period or month column, time_period must be a single period (0-16)")
+        periods = pl.Series([period] * len(obs), dtype=pl.String)
+    periods = periods.fill_null('').to_numpy()
+    used_periods = [tp for tp in time_periods if tp in set(periods)]
+    if not used_periods:
+        raise HTTPException(status_code=400, detail=f"No valid time_period/month in the upload. Allowed time_periods are {', '.join(list(time_periods))}")
+
+    plan = plan_woa23_query(-180, -90, 180, 90, None, None, grid, append, parameter, ','.join(used_periods))
+    selections = select_woa23_groups(plan, profile_layout=False)
+    ds = zarr_cache.get(selections[0].zarr_group_path)
+    lons = obs['lon'].cast(pl.Float64, strict=False).fill_null(np.nan).to_numpy()
+    lats = obs['lat'].cast(pl.Float64, strict=False).fill_null(np.nan).to_numpy()
+    depths = obs['depth'].cast(pl.Float64, strict=False).fill_null(np.nan).to_numpy()
+    lo0, lo1, wx = grid_neighbours(ds['lon'].values, lons, periodic=True)
+    la0, la1, wy = grid_neighbours(ds['lat'].values, lats)
+    in_grid = (lo0 >= 0) & (la0 >= 0)
+    strict = nan_policy == 'strict'
+
+    init_time = datetime.now()
+    n_obs = len(obs)
+    out = {}
+    for sel in selections:
+        tp_pos_of = {tp: ti for ti, tp in enumerate(sel.tp_labels)}
+        t_pos = np.asarray([tp_pos_of.get(tp, -1) for tp in periods], dtype=np.int64)
+        rows = np.flatnonzero(in_grid & (t_pos >= 0))
+        k0, k1, wz = depth_neighbours(sel.depths, depths[rows])
+        keep = k0 >= 0
+        rows, k0, k1, wz = rows[keep], k0[keep], k1[keep], wz[keep]
+        if len(rows) == 0:
+            continue
+        # read only the depth levels and the neighbour cells the observations need
+        kmin, kmax = int(k0.min()), int(k1.max())
+        depth_sl = slice(sel.depth_sl.start + kmin, sel.depth_sl.start + kmax + 1)
+        cell_lat, cell_lon, inverse = unique_cells(np.concatenate([la0[rows], la0[rows], la1[rows], la1[rows]]),
+                                                   np.concatenate([lo0[rows], lo1[rows], lo0[rows], lo1[rows]]))
+        cells = inverse.reshape(4, len(rows))
+        route_cells_layout(sel, cell_lat, cell_lon, depth_sl)
+        values = read_woa23_cells(sel, cell_lat, cell_lon, depth_sl)
+        for var in sel.variables:
+            for pi, param in enumerate(sel.param_labels):
+                name = param if var == 'mn' else f"{param}_{var}"
+                if name not in out:
+                    out[name] = (np.full(n_obs, np.nan, dtype=np.float32), np.zeros(n_obs, dtype=np.uint8))
+                v, mask = interpolate_cells(values[var][pi], t_pos[rows], k0 - kmin, k1 - kmin, wz, cells, wy[rows], wx[rows], strict)
+                out[name][0][rows] = v
+                out[name][1][rows] = mask
+    # Derived parameters from the interpolated sources, masked where any source neighbour is NaN
+    for name in plan.derived:
+        for var in [var for var in plan.variables if var in derivable_vars]:
+            sources = [out.get(src if var == 'mn' else f"{src}_{var}") for src in derived_parameters[name]]
+            if any(source is None for source in sources):
+                continue
+            (temperature, t_mask), (salinity, s_mask) = sources
+            pressure = depth_to_pressure(depths, lats) if name != 'sigma0' else 0.0
+            out[name if var == 'mn' else f"{name}_{var}"] = (compute_derived(name, temperature, salinity, pressure), t_mask | s_mask)
+    logger.debug(f"Match-up of {n_obs} observations taken: {(datetime.now() - init_time).total_seconds()} seconds")
+
+    columns = []
+    for name in result_columns(selections, plan.variables):
+        param, var = name.rsplit('_', 1)
+        name = param if var == 'mn' else name
+        values, mask = out.get(name, (np.full(n_obs, np.nan, dtype=np.float32), np.zeros(n_obs, dtype=np.uint8)))
+        columns += [float_column(name, values), pl.Series(f"{name}_nanmask", mask)]
+    df = obs.with_columns(columns)
+    return encode_frame(df, fmt), fmt
+
+@app.post("/api/woa23/matchup", tags=["WOA23"], summary="Interpolate WOA23 at observation positions (match-up)")
+async def post_woa23_matchup(
+    request: Request,
+    grid: GridQuery = None,
+    append: AppendQuery = None,
+    parameter: ParameterQuery = None,
+    time_period: Optional[str] = Query(None, description="Time period used when the upload has no time_period or month column. Default is '0' (annual)."),
+    nan_policy: Optional[str] = Query('renormalize', description="NaN neighbours (land, below bottom): 'renormalize' (default) leaves them out and rescales the weights, 'strict' returns null."),
+    fmt: Optional[str] = Query(None, alias="format", description="Output format: json, csv, arrow, parquet, ndjson. Default is the format of the upload."),
+):
+    """
+    Match-up of observations (e.g. CTD casts, bottle data) with WOA23: upload a table with columns lon, lat, depth
+    and optionally time_period (0-16) or month (1-12) as CSV (text/csv), Parquet (application/vnd.apache.parquet)
+    or Arrow IPC (application/vnd.apache.arrow.stream). The table is returned with one interpolated column per
+    parameter and statistic (bilinear in lon/lat, linear in depth) and a `{column}_nanmask` column whose bit
+    (4*iz + 2*iy + ix) is set where that neighbour (iz: shallower/deeper, iy: south/north, ix: west/east) is NaN.
+
+    #### Usage
+    * curl -X POST -H 'Content-Type: text/csv' --data-binary @casts.csv '/api/woa23/matchup?parameter=temperature,salinity'
+    """
+    if fmt is not None and fmt != 'json' and fmt not in output_formats:
+        raise HTTPException(status_code=400, detail="Invalid format. Allowed formats are json, csv, arrow, parquet, ndjson")
+    if nan_policy not in ('renormalize', 'strict'):
+        raise HTTPException(status_code=400, detail="Invalid nan_policy. Allowed: renormalize, strict")
+
+    body = await request.body()
+    (content, out_fmt), queue_time = await query_executor.run(query_woa23_matchup, body, request.headers.get('content-type'),
+                                                              fmt, grid, append, parameter, time_period, nan_policy)
+    headers = {"X-Queue-Time": f"{queue_time:.3f}"}
+    if out_fmt == 'json':
+        return Response(content=content, media_type="application/json", headers=headers)
+    media_type, ext = output_formats[out_fmt]
+    out_file = f"woa23_matchup_from_ODB_{datetime.today().strftime('%Y-%m-%d')}.{ext}"
+    headers["Content-Disposition"] = f'attachment; filename="{out_file}"'
+    return Response(content=content, media_type=media_type, headers=headers)
+
+def query_woa23_section(fmt, path, lon0, lat0, lon1, lat1, spacing, track, method, dep0, dep1, grid, append, parameter, time_period, nan_policy):
+    """
+    Vertical section along a polyline: sample the path, read only the chunks holding the sampled cells
+    """
+    if path:
+        vertices = parse_path(path)
+    elif None not in (lon0, lat0, lon1, lat1):
+        vertices = np.asarray([[lon0, lat0], [lon1, lat1]], dtype=np.float64)
+    else:
+        raise HTTPException(status_code=400, detail="Either path or the start (lon0, lat0) and end (lon1, lat1) points are required")
+    if np.abs(vertices[:, 1]).max() > 90:
+        raise HTTPException(status_code=400, detail="Invalid path. Latitudes must be in [-90, 90]")
+
+    vertex_lons = wrap_lon(vertices[:, 0])
+    plan = plan_woa23_query(vertex_lons.min(), vertices[:, 1].min(), vertex_lons.max(), vertices[:, 1].max(), dep0, dep1, grid, append, parameter, time_period)
+    if spacing is None:
+        spacing = 111.2 * plan.grid_size  # one grid cell at the equator
+    if spacing <= 0:
+        raise HTTPException(status_code=400, detail="Invalid spacing. Must be > 0 km")
+    lons, lats, dists = sample_path(vertices, spacing, track)
+    n_sample = len(lons)
+    if n_sample > SECTION_MAX_SAMPLES:
+        raise HTTPException(status_code=413, detail=f"Too many samples along the path ({n_sample} > {SECTION_MAX_SAMPLES}). Please increase the spacing.")
+
+    selections = select_woa23_groups(plan, profile_layout=False)
+    ds = zarr_cache.get(selections[0].zarr_group_path)
+    grid_lons, grid_lats = ds['lon'].values, ds['lat'].values
+    if method == 'bilinear':
+        lo0, lo1, wx = grid_neighbours(grid_lons, lons, periodic=True)
+        la0, la1, wy = grid_neighbours(grid_lats, lats)
+        valid = np.flatnonzero((lo0 >= 0) & (la0 >= 0))
+        cell_lat, cell_lon, inverse = unique_cells(np.concatenate([la0[valid], la0[valid], la1[valid], la1[valid]]),
+                                                   np.concatenate([lo0[valid], lo1[valid], lo0[valid], lo1[valid]]))
+        cells = inverse.reshape(4, len(valid))
+    else:
+        lon_idx = snap_to_grid_index(grid_lons, lons, plan.grid_size)
+        lat_idx = snap_to_grid_index(grid_lats, lats, plan.grid_size)
+        valid = np.flatnonzero((lon_idx >= 0) & (lat_idx >= 0))
+        cell_lat, cell_lon, inverse = unique_cells(lat_idx[valid], lon_idx[valid])
+    for sel in selections:
+        route_cells_layout(sel, cell_lat, cell_lon)
+
+    chunk_shapes = {(sel.read_path, var): zarr_cache.get_array(sel.read_path, var).chunks for sel in selections for var in sel.variables}
+    cost = estimate_cells_cost(selections, plan.variables, cell_lat, cell_lon, n_sample, chunk_shapes)
+    max_bytes = QUERY_JSON_MAX_BYTES if fmt == 'json' else QUERY_MAX_BYTES
+    if max_bytes is not None and cost.bytes > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Query too large (estimated {cost.bytes} bytes > {max_bytes}). Please increase the spacing or narrow the depth range, parameters or time_periods.")
+
+    init_time = datetime.now()
+    blocks = []
+    for sel in selections:
+        block = PointBlock(sel.tp_labels, sel.param_labels, sel.depths)
+        for var, values in read_woa23_cells(sel, cell_lat, cell_lon).items():
+            sampled = np.full(values.shape[:3] + (n_sample,), np.nan, dtype=np.float32)
+            if method == 'bilinear':
+                sampled[..., valid] = bilinear_cells(values, cells, wy[valid], wx[valid], strict=nan_policy == 'strict')
+            else:
+                sampled[..., valid] = values[..., inverse]
+            block.arrays[var] = sampled
+        if sel.derived or sel.hidden:
+            derive_block(block, sel.derived, sel.hidden, lats)
+        blocks.append(block)
+    columns = result_columns(selections, plan.variables)
+    logger.debug(f"Section of {n_sample} samples ({len(cell_lat)} grid cells) taken: {(datetime.now() - init_time).total_seconds()} seconds")
+
+    if fmt == 'json':
+        tp_axis, depth_axis, arrays = section_arrays(blocks, plan.variables, columns, n_sample)
+        data = {}
+        for name, values in arrays.items():
+            param, var = name.rsplit('_', 1)
+            data[param if var == 'mn' else name] = values
+        return orjson.dumps({
+            'distance': dists.round(3), 'lon': lons.round(5), 'lat': lats.round(5),
+            'depth': depth_axis, 'time_period': tp_axis, 'data': data,
+        }, option=orjson.OPT_SERIALIZE_NUMPY), cost
+
+    df = assemble_points(blocks, plan.variables, np.arange(n_sample), lons, lats, columns=columns)
+    df = df.rename({'point': 'sample'})
+    df.insert_column(1, pl.Series('distance', np.repeat(dists.astype(np.float32), len(df) // n_sample if n_sample else 0)))
+    return encode_frame(finalize_columns(df, plan), fmt), cost
+
+@app.get("/api/woa23/section", tags=["WOA23"], summary="Query a WOA23 vertical section (transect) along a path")
+async def get_woa23_section(
+    path: Optional[str] = Query(None, description="Polyline as 'lon,lat;lon,lat;...'. Longitudes beyond 180 cross the antimeridian with track=lonlat."),
+    lon0: Optional[float] = Query(None, description="Start longitude (when no path is given)."),
+    lat0: Optional[float] = Query(None, description="Start latitude (when no path is given)."),
+    lon1: Optional[float] = Query(None, description="End longitude (when no path is given)."),
+    lat1: Optional[float] = Query(None, description="End latitude (when no path is given)."),
+    spacing: Optional[float] = Query(None, description="Distance between samples along the path in km. Default is one grid cell at the equator (111.2 km for 1-degree)."),
+    track: Optional[str] = Query('great_circle', description="Segments between vertices: great_circle (default) or lonlat (straight in lon/lat, e.g. along a parallel)."),
+    method: Optional[str] = Query('nearest', description="Sampling of the grid: nearest (default) grid cell or bilinear."),
+    nan_policy: Optional[str] = Query('renormalize', description="Bilinear NaN neighbours (land, below bottom): 'renormalize' (default) leaves them out, 'strict' returns null."),
+    dep0: Dep0Query = None,
+    dep1: Dep1Query = None,
+    grid: GridQuery = None,
+    append: AppendQuery = None,
+    parameter: ParameterQuery = None,
+    time_period: TimePeriodQuery = None,
+    fmt: Optional[str] = Query('json', alias="format", description="Output format: json (default, dense arrays), csv, arrow, parquet, ndjson (one row per sample and depth)."),
+):
+    """
+    Vertical section of WOA23 along a great-circle or polyline path, sampled every `spacing` km at all depths.
+    JSON returns the sample positions (`distance` in km along the path, `lon`, `lat`), the `depth` and `time_period`
+    axes, and per parameter a dense array indexed [time_period][depth][distance] (null over land/below the bottom).
+
+    #### Usage
+    * /api/woa23/section?lon0=-80&lat0=22&lon1=-15&lat1=22&track=lonlat&parameter=salinity
+    * /api/woa23/section?path=120,22;125,18;135,18&spacing=25&grid=0.25&method=bilinear&parameter=temperature,salinity
+    """
+    if fmt != 'json' and fmt not in output_formats:
+        raise HTTPException(status_code=400, detail="Invalid format. Allowed formats are json, csv, arrow, parquet, ndjson")
+    if track not in section_tracks:
+        raise HTTPException(status_code=400, detail=f"Invalid track. Allowed: {', '.join(section_tracks)}")
+    if method not in section_methods:
+        raise HTTPException(status_code=400, detail=f"Invalid method. Allowed: {', '.join(section_methods)}")
+    if nan_policy not in ('renormalize', 'strict'):
+        raise HTTPException(status_code=400, detail="Invalid nan_policy. Allowed: renormalize, strict")
+
+    (body, cost), queue_time = await query_executor.run(query_woa23_section, fmt, path, lon0, lat0, lon1, lat1, spacing, track, method,
+                                                        dep0, dep1, grid, append, parameter, time_period, nan_policy)
+    headers = {"X-Queue-Time": f"{queue_time:.3f}", "X-Query-Estimate": cost.header()}
+    if fmt == 'json':
+        return Response(content=body, media_type="application/json", headers=headers)
+    media_type, ext = output_formats[fmt]
+    out_file = f"woa23_section_from_ODB_{datetime.today().strftime('%Y-%m-%d')}.{ext}"
+    headers["Content-Disposition"] = f'attachment; filename="{out_file}"'
+    return Response(content=body, media_type=media_type, headers=headers)
+
+def prepare_woa23_aggregate(fmt, polygon, lon0, lat0, lon1, lat1, dep0, dep1, grid, append, parameter, time_period):
+    """
+    Plan a regional aggregation over a bounding box or the cells of a polygon, with its cache key and ETag
+    """
+    vertices = None
+    if polygon:
+        vertices = parse_path(polygon, name='polygon', min_vertices=3)
+        lon0, lat0 = vertices[:, 0].min(), vertices[:, 1].min()
+        lon1, lat1 = vertices[:, 0].max(), vertices[:, 1].max()
+    elif lon0 is None or lat0 is None:
+        raise HTTPException(status_code=400, detail="Either polygon or a bounding box (lon0, lat0, lon1, lat1) is required")
+    plan = plan_woa23_query(lon0, lat0, lon1, lat1, dep0, dep1, grid, append, parameter, time_period)
+    selections = select_woa23_groups(plan)
+    cost = estimate_woa23_cost(plan, selections)
+    # only the reduced profiles are returned, so only the data read is limited
+    if QUERY_MAX_CHUNKS is not None and cost.chunks > QUERY_MAX_CHUNKS:
+        raise HTTPException(status_code=413, detail=f"Query touches too many data chunks ({cost.chunks} > {QUERY_MAX_CHUNKS}). Please narrow the region, depth range, parameters or time_periods.")
+    region = None if vertices is None else tuple(map(tuple, vertices.tolist()))
+    key = ('aggregate', fmt, tuple(plan.variables), region, tuple(sel.key() for sel in selections))
+    etag = make_etag(key, [zarr_cache.version(sel.zarr_group_path) for sel in selections])
+    return plan, selections, vertices, cost, key, etag
+
+def aggregate_woa23(plan: QueryPlan, selections: list, vertices, fmt: str) -> bytes:
+    """
+    cos(lat) area-weighted mean, min, max, std and count per (time_period, depth), reduced chunk by chunk
+    (one time period, latitude band and depth chunk at a time) so that memory stays bounded whatever the region
+    """
+    init_time = datetime.now()
+    columns = result_columns(selections, plan.variables)
+    aggregator = ProfileAggregator([key for sel in selections if not sel.is_empty() for key in sel.slab_keys()], columns)
+    for sel in selections:
+        if sel.is_empty():
+            continue
+        weights = np.repeat(area_weights(sel.lats)[:, None], len(sel.lons), axis=1)
+        if vertices is not None:
+            weights *= polygon_mask(sel.lons, sel.lats, vertices)
+        zarr_array = zarr_cache.get_array(sel.read_path, sel.variables[0])
+        chunk_depth, chunk_lat = zarr_array.chunks[2:4] if zarr_array is not None else (len(sel.depths), len(sel.lats))
+        depth_groups = {}
+        for di in range(len(sel.depths)):
+            depth_groups.setdefault((sel.depth_sl.start + di) // chunk_depth, []).append(di)
+        for band in sel.lat_bands(chunk_lat):
+            band_weights = weights[band.lat_sl.start - sel.lat_sl.start:band.lat_sl.stop - sel.lat_sl.start]
+            if not band_weights.any():
+                continue
+            for ti in range(len(sel.tp_labels)):
+                for depth_pos in depth_groups.values():
+                    aggregator.add(read_woa23_block(band, [ti], depth_pos, direct=True), band_weights)
+    labels = {name: name[:-len('_mn')] if name.endswith('_mn') else name for name in columns}
+    df = aggregator.frame(labels).rename({'time_periods': 'time_period'})
+    logger.debug(f"Aggregation of {plan.n_cells()} cells taken: {(datetime.now() - init_time).total_seconds()} seconds")
+    return encode_frame(df, fmt)
+
+@app.get("/api/woa23/aggregate", tags=["WOA23"], summary="Area-weighted WOA23 profile statistics over a region")
+async def get_woa23_aggregate(
+    request: Request,
+    polygon: Optional[str] = Query(None, description="Region as a polygon 'lon,lat;lon,lat;lon,lat;...' (cell centers inside are used). Otherwise the bounding box."),
+    lon0: Lon0Query = None,
+    lat0: Lat0Query = None,
+    lon1: Lon1Query = None,
+    lat1: Lat1Query = None,
+    dep0: Dep0Query = None,
+    dep1: Dep1Query = None,
+    grid: GridQuery = None,
+    append: AppendQuery = None,
+    parameter: ParameterQuery = None,
+    time_period: TimePeriodQuery = None,
+    fmt: Optional[str] = Query('json', alias="format", description="Output format: json (default), csv, arrow, parquet, ndjson."),
+):
+    """
+    Regional climatology profiles computed next to the data: per time_period and depth, the cos(lat) area-weighted
+    `{parameter}_mean`, `_min`, `_max`, `_std` (weighted population std) and `_count` (cells with a value)
+    over the cells of a bounding box or polygon. Only the reduced profiles are returned.
+
+    #### Usage
+    * /api/woa23/aggregate?lon0=120&lat0=10&lon1=140&lat1=30&parameter=oxygen,temperature&time_period=1,2,3
+    * /api/woa23/aggregate?polygon=120,20;135,10;140,30&parameter=salinity&format=csv
+    """
+    if fmt != 'json' and fmt not in output_formats:
+        raise HTTPException(status_code=400, detail="Invalid format. Allowed formats are json, csv, arrow, parquet, ndjson")
+
+    (plan, selections, vertices, cost, key, etag), queue_time = await query_executor.run(
+        prepare_woa23_aggregate, fmt, polygon, lon0, lat0, lon1, lat1, dep0, dep1, grid, append, parameter, time_period)
+    headers = {"ETag": etag, "X-Queue-Time": f"{queue_time:.3f}", "X-Query-Estimate": cost.header()}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    media_type = "application/json"
+    if fmt != 'json':
+        media_type, ext = output_formats[fmt]
+        out_file = f"woa23_aggregate_from_ODB_{datetime.today().strftime('%Y-%m-%d')}.{ext}"
+        headers["Content-Disposition"] = f'attachment; filename="{out_file}"'
+
+    cached = response_cache.get(key, etag)
+    if cached is not None:
+        headers["X-Cache"] = "HIT"
+        return Response(content=cached, media_type=media_type, headers=headers)
+    headers["X-Cache"] = "MISS"
+    body, _ = await query_executor.run(aggregate_woa23, plan, selections, vertices, fmt)
+    response_cache.put(key, etag, body)
+    return Response(content=body, media_type=media_type, headers=headers)